@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+Benchmark the DST test and deploy pipelines against simulated components.
+
+The test and deploy flows run in-process against the CML stand-in, while traceroute, ping, and
+ansible-playbook are replaced by the stubs in dst_sim/bin.  Each phase's latency and the peak memory
+of each run are reported for a sweep of host, domain, and firewall counts.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import argparse
+import contextlib
+import itertools
+import tracemalloc
+import subprocess
+import platform
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+from yaml import dump
+
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+import dst_utils.utils
+import test_dst
+import deploy_dst
+from dst_topology import DSTTopology
+from dst_sim import FakeClientLibrary, LicenseServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SIM_BIN_DIR = os.path.join(BENCH_DIR, "dst_sim", "bin")
+_UNSET = object()
+
+
+def make_config(path, snapshot_dir, hosts, domains, firewalls, license_lease=None):
+    """
+    Write a config file for a simulated run.
+
+    Parameters:
+        path (string): Path of the config file to write.
+        snapshot_dir (string): Directory for the deploy snapshots.
+        hosts (int): Number of test hosts (split evenly between local and tunneled hosts).
+        domains (int): Number of DST domains.
+        firewalls (int): Number of production firewalls.
+        license_lease (float): Optionally register the test firewall and keep it registered for this many hours.
+    """
+
+    conf = {
+        "cml": {"host": "cml.bench.local", "user": "admin", "pass": "admin"},
+        "dst": {"custom_name": "exclude_domains", "domains": ["svc{}.bench{}.example.com".format(i, i % 100) for i in range(domains)]},
+        "test": {
+            "firewall_ip": "192.168.10.114",
+            "vpn_hop": "172.31.113.114",
+            "ansible_user": "admin",
+            "ansible_password": "cisco123",
+            "ansible_become_password": "cisco123",
+            "group_policies": ["DfltGrpPolicy"],
+            "local_hosts": ["www.svc{}.bench{}.example.com".format(i, i % 100) for i in range(min(hosts - hosts // 2, domains))],
+            "tunnel_hosts": ["10.200.{}.{}".format(i // 250, i % 250 + 1) for i in range(hosts // 2)],
+            "canary_host": "8.8.8.8",
+            "hq_server_ip": "10.0.0.2",
+        },
+        "production": {
+            "ansible_user": "admin",
+            "ansible_password": "admin",
+            "ansible_become_password": "admin",
+            "group_policies": ["DfltGrpPolicy"],
+            "firewalls": ["10.{}.{}.1".format(i // 250, i % 250) for i in range(firewalls)],
+            "snapshot_dir": snapshot_dir,
+        },
+    }
+
+    if license_lease is not None:
+        conf["test"]["smart_license_token"] = "BENCH"
+        if license_lease > 0:
+            conf["test"]["license_lease_hours"] = license_lease
+
+    with open(path, "w") as fd:
+        dump(conf, fd, Dumper=Dumper)
+
+    return conf
+
+
+class PhaseRecorder(object):
+    """
+    Record how long each pipeline phase takes by hooking the calls that end each phase.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.probes = []
+        self.__mark = time.time()
+        self.__patched = []
+
+    def reset(self):
+        self.phases = {}
+        self.probes = []
+        self.__mark = time.time()
+
+    def __done(self, orig):
+        def done(msg):
+            now = time.time()
+            name = msg.rstrip(".")
+            self.phases[name] = self.phases.get(name, 0.0) + now - self.__mark
+            self.__mark = now
+            return orig(msg)
+
+        return done
+
+    def __probe(self, orig):
+        def probe(*args, **kwargs):
+            start = time.time()
+            try:
+                return orig(*args, **kwargs)
+            finally:
+                self.probes.append(time.time() - start)
+
+        return probe
+
+    def patch(self, module, attr, value):
+        # Builtins such as input() are shadowed by a module attribute, which is removed again afterwards.
+        self.__patched.append((module, attr, vars(module).get(attr, _UNSET)))
+        setattr(module, attr, value)
+
+    def install(self):
+        for module in (test_dst, deploy_dst, dst_utils.utils):
+            self.patch(module, "done", self.__done(module.done))
+        self.patch(test_dst, "run_traceroute", self.__probe(test_dst.run_traceroute))
+
+    def uninstall(self):
+        for module, attr, value in reversed(self.__patched):
+            if value is _UNSET:
+                delattr(module, attr)
+            else:
+                setattr(module, attr, value)
+        self.__patched = []
+
+
+def run_flow(name, module, argv, recorder):
+    """
+    Run a pipeline's main() in-process and measure it.
+
+    Returns:
+        dict: The measurements for the run.
+    """
+
+    rc = 0
+    recorder.reset()
+    old_argv = sys.argv
+    sys.argv = argv
+    tracemalloc.start()
+    start = time.time()
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            module.main()
+    except SystemExit as e:
+        rc = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    finally:
+        total = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sys.argv = old_argv
+
+    result = {"flow": name, "rc": rc, "total": total, "peak_memory_bytes": peak, "phases": dict(recorder.phases)}
+    if recorder.probes:
+        probes = sorted(recorder.probes)
+        result["probe_latency"] = {
+            "count": len(probes),
+            "mean": sum(probes) / len(probes),
+            "p50": probes[len(probes) // 2],
+            "max": probes[-1],
+        }
+
+    return result
+
+
+# Modules that each command must not load at startup, because only other commands need them.
+IMPORT_FORBIDDEN = {
+    "dst_cli": ["dst_utils", "dst_topology", "yaml"],
+    "deploy_dst": ["dst_topology", "virl2_client", "yaml", "http.server", "future", "past"],
+    "test_dst": ["virl2_client", "yaml", "http.server", "future", "past"],
+    "dst_broker": ["dst_topology", "virl2_client", "yaml", "http.server"],
+}
+
+
+def measure_imports(module, budget=None, repeat=3):
+    """
+    Import a module in a fresh interpreter and check what it loads.
+
+    Parameters:
+        module (string): The module to import.
+        budget (float): Optional maximum import time in seconds.
+        repeat (int): Number of imports to take the fastest of.
+
+    Returns:
+        dict: The measurements, in the same form as run_flow() returns them.
+    """
+
+    total = None
+    loaded = set()
+    for _ in range(repeat):
+        p = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import " + module], cwd=BENCH_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        for line in p.stderr.decode("utf-8").splitlines():
+            # import time: self [us] | cumulative | imported package
+            parts = line.split("|")
+            if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            loaded.add(parts[2].strip())
+            if parts[2].strip() == module:
+                secs = int(parts[1]) / 1000000.0
+                total = secs if total is None else min(total, secs)
+
+    forbidden = [m for m in IMPORT_FORBIDDEN.get(module, []) if m in loaded]
+    over_budget = budget is not None and total is not None and total > budget
+    result = {"flow": "imports", "params": {"module": module}, "rc": 0, "total": total or 0.0, "peak_memory_bytes": 0, "phases": {}}
+    result["modules"] = len(loaded)
+    result["forbidden"] = forbidden
+    if total is None or forbidden or over_budget:
+        result["rc"] = 1
+
+    return result
+
+
+def get_version():
+    try:
+        return (
+            subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        )
+    except Exception:
+        return "unknown"
+
+
+def compare(old, new):
+    """
+    Print the change in total time and peak memory between two result files.
+    """
+
+    def key(run):
+        return (run["flow"], tuple(sorted(run["params"].items())))
+
+    before = {key(run): run for run in old["runs"]}
+    print("")
+    print("Compared to {} ({}):".format(old["meta"]["version"], old["meta"]["timestamp"]))
+    for run in new["runs"]:
+        prev = before.get(key(run))
+        if prev is None:
+            continue
+        dt = (run["total"] - prev["total"]) / prev["total"] * 100 if prev["total"] else 0.0
+        dm = (run["peak_memory_bytes"] - prev["peak_memory_bytes"]) / float(prev["peak_memory_bytes"] or 1) * 100
+        params = ", ".join("{}={}".format(k, v) for k, v in sorted(run["params"].items()))
+        print("  {:<7} {:<40} time {:+7.1f}%  memory {:+7.1f}%".format(run["flow"], params, dt, dm))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=sys.argv[0], description="Benchmark the DST pipelines against simulated components")
+    parser.add_argument("--hosts", type=int_list, default=[4], help="Comma-separated test host counts; default: 4")
+    parser.add_argument("--domains", type=int_list, default=[10], help="Comma-separated DST domain counts; default: 10")
+    parser.add_argument("--firewalls", type=int_list, default=[1], help="Comma-separated production firewall counts; default: 1")
+    parser.add_argument("--flows", default="test,deploy", help="Comma-separated flows to run (test, deploy, imports); default: test,deploy")
+    parser.add_argument(
+        "--import-budget", type=float, help="With the imports flow, fail if importing a command takes longer than this many seconds"
+    )
+    parser.add_argument("--boot-time", type=float, default=0.5, help="Simulated node boot time in seconds; default: 0.5")
+    parser.add_argument("--cml-latency", type=float, default=0.001, help="Simulated CML request latency in seconds; default: 0.001")
+    parser.add_argument("--probe-latency", type=float, default=0.01, help="Simulated traceroute/ping latency in seconds; default: 0.01")
+    parser.add_argument(
+        "--ansible-latency", type=float, default=0.01, help="Simulated per-host Ansible task latency in seconds; default: 0.01"
+    )
+    parser.add_argument(
+        "--license-delay", type=float, help="Register the test firewall with the simulated Smart Licensing, which takes this many seconds"
+    )
+    parser.add_argument(
+        "--license-lease", type=float, default=0, help="Keep the registered test lab for this many hours between runs; default: 0"
+    )
+    parser.add_argument("--output", "-o", metavar="<RESULTS FILE>", help="Write the results to this JSON file")
+    parser.add_argument("--compare", metavar="<RESULTS FILE>", help="Compare the results to an earlier JSON results file")
+    args = parser.parse_args()
+
+    flows = args.flows.split(",")
+    workdir = tempfile.mkdtemp(prefix="dst-bench-")
+    old_env = dict(os.environ)
+    old_cwd = os.getcwd()
+    recorder = PhaseRecorder()
+
+    os.chdir(BENCH_DIR)
+    os.environ["PATH"] = SIM_BIN_DIR + os.pathsep + os.environ.get("PATH", "")
+    os.environ["DST_SIM_PROBE_LATENCY"] = str(args.probe_latency)
+    os.environ["DST_SIM_ANSIBLE_HOST_LATENCY"] = str(args.ansible_latency)
+
+    licensing = None
+    if args.license_delay is not None:
+        os.environ["DST_SIM_LICENSE_STATE"] = os.path.join(workdir, "licensing.json")
+        os.environ["DST_SIM_LICENSE_DELAY"] = str(args.license_delay)
+        licensing = LicenseServer.from_env()
+
+    # A kept lab must outlive the run that created it, so leases share one controller.
+    shared_cml = (
+        FakeClientLibrary("cml.bench.local", boot_time=args.boot_time, latency=args.cml_latency) if args.license_lease > 0 else None
+    )
+    test_argv = ["test_dst.py", "--lease-file", os.path.join(workdir, "lease.json")]
+
+    # The CML stand-in replaces the real client; the user gate "connects" the simulated VPN.
+    recorder.install()
+    recorder.patch(
+        test_dst,
+        "DSTTopology",
+        lambda host, base_config_dir: DSTTopology(
+            host, base_config_dir, client=shared_cml or FakeClientLibrary(host, boot_time=args.boot_time, latency=args.cml_latency)
+        ),
+    )
+    recorder.patch(test_dst, "input", lambda prompt="": os.environ.__setitem__("DST_SIM_VPN", "1") or "y")
+
+    runs = []
+    try:
+        if "imports" in flows:
+            for module in IMPORT_FORBIDDEN:
+                result = measure_imports(module, budget=args.import_budget)
+                runs.append(result)
+                sys.stdout.write(
+                    "{:<7} {:<40} rc={} total={:.3f}s modules={}\n".format(
+                        "imports", "module=" + module, result["rc"], result["total"], result["modules"]
+                    )
+                )
+                for mod in result["forbidden"]:
+                    sys.stdout.write("        loads {}, which only other commands need\n".format(mod))
+
+        combos = []
+        if "test" in flows:
+            combos += [("test", {"hosts": h, "domains": d}) for h, d in itertools.product(args.hosts, args.domains)]
+        if "deploy" in flows:
+            combos += [("deploy", {"domains": d, "firewalls": f}) for d, f in itertools.product(args.domains, args.firewalls)]
+
+        for flow, params in combos:
+            cfg = os.path.join(workdir, "config.yaml")
+            conf = make_config(
+                cfg,
+                os.path.join(workdir, "snapshots"),
+                params.get("hosts", 2),
+                params["domains"],
+                params.get("firewalls", 1),
+                license_lease=args.license_lease if licensing else None,
+            )
+            os.environ["DST_SIM_VPN"] = "0"
+            os.environ["DST_SIM_DST_DOMAINS"] = ",".join(conf["dst"]["domains"])
+
+            if flow == "test":
+                result = run_flow(flow, test_dst, test_argv + ["-c", cfg], recorder)
+            else:
+                result = run_flow(flow, deploy_dst, ["deploy_dst.py", "-c", cfg], recorder)
+
+            result["params"] = params
+            runs.append(result)
+
+            sys.stdout.write(
+                "{:<7} {:<40} rc={} total={:.3f}s peak_mem={:.1f}KiB\n".format(
+                    flow,
+                    ", ".join("{}={}".format(k, v) for k, v in sorted(params.items())),
+                    result["rc"],
+                    result["total"],
+                    result["peak_memory_bytes"] / 1024.0,
+                )
+            )
+            for phase, secs in result["phases"].items():
+                sys.stdout.write("        {:<60} {:.3f}s\n".format(phase, secs))
+
+        if licensing and args.license_lease > 0 and "test" in flows:
+            # Give up the kept registration so the stand-in can show that nothing was left behind.
+            result = run_flow("release", test_dst, test_argv + ["-c", cfg, "--release-lease"], recorder)
+            sys.stdout.write("{:<48} rc={} total={:.3f}s\n".format("release", result["rc"], result["total"]))
+
+        if licensing:
+            stats = licensing.stats()
+            sys.stdout.write(
+                "licensing: {} registrations, {} deregistrations, still registered: {}\n".format(
+                    stats["registrations"], stats["deregistrations"], ", ".join(stats["registered"]) or "none"
+                )
+            )
+    finally:
+        recorder.uninstall()
+        os.environ.clear()
+        os.environ.update(old_env)
+        os.chdir(old_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "meta": {"version": get_version(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version()},
+        "runs": runs,
+    }
+
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(results, fd, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as fd:
+            compare(json.load(fd), results)
+
+    if any(run["rc"] != 0 for run in runs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -32,29 +32,83 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
-from __future__ import print_function
-from builtins import input
-from dst_topology import DSTTopology
 import argparse
 import sys
-import subprocess
 from dst_utils import *
-import time
-import tempfile
 import os
-import re
-from yaml import load, dump
 
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
+
+def ansible_timings(resd):
+    """
+    Get the time each firewall took to apply its plan from the results of an Ansible run.
+
+    Parameters:
+        resd (dict): The parsed playbook results (possibly of a failed run).
+
+    Returns:
+        dict: Mapping of each firewall that applied its plan to the seconds it took (None if it had nothing to apply).
+    """
+
+    task = "Apply the Dynamic Split Tunneling command plan"
+    # The JSON callback only times whole tasks, so each firewall is given the duration of the apply task.
+    secs = get_ansible_task_duration(resd, task)
+    timings = {}
+    for host, result in get_ansible_task_results(resd, task).items():
+        if not result.get("failed") and not result.get("unreachable"):
+            timings[host] = None if result.get("skipped") else secs
+
+    return timings
+
+
+def deploy_plans(msg, hosts, conf, inv, avars, client=None, commands=None, max_workers=8):
+    """
+    Apply the DST command plans to the production firewalls.
+
+    Parameters:
+        msg (string): The progress message to display.
+        hosts (list): List of firewall addresses.
+        conf (dict): Dictionary representing the current configuration file.
+        inv (file object): The Ansible inventory.
+        avars (file object): The Ansible variables (holding the plans).
+        client (BrokerClient): Optional connection broker client to use instead of Ansible.
+        commands (list or dict): The config lines to send through the broker (shared, or per host).
+        max_workers (int): Maximum number of firewalls to work on at once through the broker (default: 8)
+    """
+
+    timings = {}
+    try:
+        with Spinner(msg, total=len(hosts)) as task:
+            if client:
+                run_broker_command(
+                    client, hosts, conf["production"], "config", commands, max_workers=max_workers, progress=task, timings=timings
+                )
+            else:
+                try:
+                    resd = run_ansible_command("dst-playbook.yaml", inv, avars, skip_tags="test")
+                except AnsibleFailed as e:
+                    # Firewalls that applied their plan before the run failed still count as deployed.
+                    timings = ansible_timings(e.results)
+                    raise
+                timings = ansible_timings(resd)
+    except Exception:
+        metrics.firewall_deploys.inc(len(timings), result="ok")
+        metrics.firewall_deploys.inc(len(hosts) - len(timings), result="failed")
+        raise
+
+    for secs in timings.values():
+        if secs is not None:
+            metrics.firewall_deploy.observe(secs, method="broker" if client else "ansible")
+    metrics.firewall_deploys.inc(len(hosts), result="ok")
+
+    done(msg)
 
 
 def main():
     conf = None
     args = None
     msg = None
+    host_plans = None
+    timestamp = None
 
     parser = argparse.ArgumentParser(prog=sys.argv[0], description="Deploy Dynamic Split Tunneling to a set of firewalls")
     parser.add_argument(
@@ -64,30 +118,142 @@ def main():
         help="Path to the configuration file; default: config.yaml in the current directory",
         default="config.yaml",
     )
+    parser.add_argument(
+        "--running-config",
+        "-r",
+        metavar="<RUNNING CONFIG FILE>",
+        help="Path to a copy of the firewalls' running config to plan the changes against offline; default: plan the full DST config",
+    )
+    parser.add_argument("--plan", action="store_true", help="Print the DST command plan for each firewall and exit without deploying")
+    parser.add_argument(
+        "--broker",
+        metavar="<SOCKET PATH>",
+        nargs="?",
+        const=DEFAULT_BROKER_SOCKET,
+        help="Apply the changes through the connection broker listening on this socket (default: {}) instead of opening new sessions".format(
+            DEFAULT_BROKER_SOCKET
+        ),
+    )
+    parser.add_argument(
+        "--push-profile",
+        action="store_true",
+        help="Also copy profiles/DST.xml to each firewall whose copy has a different checksum",
+    )
+    parser.add_argument(
+        "--snapshot-dir",
+        "-s",
+        metavar="<SNAPSHOT DIR>",
+        help="Directory in which to keep pre-change snapshots; default: snapshot_dir in the production section, else snapshots",
+    )
+    parser.add_argument("--no-snapshot", action="store_true", help="Do not snapshot the firewalls' DST config before the change")
+    parser.add_argument(
+        "--rollback",
+        metavar="<TIMESTAMP>",
+        nargs="?",
+        const="latest",
+        help="Undo the change recorded in the given snapshot (default: the latest one) and exit",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="<METRICS FILE>",
+        help="Write the run's metrics to this Prometheus textfile (e.g., in the node_exporter textfile directory); default: $DST_METRICS_FILE",
+        default=os.environ.get("DST_METRICS_FILE"),
+    )
     args = parser.parse_args()
 
     if not os.path.exists(args.config):
         print("ERROR: Config file {} does not exist!".format(args.config))
         sys.exit(1)
 
-    with open(args.config, "r") as fd:
-        conf = load(fd, Loader=Loader)
+    conf = load_config(args.config)
 
-    check_sections("production", conf)
-    check_vars("production", conf)
+    check_config("production", conf)
 
-    inv = build_ansible_inventory(config=conf)
-    avars = build_ansible_vars(conf, "production")
+    running = None
+    if args.running_config:
+        if not os.path.exists(args.running_config):
+            print("ERROR: Running config file {} does not exist!".format(args.running_config))
+            sys.exit(1)
+
+        running = AsaConfig.from_file(args.running_config)
+
+    client = None
+    if args.broker:
+        client = BrokerClient(args.broker)
+        if not client.is_alive():
+            print("ERROR: No connection broker is listening on {}.".format(args.broker))
+            sys.exit(1)
 
-    msg = "Running Ansible to deploy DST config to production..."
+    max_concurrency = set_ansible_concurrency(conf, "production")
 
-    os.environ["ANSIBLE_CONFIG"] = os.getcwd() + "/ansible/dst.ansible.cfg"
+    os.environ["ANSIBLE_CONFIG"] = os.path.join(DST_BASE_DIR, "ansible", "dst.ansible.cfg")
     os.environ["ANSIBLE_HOST_KEY_CHECKING"] = "False"
 
-    with Spinner(msg):
+    if args.plan:
+        group_policies = conf["production"]["group_policies"]
+        if running is not None:
+            plans = {"Plan against {}".format(args.running_config): build_command_plan(conf["dst"], group_policies, running)}
+        elif args.no_snapshot:
+            plans = {"Plan for every firewall with --no-snapshot": build_command_plan(conf["dst"], group_policies)}
+        else:
+            # A deployment plans each firewall against its own config, so read them (without changing anything).
+            inv = build_ansible_inventory(config=conf)
+            avars = build_ansible_vars(conf, "production")
+            try:
+                configs = capture_dst_config(
+                    conf["production"]["firewalls"],
+                    inv=inv,
+                    avars=avars,
+                    client=client,
+                    creds=conf["production"],
+                    max_workers=max_concurrency,
+                )
+            except Exception as e:
+                print("ERROR: Failed to read the production config: {}".format(e))
+                sys.exit(1)
+            finally:
+                # Remove the files quietly, so only the plan is printed.
+                os.remove(inv.name)
+                os.remove(avars.name)
+
+            plans = {}
+            for host, text in configs.items():
+                plans["Plan for {}".format(host)] = build_command_plan(conf["dst"], group_policies, AsaConfig(text))
+
+        for title, plan in plans.items():
+            print("! {}".format(title))
+            text = render_plan(plan)
+            if text:
+                sys.stdout.write(text)
+            else:
+                print("! No DST changes are needed.")
+        sys.exit(0)
+
+    metrics.begin("rollback" if args.rollback else "deploy", args.metrics_file)
+
+    store = SnapshotStore(args.snapshot_dir or conf["production"].get("snapshot_dir", DEFAULT_SNAPSHOT_DIR))
+
+    if args.rollback:
+        timestamp = store.latest() if args.rollback == "latest" else args.rollback
+        if timestamp is None or len(store.hosts(timestamp)) == 0:
+            print("ERROR: No snapshot {}found in {}.".format("" if args.rollback == "latest" else args.rollback + " ", store.base_dir))
+            sys.exit(1)
+
+        host_plans = store.rollback_plans(timestamp)
+        if len(host_plans) == 0:
+            print("Nothing to roll back for snapshot {}.".format(timestamp))
+            sys.exit(0)
+
+        hosts = sorted(host_plans)
+        inv = build_ansible_inventory(config=conf, hosts=hosts)
+        avars = build_ansible_vars(conf, "production", host_plans=host_plans)
+        commands = {host: plan_commands(plan) for host, plan in host_plans.items()}
+
+        msg = "Rolling back the DST config on {} firewall(s) to snapshot {}...".format(len(hosts), timestamp)
         try:
-            run_ansible_command("dst-playbook.yaml", inv, avars, skip_tags="test")
+            deploy_plans(msg, hosts, conf, inv, avars, client=client, commands=commands, max_workers=max_concurrency)
         except Exception as e:
+            metrics.failures.inc(command="rollback", stage="deploy")
             print("")
             print("ERROR: {}".format(e))
             try:
@@ -96,7 +262,93 @@ def main():
                 pass
             sys.exit(1)
 
-    done(msg)
+        try:
+            cleanup(inv=inv, avars=avars)
+        except Exception as e:
+            print("")
+            print("WARNING: Failed to cleanup after rollback: {}".format(e))
+            sys.exit(1)
+
+        metrics.finish("rolled_back")
+        sys.exit(0)
+
+    hosts = conf["production"]["firewalls"]
+    inv = build_ansible_inventory(config=conf)
+    avars = build_ansible_vars(conf, "production", running)
+
+    if args.push_profile:
+        msg = "Pushing the VPN profile to production..."
+
+        with Spinner(msg):
+            try:
+                run_ansible_command("push-profile-playbook.yaml", inv, avars)
+            except Exception as e:
+                metrics.failures.inc(command="deploy", stage="push_profile")
+                print("")
+                print("ERROR: {}".format(e))
+                try:
+                    cleanup(inv=inv, avars=avars)
+                except:
+                    pass
+                sys.exit(1)
+
+        done(msg)
+
+    if not args.no_snapshot:
+        msg = "Taking a snapshot of the production DST config..."
+
+        with Spinner(msg, total=len(hosts)) as task:
+            try:
+                configs = capture_dst_config(
+                    hosts, inv=inv, avars=avars, client=client, creds=conf["production"], max_workers=max_concurrency, progress=task
+                )
+
+                # With each firewall's config in hand, plan an exact delta per firewall.
+                timestamp = store.new_timestamp()
+                host_plans = {}
+                for host, text in configs.items():
+                    host_plans[host] = build_command_plan(conf["dst"], conf["production"]["group_policies"], AsaConfig(text))
+                    # Only keep snapshots of firewalls that will change, so a later --rollback undoes a real change.
+                    if len(host_plans[host]) > 0:
+                        store.save(host, timestamp, text, host_plans[host])
+
+                os.remove(avars.name)
+                avars = build_ansible_vars(conf, "production", running, host_plans)
+            except Exception as e:
+                print("")
+                print("ERROR: Failed to snapshot the production config: {}".format(e))
+                metrics.failures.inc(command="deploy", stage="snapshot")
+                try:
+                    cleanup(inv=inv, avars=avars)
+                except:
+                    pass
+                sys.exit(1)
+
+        done(msg)
+
+    if host_plans is not None:
+        commands = {host: plan_commands(plan) for host, plan in host_plans.items()}
+    else:
+        commands = plan_commands(build_command_plan(conf["dst"], conf["production"]["group_policies"], running))
+
+    if client:
+        msg = "Deploying DST config to production through the connection broker..."
+    else:
+        msg = "Running Ansible to deploy DST config to production..."
+
+    try:
+        deploy_plans(msg, hosts, conf, inv, avars, client=client, commands=commands, max_workers=max_concurrency)
+    except Exception as e:
+        metrics.failures.inc(command="deploy", stage="deploy")
+        print("")
+        print("ERROR: {}".format(e))
+        if timestamp and len(store.hosts(timestamp)) > 0:
+            print("To restore the previous config, run {} --rollback {}".format(sys.argv[0], timestamp))
+        try:
+            cleanup(inv=inv, avars=avars)
+        except:
+            pass
+        sys.exit(1)
 
     try:
         cleanup(inv=inv, avars=avars)
@@ -105,6 +357,8 @@ def main():
         print("WARNING: Failed to cleanup after deployment: {}".format(e))
         sys.exit(1)
 
+    metrics.finish("deployed")
+
 
 if __name__ == "__main__":
     main()
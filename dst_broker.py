@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Run a connection broker that keeps SSH sessions to the firewalls alive between DST runs.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import argparse
+import sys
+from dst_utils import *
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=sys.argv[0], description="Keep authenticated firewall sessions alive across DST runs")
+    parser.add_argument(
+        "--socket",
+        "-s",
+        metavar="<SOCKET PATH>",
+        help="Path to the Unix socket on which to listen; default: {}".format(DEFAULT_BROKER_SOCKET),
+        default=DEFAULT_BROKER_SOCKET,
+    )
+    parser.add_argument(
+        "--max-sessions",
+        "-m",
+        metavar="<COUNT>",
+        type=int,
+        help="Maximum number of firewall sessions to keep open; default: 16",
+        default=16,
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        "-t",
+        metavar="<SECONDS>",
+        type=int,
+        help="Close sessions that have been idle for this many seconds; default: 300",
+        default=300,
+    )
+    parser.add_argument("--stop", action="store_true", help="Stop a running broker and exit")
+    args = parser.parse_args()
+
+    if args.stop:
+        client = BrokerClient(args.socket)
+        if not client.is_alive():
+            print("ERROR: No connection broker is listening on {}.".format(args.socket))
+            sys.exit(1)
+
+        client.request({"op": "shutdown"})
+        sys.exit(0)
+
+    broker = ConnectionBroker(args.socket, max_sessions=args.max_sessions, idle_timeout=args.idle_timeout)
+    print("Connection broker listening on {}...".format(args.socket))
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
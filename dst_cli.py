@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+The dst command: one entry point for testing, deploying, and operating Dynamic Split Tunneling configs.
+
+Each subcommand runs the main() of the script that implements it, and only that script is imported,
+so e.g. "dst deploy" never loads the CML client.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import importlib
+import sys
+
+# Subcommand: (module, arguments prepended to the user's arguments, description)
+COMMANDS = {
+    "test": ("test_dst", [], "Build a test lab and test the DST config"),
+    "deploy": ("deploy_dst", [], "Deploy the DST config to the production firewalls"),
+    "plan": ("deploy_dst", ["--plan"], "Print the DST commands a deployment would send"),
+    "rollback": ("deploy_dst", ["--rollback"], "Undo the change recorded in a snapshot (default: the latest one)"),
+    "broker": ("dst_broker", [], "Run the connection broker that keeps firewall sessions open"),
+    "daemon": ("dst_daemon", [], "Run the daemon that batches DST domain changes"),
+    "bench": ("bench_dst", [], "Benchmark the pipelines against simulated components"),
+}
+
+
+def usage(out):
+    out.write("usage: dst <command> [options]\n\nCommands:\n")
+    for name, (_, _, desc) in COMMANDS.items():
+        out.write("  {:<10} {}\n".format(name, desc))
+    out.write("\nRun 'dst <command> --help' for the options of a command.\n")
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+
+    if len(argv) == 0 or argv[0] in ("-h", "--help"):
+        usage(sys.stdout)
+        sys.exit(0)
+
+    if argv[0] not in COMMANDS:
+        sys.stderr.write("ERROR: Unknown command '{}'.\n\n".format(argv[0]))
+        usage(sys.stderr)
+        sys.exit(2)
+
+    module, extra, _ = COMMANDS[argv[0]]
+    sys.argv = ["dst " + argv[0]] + extra + argv[1:]
+
+    importlib.import_module(module).main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Queue DST domain changes and batch them into combined test and deploy cycles.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import argparse
+import os
+import sys
+import threading
+from dst_utils.daemon import ChangeBatcher, make_server, DEFAULT_DAEMON_SOCKET
+from dst_utils.broker import DEFAULT_BROKER_SOCKET
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=sys.argv[0], description="Batch DST domain changes into combined test and deploy cycles")
+    parser.add_argument(
+        "--config",
+        "-c",
+        metavar="<CONFIG FILE>",
+        help="Path to the configuration file; default: config.yaml in the current directory",
+        default="config.yaml",
+    )
+    parser.add_argument(
+        "--socket",
+        "-s",
+        metavar="<SOCKET PATH>",
+        help="Unix socket on which the HTTP API listens; default: {}".format(DEFAULT_DAEMON_SOCKET),
+        default=DEFAULT_DAEMON_SOCKET,
+    )
+    parser.add_argument(
+        "--listen",
+        "-l",
+        metavar="<HOST:PORT>",
+        help="Serve the HTTP API on this TCP address instead; clients must then send the token in $DST_DAEMON_TOKEN",
+    )
+    parser.add_argument(
+        "--window",
+        "-w",
+        metavar="<SECONDS>",
+        type=float,
+        help="Seconds to wait after the first queued change for more changes before starting a cycle; default: 300",
+        default=300,
+    )
+    parser.add_argument("--deploy", action="store_true", help="Deploy each batch to production once its test passes")
+    parser.add_argument(
+        "--state-file",
+        metavar="<STATE FILE>",
+        help="File in which the deployed domain list is kept; default: dst-daemon-state.json",
+        default="dst-daemon-state.json",
+    )
+    parser.add_argument(
+        "--broker",
+        metavar="<SOCKET PATH>",
+        nargs="?",
+        const=DEFAULT_BROKER_SOCKET,
+        help="Pass --broker to the test and deploy runs; default socket: {}".format(DEFAULT_BROKER_SOCKET),
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="<METRICS FILE>",
+        help="Also write the metrics served on /metrics to this Prometheus textfile after every cycle",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.config):
+        print("ERROR: Config file {} does not exist!".format(args.config))
+        sys.exit(1)
+
+    extra_args = []
+    if args.broker:
+        extra_args = ["--broker", args.broker]
+
+    try:
+        batcher = ChangeBatcher(
+            args.config, args.state_file, window=args.window, deploy=args.deploy, extra_args=extra_args, metrics_file=args.metrics_file
+        )
+    except Exception as e:
+        print("ERROR: {}".format(e))
+        sys.exit(1)
+
+    if args.listen:
+        # Anyone on the host can reach a TCP port, so the API then requires a token.
+        token = os.environ.get("DST_DAEMON_TOKEN")
+        if not token:
+            print("ERROR: Set DST_DAEMON_TOKEN to the token clients must send before listening on {}.".format(args.listen))
+            sys.exit(1)
+
+        host, _, port = args.listen.rpartition(":")
+        try:
+            server = make_server(batcher, listen=(host or "127.0.0.1", int(port)), token=token)
+        except ValueError:
+            print("ERROR: Invalid listen address {}.".format(args.listen))
+            sys.exit(1)
+        where = args.listen
+    else:
+        try:
+            server = make_server(batcher, socket_path=args.socket)
+        except Exception as e:
+            print("ERROR: {}".format(e))
+            sys.exit(1)
+        where = args.socket
+
+    thr = threading.Thread(target=server.serve_forever)
+    thr.daemon = True
+    thr.start()
+
+    print("DST change daemon listening on {} (batch window {}s)...".format(where, args.window))
+    try:
+        batcher.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batcher.stop()
+        server.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+from .cml import FakeClientLibrary
+from .licensing import LicenseServer
@@ -0,0 +1,286 @@
+"""
+A local, in-process stand-in for a CML controller.
+
+It implements the subset of the virl2_client ClientLibrary API that DSTTopology uses, with configurable
+node boot times and per-request latency, so lab creation, readiness polling and teardown can be exercised
+without a real controller or a network.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import threading
+import itertools
+import time
+
+# Interfaces created by populate_interfaces=True for each node definition.
+_DEFAULT_INTERFACES = {
+    "iosv": ["GigabitEthernet0/{}".format(i) for i in range(4)],
+    "asav": ["Management0/0", "GigabitEthernet0/0"],
+    "unmanaged_switch": ["port{}".format(i) for i in range(8)],
+    "ubuntu": ["enp0s2"],
+    "external_connector": ["port"],
+}
+
+
+class FakeInterface(object):
+    def __init__(self, node, label):
+        self.node = node
+        self.label = label
+
+    @property
+    def discovered_ipv4(self):
+        self.node.lab.controller.request()
+        if self.node.is_booted() and self.label in self.node.discovered_ips:
+            return [self.node.discovered_ips[self.label]]
+
+        return []
+
+
+class FakeNode(object):
+    def __init__(self, lab, label, node_definition, populate_interfaces=False):
+        self.lab = lab
+        self.label = label
+        self.node_definition = node_definition
+        self.config = None
+        self.interfaces = []
+        self.discovered_ips = {}
+        self.__booted_at = None
+
+        if populate_interfaces:
+            for ilabel in _DEFAULT_INTERFACES.get(node_definition, []):
+                self.interfaces.append(FakeInterface(self, ilabel))
+
+    def _start(self, now):
+        self.__booted_at = now + self.lab.controller.boot_time_for(self.node_definition)
+
+    def _stop(self):
+        self.__booted_at = None
+
+    def create_interface(self):
+        self.lab.controller.request()
+        prefix = "GigabitEthernet0/"
+        n = len([i for i in self.interfaces if i.label.startswith(prefix)])
+        iface = FakeInterface(self, prefix + str(n))
+        self.interfaces.append(iface)
+        return iface
+
+    def get_interface_by_label(self, label):
+        self.lab.controller.request()
+        for iface in self.interfaces:
+            if iface.label == label:
+                return iface
+
+        raise Exception("Interface {} not found on node {}".format(label, self.label))
+
+    def is_booted(self):
+        self.lab.controller.request()
+        return self.__booted_at is not None and time.time() >= self.__booted_at
+
+    def has_converged(self):
+        return self.is_booted()
+
+
+class FakeLab(object):
+    def __init__(self, controller, lab_id, title):
+        self.controller = controller
+        self.id = lab_id
+        self.title = title
+        self.description = ""
+        self.wait_for_convergence = True
+        self.nodes = []
+        self.links = []
+        self.__state = "DEFINED_ON_CORE"
+
+    def create_node(self, label, node_definition, populate_interfaces=False):
+        self.controller.request()
+        node = FakeNode(self, label, node_definition, populate_interfaces=populate_interfaces)
+        if node_definition == "asav" and self.controller.fw_ip:
+            node.discovered_ips["Management0/0"] = self.controller.fw_ip
+        self.nodes.append(node)
+        return node
+
+    def get_node_by_label(self, label):
+        self.controller.request()
+        for node in self.nodes:
+            if node.label == label:
+                return node
+
+        raise Exception("Node {} not found in lab {}".format(label, self.id))
+
+    def create_link(self, i1, i2):
+        self.controller.request()
+        self.links.append((i1, i2))
+
+    def state(self):
+        self.controller.request()
+        return self.__state
+
+    def start(self, wait=False):
+        self.controller.request()
+        now = time.time()
+        for node in self.nodes:
+            node._start(now)
+        self.__state = "STARTED"
+        if wait:
+            while not all(node.is_booted() for node in self.nodes):
+                time.sleep(0.01)
+
+    def stop(self, wait=False):
+        self.controller.request()
+        for node in self.nodes:
+            node._stop()
+        if wait:
+            time.sleep(self.controller.stop_time)
+        self.__state = "STOPPED"
+
+    def wipe(self, wait=False):
+        self.controller.request()
+        if self.__state == "STARTED":
+            raise Exception("Lab {} must be stopped before it can be wiped".format(self.id))
+        self.__state = "DEFINED_ON_CORE"
+
+    def remove(self):
+        self.controller.request()
+        self.controller._remove_lab(self)
+
+
+class FakeClientLibrary(object):
+    """
+    Drop-in replacement for virl2_client.ClientLibrary backed by an in-memory controller.
+
+    Parameters:
+        url (string): Ignored; accepted for compatibility with ClientLibrary.
+        ssl_verify: Ignored; accepted for compatibility with ClientLibrary.
+        boot_time (float or dict): Seconds from lab start until a node is booted, either for all nodes or per
+                                   node definition (e.g., {"asav": 5, "default": 1}).
+        latency (float): Seconds each API request takes.
+        stop_time (float): Seconds a lab takes to stop when waited on.
+        fw_ip (string): Address the firewall's Management0/0 interface reports once booted (None to report nothing).
+    """
+
+    def __init__(self, url=None, ssl_verify=False, boot_time=0.0, latency=0.0, stop_time=0.0, fw_ip="192.168.10.114"):
+        self.url = url
+        self.boot_time = boot_time
+        self.latency = latency
+        self.stop_time = stop_time
+        self.fw_ip = fw_ip
+        self.request_count = 0
+
+        self.__labs = {}
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+
+    def boot_time_for(self, node_definition):
+        if isinstance(self.boot_time, dict):
+            return self.boot_time.get(node_definition, self.boot_time.get("default", 0.0))
+
+        return self.boot_time
+
+    def request(self):
+        """
+        Account for (and simulate the latency of) a single API request.
+        """
+
+        with self.__lock:
+            self.request_count += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def wait_for_lld_connected(self):
+        self.request()
+
+    def find_labs_by_title(self, title):
+        self.request()
+        with self.__lock:
+            return [lab for lab in self.__labs.values() if lab.title == title]
+
+    def create_lab(self, title=None):
+        self.request()
+        with self.__lock:
+            lab_id = "{:06x}".format(next(self.__ids))
+            lab = FakeLab(self, lab_id, title)
+            self.__labs[lab_id] = lab
+        return lab
+
+    def join_existing_lab(self, lab_id):
+        self.request()
+        with self.__lock:
+            if lab_id not in self.__labs:
+                raise Exception("Lab {} does not exist".format(lab_id))
+            return self.__labs[lab_id]
+
+    def all_labs(self):
+        self.request()
+        with self.__lock:
+            return list(self.__labs.values())
+
+    def _remove_lab(self, lab):
+        with self.__lock:
+            self.__labs.pop(lab.id, None)
+
+
+if __name__ == "__main__":
+    import sys
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from dst_topology import DSTTopology
+
+    base_config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "base_configs")
+    client = FakeClientLibrary(boot_time={"asav": 2.0, "default": 1.0}, latency=0.005)
+
+    def run_lab(_):
+        times = {}
+        start = time.time()
+        dstt = DSTTopology("localhost", base_config_dir, client=client)
+        dstt.create_topology()
+        times["create"] = time.time() - start
+
+        start = time.time()
+        dstt.start()
+        while not dstt.is_ready():
+            time.sleep(0.1)
+        times["ready"] = time.time() - start
+
+        start = time.time()
+        dstt.stop()
+        dstt.wipe()
+        dstt.remove()
+        times["teardown"] = time.time() - start
+
+        return times
+
+    labs = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    with ThreadPoolExecutor(max_workers=labs) as pool:
+        for i, times in enumerate(pool.map(run_lab, range(labs))):
+            print("Lab {}: {}".format(i, ", ".join("{}={:.3f}s".format(k, v) for k, v in times.items())))
+
+    print("Total API requests: {}".format(client.request_count))
@@ -0,0 +1,125 @@
+"""
+A local stand-in for Smart Licensing, so registration, reuse, and deregistration can be checked without a Smart Account.
+
+Registrations are kept in a JSON state file shared by all of the (separate) runs of the Ansible stub:
+
+    DST_SIM_LICENSE_STATE  Path of the state file; the stand-in is only used when this is set.
+    DST_SIM_LICENSE_DELAY  Seconds a registration takes to complete.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+import json
+import time
+import fcntl
+import contextlib
+
+
+class LicenseServer(object):
+    """
+    File-backed record of which firewalls are registered.
+
+    Parameters:
+        path (string): The state file.
+        delay (float): Seconds a registration takes to complete.
+    """
+
+    def __init__(self, path, delay=0.0):
+        self.path = path
+        self.delay = delay
+
+    @classmethod
+    def from_env(cls):
+        if not os.environ.get("DST_SIM_LICENSE_STATE"):
+            return None
+
+        return cls(os.environ["DST_SIM_LICENSE_STATE"], float(os.environ.get("DST_SIM_LICENSE_DELAY", "0")))
+
+    @contextlib.contextmanager
+    def __state(self):
+        with open(self.path, "a+") as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            fd.seek(0)
+            data = fd.read()
+            state = json.loads(data) if data else {"hosts": {}, "registrations": 0, "deregistrations": 0}
+            yield state
+            fd.seek(0)
+            fd.truncate()
+            json.dump(state, fd, indent=2)
+
+    def register(self, host):
+        with self.__state() as state:
+            if host not in state["hosts"]:
+                state["hosts"][host] = time.time() + self.delay
+                state["registrations"] += 1
+
+    def deregister(self, host):
+        with self.__state() as state:
+            if state["hosts"].pop(host, None) is not None:
+                state["deregistrations"] += 1
+
+    def registered_at(self, host):
+        with self.__state() as state:
+            return state["hosts"].get(host)
+
+    def status(self, host):
+        """
+        Returns:
+            string: REGISTERED, REGISTERING, or UNREGISTERED.
+        """
+
+        ready = self.registered_at(host)
+        if ready is None:
+            return "UNREGISTERED"
+
+        return "REGISTERED" if time.time() >= ready else "REGISTERING"
+
+    def wait_registered(self, host, timeout):
+        """
+        Wait (as the retries of the registration task would) until a host is registered.
+
+        Returns:
+            string: The final status.
+        """
+
+        ready = self.registered_at(host)
+        if ready is not None:
+            time.sleep(min(max(0.0, ready - time.time()), timeout))
+
+        return self.status(host)
+
+    def stats(self):
+        with self.__state() as state:
+            return {
+                "registered": sorted(state["hosts"]),
+                "registrations": state["registrations"],
+                "deregistrations": state["deregistrations"],
+            }
@@ -0,0 +1,222 @@
+"""
+A stand-in for ansible-playbook that emits the same JSON the 'json' stdout callback does.
+
+The stub in dst_sim/bin calls into this module.  It reads the real playbooks (so task names, tags, and
+imports match), works out which tasks would run, and fabricates realistic per-host results.  Its behavior
+is controlled with environment variables:
+
+    DST_SIM_ANSIBLE_STARTUP       Seconds spent starting up (default: 0.2).
+    DST_SIM_ANSIBLE_HOST_LATENCY  Seconds each task takes per host (default: 0.01).
+    DST_SIM_ANSIBLE_FAIL_TASK     Name of a task that should fail on every host.
+    DST_SIM_PROFILE_CURRENT       Set to 1 if the firewalls already have the current VPN profile.
+    ANSIBLE_FORKS                 Number of hosts worked on in parallel (default: 5).
+    DST_SIM_LICENSE_STATE         Smart Licensing stand-in state file (see dst_sim/licensing.py).
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import math
+import argparse
+import datetime
+from yaml import load
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+from dst_utils.asa_config import AsaConfig
+from dst_sim.licensing import LicenseServer
+
+_TASK_KEYWORDS = ("name", "tags", "when", "register", "failed_when", "delegate_to", "with_items", "loop")
+
+
+def _load_tasks(path, inherited_tags=None):
+    with open(path, "r") as fd:
+        tasks = load(fd, Loader=Loader) or []
+
+    return _expand_tasks(tasks, os.path.dirname(path), inherited_tags)
+
+
+def _expand_tasks(tasks, base_dir, inherited_tags=None):
+    result = []
+    for task in tasks:
+        tags = list(inherited_tags or [])
+        ttags = task.get("tags", [])
+        tags += [ttags] if isinstance(ttags, str) else ttags
+        if "import_tasks" in task:
+            result += _load_tasks(os.path.join(base_dir, task["import_tasks"]), tags)
+            continue
+
+        action = [k for k in task if k not in _TASK_KEYWORDS][0]
+        result.append({"name": task.get("name", action), "action": action, "args": task[action], "tags": tags})
+
+    return result
+
+
+def _show_running(base_config, command):
+    section = command[len("show running-config ") :].strip()
+    out = []
+
+    def walk(line, depth):
+        out.append(" " * depth + line.text)
+        for child in line.children:
+            walk(child, depth + 1)
+
+    for line in base_config.find(section):
+        walk(line, 0)
+
+    return "\n".join(out)
+
+
+def _license_output(command, host, task, licensing):
+    if command.startswith("license smart register"):
+        licensing.register(host)
+        return ""
+    if command.startswith("license smart deregister"):
+        licensing.deregister(host)
+        return ""
+
+    status = licensing.status(host)
+    if status == "REGISTERING" and "wait_for" in task["args"]:
+        status = licensing.wait_registered(host, 3600)
+
+    return "Smart Licensing is ENABLED\n\nRegistration:\n  Status: {}".format(status)
+
+
+def _command_output(command, avars, base_config):
+    if command.startswith("verify /md5"):
+        md5 = avars.get("dst_profile_md5", "") if os.environ.get("DST_SIM_PROFILE_CURRENT") == "1" else uuid.uuid4().hex
+        return "verify /MD5 (disk0:/DST.xml) = {}".format(md5)
+    if command.startswith("show running-config"):
+        return _show_running(base_config, command)
+    if command.startswith("show license status"):
+        return "Smart Licensing is ENABLED\n\nRegistration:\n  Status: REGISTERED"
+    if command.startswith("ping"):
+        return "Sending 5, 100-byte ICMP Echos, timeout is 2 seconds:\n!!!!!\nSuccess rate is 100 percent (5/5)"
+
+    return ""
+
+
+def _host_result(task, host, avars, base_config, licensing=None):
+    result = {"_ansible_no_log": False, "action": task["action"], "changed": task["action"] in ("asa_config", "net_put")}
+    if task["action"] == "asa_command":
+        commands = task["args"]["commands"]
+        if isinstance(commands, str):
+            # e.g., "{{ dst_snapshot_commands }}"
+            commands = avars.get(commands.strip("{} "), [])
+        stdout = []
+        for c in commands:
+            if licensing is not None and (c.startswith("license smart") or c.startswith("show license status")):
+                stdout.append(_license_output(c, host, task, licensing))
+            else:
+                stdout.append(_command_output(c, avars, base_config))
+        result["stdout"] = stdout
+        result["stdout_lines"] = [s.splitlines() for s in stdout]
+
+    return result
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat() + "Z"
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="ansible-playbook")
+    parser.add_argument("-i", dest="inventory")
+    parser.add_argument("-e", dest="extra_vars", action="append", default=[])
+    parser.add_argument("--skip-tags", dest="skip_tags", default="")
+    parser.add_argument("--tags", dest="tags", default="")
+    parser.add_argument("playbook")
+    args = parser.parse_args()
+
+    time.sleep(float(os.environ.get("DST_SIM_ANSIBLE_STARTUP", "0.2")))
+
+    extra = dict(e.split("=", 1) for e in args.extra_vars)
+    with open(extra["dst_variable_file"], "r") as fd:
+        avars = load(fd, Loader=Loader)
+
+    with open(args.inventory, "r") as fd:
+        hosts = [line.strip() for line in fd if line.strip()]
+
+    base_config = AsaConfig.from_file(os.path.join(avars["dst_base_dir"], "base_configs", "hq_firewall.txt"))
+
+    with open(args.playbook, "r") as fd:
+        play = load(fd, Loader=Loader)[0]
+
+    tasks = _expand_tasks(play["tasks"], os.path.dirname(os.path.abspath(args.playbook)))
+
+    skip = set(t for t in args.skip_tags.split(",") if t)
+    only = set(t for t in args.tags.split(",") if t)
+    forks = int(os.environ.get("ANSIBLE_FORKS", "5"))
+    host_latency = float(os.environ.get("DST_SIM_ANSIBLE_HOST_LATENCY", "0.01"))
+    fail_task = os.environ.get("DST_SIM_ANSIBLE_FAIL_TASK")
+    licensing = LicenseServer.from_env()
+
+    stats = {h: {"changed": 0, "failures": 0, "ignored": 0, "ok": 0, "rescued": 0, "skipped": 0, "unreachable": 0} for h in hosts}
+    results = []
+    failed = False
+    for task in tasks:
+        if skip.intersection(task["tags"]) or (only and not only.intersection(task["tags"])):
+            continue
+
+        start = _now()
+        time.sleep(host_latency * math.ceil(len(hosts) / float(max(1, forks))))
+        hresults = {}
+        for host in hosts:
+            hresults[host] = _host_result(task, host, avars, base_config, licensing)
+            if task["name"] == fail_task:
+                hresults[host]["failed"] = True
+                hresults[host]["msg"] = "Simulated failure"
+                stats[host]["failures"] += 1
+                failed = True
+            else:
+                stats[host]["ok"] += 1
+                stats[host]["changed"] += 1 if hresults[host]["changed"] else 0
+
+        results.append(
+            {"hosts": hresults, "task": {"duration": {"start": start, "end": _now()}, "id": str(uuid.uuid4()), "name": task["name"]}}
+        )
+        if failed:
+            break
+
+    out = {
+        "custom_stats": {},
+        "global_custom_stats": {},
+        "plays": [{"play": {"id": str(uuid.uuid4()), "name": play.get("name", "")}, "tasks": results}],
+        "stats": stats,
+    }
+    sys.stdout.write(json.dumps(out, indent=4) + "\n")
+    sys.exit(2 if failed else 0)
@@ -0,0 +1,96 @@
+"""
+Simulated traceroute and ping for running the DST test flow without a network or a VPN.
+
+The stubs in dst_sim/bin call into this module.  Their behavior is controlled with environment variables:
+
+    DST_SIM_VPN            Set to 1 once the (simulated) AnyConnect client is connected.
+    DST_SIM_DST_DOMAINS    Comma-separated list of domains excluded from the tunnel.
+    DST_SIM_VPN_HOP        The third hop of a tunneled path (test.vpn_hop).
+    DST_SIM_LOCAL_HOPS     Comma-separated list of the first three hops of the local path.
+    DST_SIM_PROBE_LATENCY  Seconds each traceroute or ping takes.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+import sys
+import time
+
+DEFAULT_LOCAL_HOPS = "192.168.1.1,10.10.0.1,10.20.0.1"
+DEFAULT_VPN_HOP = "172.31.113.114"
+
+
+def _sleep():
+    latency = float(os.environ.get("DST_SIM_PROBE_LATENCY", "0"))
+    if latency > 0:
+        time.sleep(latency)
+
+
+def route_for(host):
+    """
+    Return the first three hops to a host given the simulated VPN state.
+
+    Parameters:
+        host (string): The traceroute target.
+
+    Returns:
+        list: The three hops.
+    """
+
+    local = os.environ.get("DST_SIM_LOCAL_HOPS", DEFAULT_LOCAL_HOPS).split(",")
+    if os.environ.get("DST_SIM_VPN") != "1":
+        return local
+
+    for domain in os.environ.get("DST_SIM_DST_DOMAINS", "").split(","):
+        if domain and (host == domain or host.endswith("." + domain)):
+            return local
+
+    return ["10.100.0.1", "172.31.113.115", os.environ.get("DST_SIM_VPN_HOP", DEFAULT_VPN_HOP)]
+
+
+def traceroute_main():
+    """
+    Entry point of the traceroute stub; prints output in the same format as 'traceroute -n'.
+    """
+
+    host = sys.argv[-1]
+    _sleep()
+    print("traceroute to {} ({}), 3 hops max, 60 byte packets".format(host, host))
+    for i, hop in enumerate(route_for(host), start=1):
+        print(" {}  {}  1.234 ms".format(i, hop))
+
+
+def ping_main():
+    """
+    Entry point of the ping stub; the target is always reachable.
+    """
+
+    _sleep()
+    sys.exit(0)
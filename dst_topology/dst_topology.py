@@ -31,13 +31,9 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
-from __future__ import print_function
-from builtins import input
-from builtins import range
-from builtins import object
-from virl2_client import ClientLibrary
 import string
 import random
+import copy
 import time
 import os
 
@@ -60,9 +56,19 @@ class DSTTopology(object):
         "OOB Management": {"type": "external_connector", "node": None, "config": "oob_management.txt"},
     }
 
-    def __init__(self, cml_controller, base_config_dir):
+    def __init__(self, cml_controller, base_config_dir, client=None):
         self.__base_config_dir = base_config_dir
 
+        # Each topology needs its own node objects so that several labs can be driven at once.
+        self.__nodes = copy.deepcopy(DSTTopology.__nodes)
+
+        if client is not None:
+            # Use the given client (e.g., the local CML stand-in in dst_sim)
+            self.__client = client
+            return
+
+        from virl2_client import ClientLibrary
+
         ssl_cert = False
 
         if "CA_BUNDLE" in os.environ:
@@ -154,6 +160,33 @@ class DSTTopology(object):
         self.__connect_nodes()
         self.__configure_nodes()
 
+    def attach(self, lab_id):
+        """
+        Attach to an existing, running DST test lab (e.g., one kept for the Smart License registration of its firewall).
+
+        Parameters:
+            lab_id (string): The ID of the lab.
+        """
+
+        self.__client.wait_for_lld_connected()
+        self.__lab = self.__client.join_existing_lab(lab_id)
+        if self.__lab.state() != "STARTED":
+            raise Exception("Lab {} is not running.".format(lab_id))
+
+        for node in list(self.__nodes.keys()):
+            self.__nodes[node]["node"] = self.__lab.get_node_by_label(node)
+
+        self.__started = True
+        self.__wiped = False
+
+    @property
+    def lab_id(self):
+        """
+        The ID of the lab, or None if it has not been created yet.
+        """
+
+        return self.__lab.id if self.__lab is not None else None
+
     def start(self):
         """
         Start the DST test lab.
@@ -196,12 +229,13 @@ class DSTTopology(object):
 
         return ready
 
-    def get_fw_ip(self, wait=False):
+    def get_fw_ip(self, wait=False, policy=None):
         """
         Return the IP address of the OOB Management interface on the firewall node.
 
         Parameters:
             wait (Boolean): Whether or not to wait for the firewall node to converge (default: False)
+            policy (RetryPolicy): Optional policy that controls the wait (default: poll every second)
 
         Returns:
             string: The first IP address on Management0/0 if found, else None
@@ -213,8 +247,11 @@ class DSTTopology(object):
         if not wait and not self.__nodes["HQ Firewall"]["node"].has_converged():
             raise Exception("Firewall node has not yet converged.")
         elif not self.__nodes["HQ Firewall"]["node"].has_converged():
-            while not self.__nodes["HQ Firewall"]["node"].has_converged():
-                time.sleep(1)
+            if policy is None:
+                from dst_utils.retry import RetryPolicy
+
+                policy = RetryPolicy("fw_ip", initial=1.0, factor=1.0, jitter=0.0)
+            policy.wait_until(self.__nodes["HQ Firewall"]["node"].has_converged)
 
         fm0 = self.__nodes["HQ Firewall"]["node"].get_interface_by_label("Management0/0")
         ip4_addr = fm0.discovered_ipv4
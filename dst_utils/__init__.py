@@ -1 +1,27 @@
 from .utils import *
+from .domains import *
+from .asa_config import *
+from .broker import *
+from .snapshot import *
+from .stages import *
+from .retry import *
+from .license import *
+from .config import *
+from .progress import *
+from .metrics import *
+
+# The change daemon pulls in the HTTP server modules, which only dst_daemon.py needs, so its names are
+# imported on first use (e.g., "from dst_utils import ChangeBatcher") rather than with the rest.
+_LAZY_MODULES = (".daemon",)
+
+
+def __getattr__(name):
+    import importlib
+
+    if not name.startswith("_"):
+        for mod in _LAZY_MODULES:
+            module = importlib.import_module(mod, __name__)
+            if hasattr(module, name):
+                return getattr(module, name)
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,397 @@
+"""
+Offline ASA configuration model and DST command planner.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+from .domains import pack_domains
+
+DST_CUSTOM_TYPE = "dynamic-split-exclude-domains"
+DST_CUSTOM_ATTR = "anyconnect-custom-attr {} description Exclude domains from tunneling".format(DST_CUSTOM_TYPE)
+
+# The show commands whose output contains every section a DST change can touch.
+DST_SNAPSHOT_COMMANDS = [
+    "show running-config webvpn",
+    "show running-config anyconnect-custom-data",
+    "show running-config group-policy",
+]
+
+
+class AsaConfigLine(object):
+    """
+    A single line of ASA config along with its parent and child lines.
+    """
+
+    def __init__(self, text, parent=None, lineno=0):
+        self.text = text
+        self.parent = parent
+        self.lineno = lineno
+        self.children = []
+
+    @property
+    def parents(self):
+        """
+        Return the list of parent line texts from the top-level section down.
+        """
+
+        parents = []
+        p = self.parent
+        while p is not None:
+            parents.insert(0, p.text)
+            p = p.parent
+
+        return parents
+
+    def __repr__(self):
+        return "AsaConfigLine({!r}, parents={!r})".format(self.text, self.parents)
+
+
+class AsaConfig(object):
+    """
+    An indexed, in-memory model of an ASA configuration (e.g., a base config or a fetched running config).
+    """
+
+    def __init__(self, text=None):
+        self.lines = []
+        self.__index = {}
+        if text:
+            self.parse(text)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Build a model from a config file on disk.
+
+        Parameters:
+            path (string): Path to the ASA config file.
+
+        Returns:
+            AsaConfig: The parsed config model.
+        """
+
+        with open(path, "r") as fd:
+            return cls(fd.read())
+
+    def parse(self, text):
+        """
+        Parse ASA config text into the model.  Sections are determined by indentation.
+
+        Parameters:
+            text (string): The ASA config text.
+        """
+
+        # Stack of (indent, AsaConfigLine) for the currently open sections.
+        stack = []
+        for lineno, raw in enumerate(text.splitlines(), start=1):
+            stripped = raw.strip()
+            if not stripped or stripped.startswith("!") or stripped.startswith(":"):
+                continue
+
+            indent = len(raw) - len(raw.lstrip(" "))
+            while len(stack) > 0 and stack[-1][0] >= indent:
+                stack.pop()
+
+            parent = stack[-1][1] if len(stack) > 0 else None
+            line = AsaConfigLine(stripped, parent=parent, lineno=lineno)
+            if parent is None:
+                self.lines.append(line)
+            else:
+                parent.children.append(line)
+
+            self.__index[tuple(line.parents + [stripped])] = line
+            stack.append((indent, line))
+
+    def get(self, text, parents=None):
+        """
+        Look up a line by its text and parents.
+
+        Parameters:
+            text (string): The line text.
+            parents (list): Optional list of parent line texts.
+
+        Returns:
+            AsaConfigLine: The matching line, or None if not found.
+        """
+
+        return self.__index.get(tuple(list(parents or []) + [text]))
+
+    def has_line(self, text, parents=None):
+        """
+        Check if a line exists under the given parents.
+        """
+
+        return self.get(text, parents) is not None
+
+    def find(self, prefix, parents=None):
+        """
+        Find all lines directly under the given parents that start with a prefix.
+
+        Parameters:
+            prefix (string): The line prefix to match.
+            parents (list): Optional list of parent line texts (default: top-level lines).
+
+        Returns:
+            list: List of matching AsaConfigLine objects.
+        """
+
+        if parents:
+            section = self.get(parents[-1], parents[:-1])
+            if section is None:
+                return []
+            candidates = section.children
+        else:
+            candidates = self.lines
+
+        return [line for line in candidates if line.text.startswith(prefix)]
+
+
+def dst_sets(dst, group_policies):
+    """
+    List the custom-data sets of a DST config, each with the group policies that use it.
+
+    The 'dst' section either names a single set with 'custom_name' and 'domains' (used by every group policy
+    of the run), or defines several under 'sets', each with a 'name', its 'domains', and optionally the
+    'group_policies' that use it (default: every group policy of the run not claimed by another set).  Only
+    the group policies of the run are used, so the test firewall can enable DST on fewer of them.
+
+    Parameters:
+        dst (dict): The 'dst' section of the config file.
+        group_policies (list): The group policies of the run (from the 'test' or 'production' section).
+
+    Returns:
+        list: List of dicts with 'name', 'domains', and 'group_policies' keys.
+    """
+
+    sets = []
+    if dst.get("custom_name") is not None:
+        sets.append({"name": dst["custom_name"], "domains": dst.get("domains") or [], "group_policies": None})
+    for s in dst.get("sets") or []:
+        sets.append({"name": s["name"], "domains": s.get("domains") or [], "group_policies": s.get("group_policies")})
+
+    names = [s["name"] for s in sets]
+    for name in names:
+        if names.count(name) > 1:
+            raise Exception("DST custom-data set '{}' is defined more than once".format(name))
+
+    # A group policy can only reference one value of the custom attribute.
+    owners = {}
+    for s in sets:
+        for gp in s["group_policies"] or []:
+            if gp in owners:
+                raise Exception("Group policy '{}' is mapped to both DST sets '{}' and '{}'".format(gp, owners[gp], s["name"]))
+            owners[gp] = s["name"]
+
+    defaults = [s for s in sets if s["group_policies"] is None]
+    rest = [gp for gp in group_policies if gp not in owners]
+    if len(defaults) > 1 and len(rest) > 0:
+        raise Exception(
+            "DST sets {} do not list their group policies, so group policies {} would be mapped to all of them".format(
+                ", ".join("'{}'".format(s["name"]) for s in defaults), ", ".join(rest)
+            )
+        )
+
+    for s in sets:
+        s["group_policies"] = rest if s["group_policies"] is None else [gp for gp in s["group_policies"] if gp in group_policies]
+
+    return sets
+
+
+def build_command_plan(dst, group_policies, running=None):
+    """
+    Compute the set of ASA commands needed to apply a DST config.
+
+    All of the custom-data sets and group policies are combined into one plan, so each firewall is
+    changed in a single session.
+
+    Parameters:
+        dst (dict): The 'dst' section of the config file.
+        group_policies (list): List of group policies for which to enable DST.
+        running (AsaConfig): Optional model of the current device config.  When given, only the
+                             commands needed to move from this config to the desired state are returned
+                             (including removing stale domain entries and the data of sets no longer in
+                             the config).  Without it, the full desired config is returned and Ansible
+                             only applies the lines the device does not have yet, so stale entries stay.
+
+    Returns:
+        list: List of plan blocks, each a dict with 'parents' and 'lines' keys, in the order they must be applied.
+    """
+
+    plan = []
+    sets = dst_sets(dst, group_policies)
+
+    # The custom attribute type must exist before any data can reference it.
+    if running is None or len(running.find("anyconnect-custom-attr {} ".format(DST_CUSTOM_TYPE), ["webvpn"])) == 0:
+        plan.append({"parents": ["webvpn"], "lines": [DST_CUSTOM_ATTR]})
+
+    lines = []
+    for dset in sets:
+        data_prefix = "anyconnect-custom-data {} {} ".format(DST_CUSTOM_TYPE, dset["name"])
+        current = [] if running is None else [line.text for line in running.find(data_prefix)]
+        # Keep the values already on the device where possible, so a small change only touches a few lines.
+        existing = [text[len(data_prefix) :] for text in current]
+        wanted = [data_prefix + chunk for chunk in pack_domains(dset["domains"], existing=existing)]
+
+        for text in current:
+            if text not in wanted:
+                lines.append("no " + text)
+
+        for line in wanted:
+            if running is None or not running.has_line(line):
+                lines.append(line)
+
+    if len(lines) > 0:
+        plan.append({"parents": [], "lines": lines})
+
+    for dset in sets:
+        line = "anyconnect-custom {} value {}".format(DST_CUSTOM_TYPE, dset["name"])
+        for gp in dset["group_policies"]:
+            parents = ["group-policy {} attributes".format(gp)]
+            if running is None:
+                plan.append({"parents": parents, "lines": [line]})
+            elif not running.has_line(line, parents):
+                # Remove the value of a group policy that moves to another set, so a rollback can restore it.
+                current = running.find("anyconnect-custom {} value ".format(DST_CUSTOM_TYPE), parents)
+                plan.append({"parents": parents, "lines": ["no " + c.text for c in current] + [line]})
+
+    if running is not None:
+        plan += _stale_set_plan(sets, group_policies, running)
+
+    return plan
+
+
+def _stale_set_plan(sets, group_policies, running):
+    # Find the custom data of sets that are no longer in the config.
+    names = [dset["name"] for dset in sets]
+    stale = {}
+    for line in running.find("anyconnect-custom-data {} ".format(DST_CUSTOM_TYPE)):
+        name = line.text.split()[2]
+        if name not in names:
+            stale.setdefault(name, []).append(line.text)
+
+    # The group policies of the run that no set claims stop using the data; a group policy this run does not
+    # manage keeps it in place.
+    plan = []
+    assigned = [gp for dset in sets for gp in dset["group_policies"]]
+    prefix = "anyconnect-custom {} value ".format(DST_CUSTOM_TYPE)
+    kept = set()
+    for section in running.find("group-policy "):
+        if not section.text.endswith(" attributes"):
+            continue
+        gp = section.text[len("group-policy ") : -len(" attributes")]
+        for ref in running.find(prefix, [section.text]):
+            name = ref.text[len(prefix) :]
+            if name not in stale:
+                continue
+            if gp not in group_policies:
+                kept.add(name)
+            elif gp not in assigned:
+                plan.append({"parents": [section.text], "lines": ["no " + ref.text]})
+
+    lines = ["no " + text for name in sorted(stale) if name not in kept for text in stale[name]]
+    if len(lines) > 0:
+        plan.append({"parents": [], "lines": lines})
+
+    return plan
+
+
+def invert_plan(plan, running):
+    """
+    Compute the plan that undoes a previously applied plan.
+
+    Parameters:
+        plan (list): The plan that was applied.
+        running (AsaConfig): Model of the device config before the plan was applied.
+
+    Returns:
+        list: The rollback plan, in the order it must be applied.
+    """
+
+    inverse = []
+    for block in reversed(plan):
+        lines = []
+        for line in reversed(block["lines"]):
+            if line.startswith("no "):
+                # Only restore what was really there before the change.
+                if running.has_line(line[3:], block["parents"]):
+                    lines.append(line[3:])
+            elif not running.has_line(line, block["parents"]):
+                lines.append("no " + line)
+
+        if len(lines) > 0:
+            inverse.append({"parents": list(block["parents"]), "lines": lines})
+
+    return inverse
+
+
+def render_plan(plan):
+    """
+    Render a command plan as indented ASA config text.
+
+    Parameters:
+        plan (list): The plan as returned by build_command_plan().
+
+    Returns:
+        string: The config text (empty if there is nothing to do).
+    """
+
+    out = []
+    for block in plan:
+        depth = 0
+        for parent in block["parents"]:
+            out.append(" " * depth + parent)
+            depth += 1
+
+        for line in block["lines"]:
+            out.append(" " * depth + line)
+
+    if len(out) == 0:
+        return ""
+
+    return "\n".join(out) + "\n"
+
+
+def plan_commands(plan):
+    """
+    Flatten a command plan into the sequence of lines to enter in configuration mode.
+
+    Parameters:
+        plan (list): The plan as returned by build_command_plan().
+
+    Returns:
+        list: List of config lines, with 'exit' lines to leave each sub-mode.
+    """
+
+    commands = []
+    for block in plan:
+        commands += block["parents"]
+        commands += block["lines"]
+        commands += ["exit"] * len(block["parents"])
+
+    return commands
@@ -0,0 +1,575 @@
+"""
+A connection broker that keeps authenticated SSH sessions to ASA firewalls alive across runs.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+import re
+import json
+import time
+import socket
+import struct
+import hashlib
+import threading
+import socketserver
+from collections import OrderedDict
+from .metrics import metrics
+
+# Sockets that carry credentials live in a directory only the current user can reach, so no one else can listen in
+# their place.
+DST_RUNTIME_DIR = os.path.join(os.environ["XDG_RUNTIME_DIR"], "dst") if os.environ.get("XDG_RUNTIME_DIR") else os.path.expanduser("~/.dst")
+DEFAULT_BROKER_SOCKET = os.path.join(DST_RUNTIME_DIR, "broker.sock")
+
+_PROMPT_RE = re.compile(r"[\w\-\.\/]+(\([\w\-]+\))?[>#]\s*$")
+_PASSWORD_RE = re.compile(r"[Pp]assword:\s*$")
+_ERROR_RE = re.compile(r"^(ERROR|% ?Invalid|% ?Incomplete)", re.MULTILINE)
+
+
+def session_key(host, port, username, password, enable_password=None):
+    """
+    Return the pool key for a session.  It includes a digest of the passwords, so a request with
+    different credentials never reuses a session opened with other ones.
+    """
+
+    secret = "{}\0{}".format(password, enable_password if enable_password is not None else password)
+    return (host, port, username, hashlib.sha256(secret.encode("utf-8")).hexdigest())
+
+
+def make_private_dir(path):
+    """
+    Create a directory that only the current user can access, or check that an existing one is.
+
+    Parameters:
+        path (string): The directory path.
+    """
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise Exception("Directory {} must be owned by the current user and not accessible to others".format(path))
+
+
+def check_socket_owner(sock, socket_path):
+    """
+    Check that a Unix socket belongs to a process of the current user before sending it anything secret.
+
+    Parameters:
+        sock (socket): The connected socket.
+        socket_path (string): The path it is connected to.
+    """
+
+    if os.stat(socket_path).st_uid != os.getuid():
+        raise Exception("Socket {} is not owned by the current user".format(socket_path))
+
+    # Where the platform reports it, also check the process at the other end, not just the file.
+    if hasattr(socket, "SO_PEERCRED"):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        if struct.unpack("3i", creds)[1] != os.getuid():
+            raise Exception("The process listening on {} does not belong to the current user".format(socket_path))
+
+
+class AsaSession(object):
+    """
+    A single interactive SSH session to an ASA in privileged (enable) mode.
+    """
+
+    def __init__(self, host, username, password, enable_password=None, port=22, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.timeout = timeout
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+        self.key = session_key(host, port, username, password, enable_password)
+        # Number of requests holding this session; only the broker's pool lock guards it.
+        self.users = 0
+
+        self.__password = password
+        self.__enable_password = enable_password if enable_password is not None else password
+        self.__client = None
+        self.__channel = None
+
+    def __read_until(self, pattern):
+        buf = ""
+        deadline = time.time() + self.timeout
+        while not pattern.search(buf):
+            if time.time() > deadline:
+                raise Exception("Timed out waiting for a response from {}".format(self.host))
+            try:
+                data = self.__channel.recv(65535)
+            except socket.timeout:
+                continue
+            if not data:
+                raise Exception("Connection to {} closed unexpectedly".format(self.host))
+            buf += data.decode("utf-8", errors="replace")
+
+        return buf
+
+    def __send(self, line, pattern=_PROMPT_RE):
+        self.__channel.send(line + "\n")
+        return self.__read_until(pattern)
+
+    def connect(self):
+        """
+        Open the SSH session, enter enable mode, and disable paging.
+        """
+
+        # Only pull in the SSH stack when a session is actually opened.
+        import paramiko
+
+        self.__client = paramiko.SSHClient()
+        self.__client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.__client.connect(
+            self.host,
+            port=self.port,
+            username=self.username,
+            password=self.__password,
+            timeout=self.timeout,
+            look_for_keys=False,
+            allow_agent=False,
+        )
+        self.__channel = self.__client.invoke_shell(width=511)
+        self.__channel.settimeout(1)
+
+        prompt = self.__read_until(_PROMPT_RE)
+        if prompt.rstrip().endswith(">"):
+            self.__channel.send("enable\n")
+            out = self.__read_until(re.compile(_PASSWORD_RE.pattern + "|" + _PROMPT_RE.pattern))
+            if _PASSWORD_RE.search(out):
+                out = self.__send(self.__enable_password)
+            if not out.rstrip().endswith("#"):
+                raise Exception("Failed to enter enable mode on {}".format(self.host))
+
+        self.__send("terminal pager 0")
+        self.last_used = time.time()
+
+    def is_alive(self):
+        """
+        Check if the underlying SSH transport is still usable.
+        """
+
+        if self.__client is None:
+            return False
+
+        transport = self.__client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def execute(self, commands):
+        """
+        Run a list of exec commands and return their output.
+
+        Parameters:
+            commands (list): List of commands to run.
+
+        Returns:
+            list: List of output strings, one per command.
+        """
+
+        output = []
+        for command in commands:
+            out = self.__send(command)
+            # Strip the echoed command and the trailing prompt.
+            lines = out.splitlines()
+            output.append("\n".join(lines[1:-1]))
+
+        self.last_used = time.time()
+        return output
+
+    def configure(self, lines):
+        """
+        Apply a list of config lines in configuration mode.
+
+        Parameters:
+            lines (list): List of config lines (including any 'exit' lines needed to leave sub-modes).
+
+        Returns:
+            list: List of output strings, one per line.
+        """
+
+        self.execute(["configure terminal"])
+        output = []
+        for line in lines:
+            out = self.execute([line])[0]
+            if _ERROR_RE.search(out):
+                # Stop at the first error, but leave config mode so the session can be reused.
+                self.execute(["end"])
+                raise Exception("'{}' failed on {}: {}".format(line, self.host, out.strip()))
+            output.append(out)
+
+        self.execute(["end"])
+        return output
+
+    def close(self):
+        """
+        Close the SSH session.
+        """
+
+        if self.__client is not None:
+            try:
+                self.__client.close()
+            except Exception:
+                pass
+
+        self.__client = None
+        self.__channel = None
+
+
+class ConnectionBroker(object):
+    """
+    A bounded pool of ASA sessions that is served to the runners over a Unix socket.
+    """
+
+    def __init__(self, socket_path=DEFAULT_BROKER_SOCKET, max_sessions=16, idle_timeout=300):
+        self.socket_path = socket_path
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+
+        self.__sessions = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__released = threading.Condition(self.__lock)
+        self.__server = None
+        self.__running = False
+
+    def get_session(self, host, username, password, enable_password=None, port=22):
+        """
+        Return the pooled session for the given host, creating a new (unconnected) one if needed.  The
+        session is marked in use before it is returned, so it cannot be evicted until it is released with
+        release_session().  If the pool is full of sessions in use, wait for one to be released.
+        """
+
+        key = session_key(host, port, username, password, enable_password)
+        stale = []
+        with self.__lock:
+            while True:
+                session = self.__sessions.pop(key, None)
+                if session is not None and session.users == 0 and not session.is_alive():
+                    stale.append(session)
+                    session = None
+
+                if session is not None:
+                    break
+
+                # Evict the least recently used sessions that are not in use to make room for a new one.
+                for oldest in list(self.__sessions):
+                    if len(self.__sessions) < self.max_sessions:
+                        break
+                    if self.__sessions[oldest].users == 0:
+                        stale.append(self.__sessions.pop(oldest))
+
+                if len(self.__sessions) < self.max_sessions:
+                    session = AsaSession(host, username, password, enable_password=enable_password, port=port)
+                    break
+
+                self.__released.wait()
+
+            # Keep the pool ordered from least to most recently used.
+            session.users += 1
+            self.__sessions[key] = session
+
+        for s in stale:
+            s.close()
+
+        return session
+
+    def release_session(self, session):
+        """
+        Mark a session returned by get_session() as no longer in use.
+        """
+
+        with self.__lock:
+            session.users -= 1
+            self.__released.notify_all()
+
+    def drop_session(self, session):
+        """
+        Remove a (broken) session from the pool and close it.
+        """
+
+        with self.__lock:
+            if self.__sessions.get(session.key) is session:
+                del self.__sessions[session.key]
+            self.__released.notify_all()
+
+        session.close()
+
+    def reap_idle(self):
+        """
+        Close sessions that have not been used within the idle timeout.
+        """
+
+        now = time.time()
+        idle = []
+        with self.__lock:
+            for key, session in list(self.__sessions.items()):
+                if now - session.last_used > self.idle_timeout and session.users == 0:
+                    idle.append(self.__sessions.pop(key))
+
+        for session in idle:
+            session.close()
+
+    def stats(self):
+        """
+        Return a summary of the current pool.
+        """
+
+        with self.__lock:
+            return {
+                "sessions": len(self.__sessions),
+                "max_sessions": self.max_sessions,
+                "idle_timeout": self.idle_timeout,
+                "hosts": [key[0] for key in self.__sessions],
+            }
+
+    def handle(self, req):
+        """
+        Handle a single broker request.
+
+        Parameters:
+            req (dict): The request with an 'op' key and the op's parameters.
+
+        Returns:
+            dict: The response.
+        """
+
+        op = req.get("op")
+        if op == "stats":
+            return {"ok": True, "stats": self.stats()}
+        if op == "shutdown":
+            threading.Thread(target=self.shutdown).start()
+            return {"ok": True}
+        if op not in ("exec", "config"):
+            return {"ok": False, "error": "Unknown operation '{}'".format(op)}
+
+        session = self.get_session(
+            req["host"], req["username"], req["password"], enable_password=req.get("enable_password"), port=req.get("port", 22)
+        )
+        try:
+            with session.lock:
+                try:
+                    if not session.is_alive():
+                        session.connect()
+                    if op == "exec":
+                        output = session.execute(req["commands"])
+                    else:
+                        output = session.configure(req["commands"])
+                except Exception as e:
+                    self.drop_session(session)
+                    return {"ok": False, "error": str(e)}
+        finally:
+            self.release_session(session)
+
+        return {"ok": True, "output": output}
+
+    def __reaper(self):
+        while self.__running:
+            time.sleep(min(5, self.idle_timeout))
+            self.reap_idle()
+
+    def serve_forever(self):
+        """
+        Listen on the broker socket until shut down.
+        """
+
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        resp = broker.handle(json.loads(line.decode("utf-8")))
+                    except Exception as e:
+                        resp = {"ok": False, "error": str(e)}
+                    self.wfile.write((json.dumps(resp) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+
+        if os.path.dirname(self.socket_path) == DST_RUNTIME_DIR:
+            make_private_dir(DST_RUNTIME_DIR)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        # The socket carries device credentials, so only the owner may connect.
+        omask = os.umask(0o077)
+        try:
+            self.__server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        finally:
+            os.umask(omask)
+
+        self.__server.daemon_threads = True
+        self.__running = True
+        threading.Thread(target=self.__reaper, daemon=True).start()
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.__running = False
+            self.__server.server_close()
+            with self.__lock:
+                sessions = list(self.__sessions.values())
+                self.__sessions.clear()
+            for session in sessions:
+                session.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        """
+        Stop serving and close all sessions.
+        """
+
+        if self.__server is not None:
+            self.__server.shutdown()
+
+
+class BrokerClient(object):
+    """
+    Client used by the runners to attach to a running ConnectionBroker.
+    """
+
+    def __init__(self, socket_path=DEFAULT_BROKER_SOCKET, timeout=300):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, req):
+        """
+        Send a single request to the broker and return its response.
+        """
+
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        try:
+            s.connect(self.socket_path)
+            check_socket_owner(s, self.socket_path)
+            s.sendall((json.dumps(req) + "\n").encode("utf-8"))
+            buf = b""
+            while not buf.endswith(b"\n"):
+                data = s.recv(65535)
+                if not data:
+                    break
+                buf += data
+        finally:
+            s.close()
+
+        return json.loads(buf.decode("utf-8"))
+
+    def is_alive(self):
+        """
+        Check if a broker is listening on the socket.
+        """
+
+        try:
+            return self.request({"op": "stats"})["ok"]
+        except Exception:
+            return False
+
+    def run(self, op, host, creds, commands):
+        """
+        Run exec commands ('exec') or config lines ('config') on a host through the broker.
+
+        Parameters:
+            op (string): Either "exec" or "config".
+            host (string): The firewall address.
+            creds (dict): Config section with ansible_user, ansible_password, and ansible_become_password.
+            commands (list): List of commands or config lines.
+
+        Returns:
+            list: List of output strings, one per command.
+        """
+
+        resp = self.request(
+            {
+                "op": op,
+                "host": host,
+                "username": creds["ansible_user"],
+                "password": creds["ansible_password"],
+                "enable_password": creds.get("ansible_become_password"),
+                "commands": commands,
+            }
+        )
+        if not resp["ok"]:
+            raise Exception(resp["error"])
+
+        return resp["output"]
+
+
+def run_broker_command(client, hosts, creds, op, commands, max_workers=8, progress=None, timings=None):
+    """
+    Run the same commands on a set of hosts through the broker in parallel.
+
+    Parameters:
+        client (BrokerClient): The broker client.
+        hosts (list): List of firewall addresses.
+        creds (dict): Config section with the device credentials.
+        op (string): Either "exec" or "config".
+        commands (list): List of commands or config lines, or a dict mapping each host to its own list.
+        max_workers (int): Maximum number of hosts to work on at once (default: 8)
+        progress (ProgressTask): Optional progress task to update as each host finishes.
+        timings (dict): Optional dict in which to store how long each host that succeeded took, in seconds.
+
+    Returns:
+        dict: Mapping of host to its list of command outputs.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    def run(host, hcommands):
+        start = time.time()
+        try:
+            output = client.run(op, host, creds, hcommands)
+        except Exception:
+            metrics.broker_command.observe(time.time() - start, op=op, result="failed")
+            raise
+        secs = time.time() - start
+        metrics.broker_command.observe(secs, op=op, result="ok")
+        if timings is not None:
+            timings[host] = secs
+        return output
+
+    results = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(hosts)))) as pool:
+        futures = {}
+        for host in hosts:
+            hcommands = commands[host] if isinstance(commands, dict) else commands
+            futures[pool.submit(run, host, hcommands)] = host
+        for future in as_completed(futures):
+            host = futures[future]
+            try:
+                results[host] = future.result()
+                if progress:
+                    progress.update(host)
+            except Exception as e:
+                errors.append("{}: {}".format(host, e))
+                if progress:
+                    progress.update(host, "failed", failed=True)
+
+    if len(errors) > 0:
+        raise Exception("Failed to run commands through the connection broker on {}".format("; ".join(errors)))
+
+    return results
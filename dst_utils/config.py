@@ -0,0 +1,366 @@
+"""
+The config file schema, its validator, and a cache of parsed config files.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+import re
+import copy
+import hashlib
+import threading
+from .domains import normalize_domains
+from .asa_config import dst_sets
+from .retry import DEFAULT_WAITS, RetryPolicy
+
+
+def _check_domains(value):
+    normalize_domains(value)
+
+
+def _check_ipv4(value):
+    if not re.match(r"^\d{1,3}(\.\d{1,3}){3}$", value):
+        raise Exception("must be an IPv4 address")
+
+
+def _check_positive(value):
+    if value <= 0:
+        raise Exception("must be greater than 0")
+
+
+def _check_waits(value):
+    problems = []
+    for name, params in value.items():
+        if name not in DEFAULT_WAITS:
+            problems.append("unknown wait '{}' (known waits: {})".format(name, ", ".join(sorted(DEFAULT_WAITS))))
+            continue
+        try:
+            RetryPolicy(name, **dict(DEFAULT_WAITS[name], **(params or {})))
+        except Exception as e:
+            problems.append("invalid parameters for wait '{}': {}".format(name, e))
+
+    if len(problems) > 0:
+        raise Exception("; ".join(problems))
+
+
+def _check_dst_sets(value):
+    problems = []
+    for i, dset in enumerate(value, start=1):
+        if not isinstance(dset, dict):
+            problems.append("set {} must be a mapping".format(i))
+            continue
+        name = dset.get("name")
+        if not isinstance(name, str) or not re.match(r"^[\w\-\.]+$", name):
+            problems.append("set {} needs a 'name' made of letters, digits, '_', '-', or '.'".format(i))
+            name = str(i)
+        unknown = [k for k in dset if k not in ("name", "domains", "group_policies")]
+        if len(unknown) > 0:
+            problems.append("set '{}' has unknown key(s) {}".format(name, ", ".join(str(k) for k in unknown)))
+        domains = dset.get("domains")
+        if not isinstance(domains, list) or not all(isinstance(d, str) for d in domains):
+            problems.append("set '{}' needs 'domains' as a list of strings".format(name))
+        else:
+            try:
+                normalize_domains(domains)
+            except Exception as e:
+                problems.append("set '{}': {}".format(name, e))
+        gps = dset.get("group_policies")
+        if gps is not None and (not isinstance(gps, list) or not all(isinstance(gp, str) for gp in gps)):
+            problems.append("set '{}' needs 'group_policies' as a list of strings".format(name))
+
+    if len(problems) > 0:
+        raise Exception("; ".join(problems))
+
+
+def _check_dst_section(config, type):
+    dst = config["dst"]
+    if dst.get("sets") is None and dst.get("custom_name") is None:
+        raise Exception("define either 'custom_name' and 'domains', or 'sets'")
+    if dst.get("custom_name") is not None and dst.get("domains") is None:
+        raise Exception("'domains' must be defined with 'custom_name'")
+
+    # Check how the sets map to the group policies of this run.
+    dst_sets(dst, config[type]["group_policies"])
+
+
+def Var(type, required=True, items=None, check=None):
+    """
+    Declare a variable of a config section.
+
+    Parameters:
+        type (type or tuple): The allowed type(s) of the value.
+        required (Boolean): Whether the variable must be defined (default: True)
+        items (type or tuple): For lists, the allowed type(s) of each item.
+        check (function): Optional function that raises an Exception (with the reason) if the value is invalid.
+    """
+
+    return {"type": type, "required": required, "items": items, "check": check}
+
+
+_SCALAR = (str, int, float)
+_CREDS = {
+    "ansible_user": Var(_SCALAR),
+    "ansible_password": Var(_SCALAR),
+    "ansible_become_password": Var(_SCALAR),
+    "group_policies": Var(list, items=str),
+    "max_concurrency": Var(int, required=False, check=_check_positive),
+}
+
+# Each section lists the run types that need it, its variables, and optional checks of the whole section (each called
+# with the config and the run type, once every variable is valid).
+CONFIG_SCHEMA = {
+    "cml": {
+        "types": ("test",),
+        "vars": {"host": Var(str), "user": Var(_SCALAR), "pass": Var(_SCALAR)},
+    },
+    "dst": {
+        "types": ("test", "production"),
+        "vars": {
+            "custom_name": Var(str, required=False),
+            "domains": Var(list, required=False, items=str, check=_check_domains),
+            "sets": Var(list, required=False, check=_check_dst_sets),
+        },
+        "checks": (_check_dst_section,),
+    },
+    "test": {
+        "types": ("test",),
+        "vars": dict(
+            _CREDS,
+            local_hosts=Var(list, items=str),
+            tunnel_hosts=Var(list, items=str),
+            canary_host=Var(str, check=_check_ipv4),
+            vpn_hop=Var(str),
+            firewall_ip=Var(str, required=False),
+            hq_server_ip=Var(str, required=False),
+            smart_license_token=Var(str, required=False),
+            license_lease_hours=Var((int, float), required=False, check=_check_positive),
+            waits=Var(dict, required=False, check=_check_waits),
+        ),
+    },
+    "production": {
+        "types": ("production",),
+        "vars": dict(_CREDS, firewalls=Var(list, items=str), snapshot_dir=Var(str, required=False)),
+    },
+}
+
+
+class ConfigError(object):
+    """
+    A single problem found in a config file.
+    """
+
+    def __init__(self, section, var, message):
+        self.section = section
+        self.var = var
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def _type_name(type):
+    types = type if isinstance(type, tuple) else (type,)
+    names = {str: "a string", int: "an integer", float: "a number", list: "a list", dict: "a dict"}
+
+    return " or ".join(names.get(t, t.__name__) for t in types)
+
+
+def _compile_var(section, name, spec):
+    type = spec["type"]
+    items = spec["items"]
+    check = spec["check"]
+    required = spec["required"]
+    type_name = _type_name(type)
+    items_name = _type_name(items) if items else None
+
+    def validate(values, errors):
+        if name not in values or values[name] is None:
+            if required:
+                errors.append(ConfigError(section, name, "Variable '{}' not defined in '{}' section in config file.".format(name, section)))
+            return
+
+        value = values[name]
+        # bool is an int, but never a valid value here.
+        if not isinstance(value, type) or isinstance(value, bool):
+            errors.append(ConfigError(section, name, "Variable '{}' in '{}' section must be {}.".format(name, section, type_name)))
+            return
+
+        if items is not None:
+            bad = [str(v) for v in value if not isinstance(v, items)]
+            if len(bad) > 0:
+                errors.append(
+                    ConfigError(
+                        section, name, "Each of '{}' in '{}' section must be {}: {}".format(name, section, items_name, ", ".join(bad))
+                    )
+                )
+                return
+
+        if check is not None:
+            try:
+                check(value)
+            except Exception as e:
+                errors.append(ConfigError(section, name, "Variable '{}' in '{}' section is invalid: {}".format(name, section, e)))
+
+    return validate
+
+
+class ConfigValidator(object):
+    """
+    A validator compiled from a schema for one type of run; it reports every problem in a single pass.
+
+    Parameters:
+        schema (dict): The schema (see CONFIG_SCHEMA).
+        type (string): Either "test" or "production" to indicate the type of execution being run.
+    """
+
+    def __init__(self, schema, type):
+        self.type = type
+        self.__sections = []
+        for section, spec in schema.items():
+            if type not in spec["types"]:
+                continue
+            validators = [_compile_var(section, name, vspec) for name, vspec in spec["vars"].items()]
+            self.__sections.append((section, validators, spec.get("checks", ())))
+
+    def validate(self, config):
+        """
+        Validate a parsed config.
+
+        Parameters:
+            config (dict): A dictionary representing the current config file.
+
+        Returns:
+            list: List of ConfigError objects (empty if the config is valid).
+        """
+
+        errors = []
+        if not isinstance(config, dict):
+            return [ConfigError(None, None, "The config file must contain a YAML mapping.")]
+
+        checks = []
+        for section, validators, section_checks in self.__sections:
+            values = config.get(section)
+            if values is None:
+                errors.append(ConfigError(section, None, "Section '{}' not found in config file.".format(section)))
+                continue
+            if not isinstance(values, dict):
+                errors.append(ConfigError(section, None, "Section '{}' in config file must be a mapping.".format(section)))
+                continue
+
+            for validate in validators:
+                validate(values, errors)
+            checks += [(section, check) for check in section_checks]
+
+        # The section checks look across sections, so they only run on an otherwise valid config.
+        if len(errors) == 0:
+            for section, check in checks:
+                try:
+                    check(config, self.type)
+                except Exception as e:
+                    errors.append(ConfigError(section, None, "Section '{}' in config file is invalid: {}".format(section, e)))
+
+        return errors
+
+
+_validators = {}
+_validators_lock = threading.Lock()
+
+
+def get_validator(type):
+    """
+    Return the validator for a type of run, compiling it from CONFIG_SCHEMA on first use.
+    """
+
+    with _validators_lock:
+        if type not in _validators:
+            _validators[type] = ConfigValidator(CONFIG_SCHEMA, type)
+
+        return _validators[type]
+
+
+def validate_config(type, config):
+    """
+    Validate a parsed config for a type of run.
+
+    Parameters:
+        type (string): Either "test" or "production" to indicate the type of execution being run.
+        config (dict): A dictionary representing the current config file.
+
+    Returns:
+        list: List of ConfigError objects (empty if the config is valid).
+    """
+
+    return get_validator(type).validate(config)
+
+
+class ConfigCache(object):
+    """
+    In-memory cache of parsed config files, so a long-running process (e.g., the daemon) does not parse a config
+    that has not changed again.  Configs hold device and CML credentials, so they are never written to disk.
+
+    An entry is reused while the file's modification time and size are unchanged; otherwise the file's SHA-256
+    is compared with the one the entry was made from, so a file that was only touched is not parsed again either.
+    """
+
+    def __init__(self):
+        self.__entries = {}
+        self.__lock = threading.Lock()
+
+    def load(self, path, parse):
+        """
+        Return the parsed contents of a file.
+
+        Parameters:
+            path (string): Path to the file.
+            parse (function): Function that parses the file's contents (a string).
+
+        Returns:
+            A copy of the parsed contents (callers are free to modify it).
+        """
+
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.__lock:
+            entry = self.__entries.get(path)
+        if entry is None or entry["mtime_ns"] != st.st_mtime_ns or entry["size"] != st.st_size:
+            with open(path, "rb") as fd:
+                raw = fd.read()
+            digest = hashlib.sha256(raw).hexdigest()
+
+            if entry is None or entry["sha256"] != digest:
+                entry = {"data": parse(raw.decode("utf-8"))}
+            entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha256": digest, "data": entry["data"]}
+            with self.__lock:
+                self.__entries[path] = entry
+
+        return copy.deepcopy(entry["data"])
+
+
+config_cache = ConfigCache()
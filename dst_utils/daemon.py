@@ -0,0 +1,514 @@
+"""
+A long-running service that batches DST domain changes into combined test and deploy cycles.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import itertools
+import hmac
+import subprocess
+import socketserver
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .domains import validate_domain
+from .asa_config import dst_sets
+from .utils import load_config, _yaml, DST_BASE_DIR
+from .config import validate_config
+from .broker import DST_RUNTIME_DIR, make_private_dir
+from .metrics import PipelineMetrics, OPENMETRICS_CONTENT_TYPE, PROMETHEUS_CONTENT_TYPE
+
+DEFAULT_DAEMON_SOCKET = os.path.join(DST_RUNTIME_DIR, "daemon.sock")
+
+
+class DaemonMetrics(PipelineMetrics):
+    """
+    The pipeline metrics of every cycle the daemon runs, plus the daemon's own.
+    """
+
+    def __init__(self):
+        super(DaemonMetrics, self).__init__()
+
+        self.changes = self.counter("dst_daemon_changes_total", "Submitted changes by final status.", ["status"])
+        self.batches = self.counter("dst_daemon_batches_total", "Test and deploy cycles by result.", ["result"])
+        self.batch_duration = self.histogram("dst_daemon_batch_duration_seconds", "Duration of each test and deploy cycle.")
+        self.batch_size = self.histogram(
+            "dst_daemon_batch_changes", "Changes combined into each cycle.", buckets=(1, 2, 5, 10, 20, 50, 100)
+        )
+        self.pending = self.gauge("dst_daemon_pending_changes", "Changes waiting for the next cycle.")
+
+
+class ChangeRequest(object):
+    """
+    A single submitted change to the DST domain list.
+    """
+
+    def __init__(self, change_id, add, remove, submitter=None, dst_set=None):
+        self.id = change_id
+        self.add = add
+        self.remove = remove
+        self.submitter = submitter
+        self.dst_set = dst_set
+        self.status = "queued"
+        self.batch = None
+        self.message = ""
+        self.submitted = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "add": self.add,
+            "remove": self.remove,
+            "submitter": self.submitter,
+            "set": self.dst_set,
+            "status": self.status,
+            "batch": self.batch,
+            "message": self.message,
+            "submitted": self.submitted,
+            "finished": self.finished,
+        }
+
+
+class ChangeBatcher(object):
+    """
+    Queue domain changes and periodically run one combined test (and optional deploy) cycle for all of them.
+
+    Parameters:
+        config_file (string): The DST config file used as the base for every cycle.
+        state_file (string): File in which the domain lists of the last successful cycle are kept between restarts
+                             (the deployed lists, or the tested ones if deploy is off).
+        window (float): Seconds to wait after the first queued change for more changes to arrive.
+        deploy (Boolean): Whether to deploy to production after a successful test.
+        extra_args (list): Extra arguments to pass to test_dst.py and deploy_dst.py (e.g., --broker).
+        metrics_file (string): Optional Prometheus textfile to rewrite after every cycle.
+    """
+
+    def __init__(self, config_file, state_file, window=300, deploy=False, extra_args=None, metrics_file=None):
+        self.config_file = config_file
+        self.state_file = state_file
+        self.window = window
+        self.deploy = deploy
+        self.extra_args = list(extra_args or [])
+        self.metrics_file = metrics_file
+        self.metrics = DaemonMetrics()
+
+        self.__changes = {}
+        self.__pending = []
+        self.__ids = itertools.count(1)
+        self.__batches = itertools.count(1)
+        self.__cond = threading.Condition()
+        self.__running = False
+        self.__current = None
+
+        self.__load()
+
+    def __load(self):
+        # Called again before every cycle, so edits to the config file apply to the next batch.  An unchanged
+        # file comes from the config cache without being parsed again.
+        config = load_config(self.config_file)
+
+        # Every cycle tests the config (and deploys it if asked to), so refuse one that either would reject.
+        errors = []
+        for type in ["test"] + (["production"] if self.deploy else []):
+            errors += [str(e) for e in validate_config(type, config) if str(e) not in errors]
+        if len(errors) > 0:
+            raise Exception("Invalid config file {}:\n{}".format(self.config_file, "\n".join(errors)))
+
+        # The domains of each custom-data set, by set name (the first set takes changes that do not name one).
+        domains = OrderedDict((dset["name"], list(dset["domains"])) for dset in dst_sets(config["dst"], []))
+        default_set = next(iter(domains))
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r") as fd:
+                state = json.load(fd)
+            # The lists of the last successful cycle win over the config.  Older state files only hold the domains
+            # of the single set.
+            for name, sdomains in state.get("sets", {default_set: state.get("domains")}).items():
+                if name in domains and sdomains is not None:
+                    domains[name] = sdomains
+
+        with self.__cond:
+            self.__config = config
+            self.domains = domains
+            self.default_set = default_set
+
+    def submit(self, add=None, remove=None, submitter=None, dst_set=None):
+        """
+        Queue a change.
+
+        Parameters:
+            add (list): Domains to add.
+            remove (list): Domains to remove.
+            submitter (string): Optional name of who submitted the change.
+            dst_set (string): The custom-data set to change (default: the first set in the config).
+
+        Returns:
+            ChangeRequest: The queued change.
+        """
+
+        add = list(add or [])
+        remove = list(remove or [])
+        if len(add) == 0 and len(remove) == 0:
+            raise ValueError("A change must add or remove at least one domain")
+
+        bad = [d for d in add + remove if validate_domain(d) is None]
+        if len(bad) > 0:
+            raise ValueError("Invalid DST domain(s): {}".format(", ".join(str(d) for d in bad)))
+
+        # Compare domains the way they are deployed, so 'Example.com.' removes 'example.com'.
+        add = [validate_domain(d) for d in add]
+        remove = [validate_domain(d) for d in remove]
+
+        dst_set = dst_set or self.default_set
+        if dst_set not in self.domains:
+            raise ValueError("Unknown DST set '{}' (known sets: {})".format(dst_set, ", ".join(self.domains)))
+
+        with self.__cond:
+            change = ChangeRequest(next(self.__ids), add, remove, submitter, dst_set)
+            self.__changes[change.id] = change
+            self.__pending.append(change)
+            self.__cond.notify_all()
+
+        return change
+
+    def get(self, change_id):
+        with self.__cond:
+            change = self.__changes.get(change_id)
+            return change.to_dict() if change else None
+
+    def list(self):
+        with self.__cond:
+            return [c.to_dict() for c in self.__changes.values()]
+
+    def status(self):
+        with self.__cond:
+            return {
+                "pending": len(self.__pending),
+                "current_batch": self.__current,
+                "window": self.window,
+                "deploy": self.deploy,
+                "domains": sum(len(domains) for domains in self.domains.values()),
+                "sets": {name: len(domains) for name, domains in self.domains.items()},
+            }
+
+    def render_metrics(self, openmetrics=False):
+        with self.__cond:
+            self.metrics.pending.set(len(self.__pending))
+
+        return self.metrics.render(openmetrics)
+
+    def __set(self, changes, status, message=""):
+        with self.__cond:
+            for change in changes:
+                change.status = status
+                change.message = message
+                if status in ("deployed", "tested", "failed"):
+                    change.finished = time.time()
+                    self.metrics.changes.inc(status=status)
+
+    def __take_batch(self):
+        with self.__cond:
+            while self.__running and len(self.__pending) == 0:
+                self.__cond.wait()
+            if not self.__running:
+                return []
+
+            # Give related changes a chance to arrive before the cycle starts.
+            deadline = self.__pending[0].submitted + self.window
+            while self.__running and time.time() < deadline:
+                self.__cond.wait(deadline - time.time())
+
+            batch = self.__pending
+            self.__pending = []
+            self.__current = next(self.__batches)
+            for change in batch:
+                change.batch = self.__current
+                change.status = "batched"
+
+        return batch
+
+    def __run(self, script, config_file, extra):
+        command = [sys.executable, os.path.join(DST_BASE_DIR, script), "-c", config_file] + extra + self.extra_args
+        # Each run dumps its metrics so they can be added to the daemon's.
+        fd, dump = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=dict(os.environ, DST_METRICS_DUMP=dump))
+            out = p.communicate()[0].decode("utf-8", errors="replace")
+            if os.path.getsize(dump) > 0:
+                with open(dump, "r") as f:
+                    self.metrics.merge(json.load(f))
+        finally:
+            os.remove(dump)
+
+        return p.returncode, out
+
+    def __save_state(self, domains):
+        self.domains = domains
+        with open(self.state_file, "w") as fd:
+            json.dump({"sets": domains}, fd)
+
+    def run_batch(self, batch):
+        """
+        Apply a batch of changes (in submission order) and run one test and deploy cycle for all of them.  The
+        config file is read again first, so the cycle uses its current contents.
+        """
+
+        self.metrics.batch_size.observe(len(batch))
+        start = time.time()
+        result = "failed"
+        cfd = None
+
+        try:
+            try:
+                self.__load()
+            except Exception as e:
+                self.__set(batch, "failed", str(e))
+                return False
+
+            # A set removed from the config since a change was queued can no longer take it.
+            gone = [change for change in batch if change.dst_set not in self.domains]
+            if len(gone) > 0:
+                self.__set(gone, "failed", "DST set is no longer in the config file")
+                batch = [change for change in batch if change not in gone]
+                if len(batch) == 0:
+                    return False
+
+            domains = OrderedDict((name, list(sdomains)) for name, sdomains in self.domains.items())
+            for change in batch:
+                sdomains = [d for d in domains[change.dst_set] if validate_domain(d) not in change.remove]
+                known = set(validate_domain(d) for d in sdomains)
+                for d in change.add:
+                    if d not in known:
+                        sdomains.append(d)
+                        known.add(d)
+                domains[change.dst_set] = sdomains
+
+            conf = dict(self.__config)
+            conf["dst"] = dict(conf["dst"])
+            if conf["dst"].get("custom_name") is not None:
+                conf["dst"]["domains"] = domains[conf["dst"]["custom_name"]]
+            if conf["dst"].get("sets"):
+                conf["dst"]["sets"] = [dict(dset, domains=domains[dset["name"]]) for dset in conf["dst"]["sets"]]
+            yaml, _, Dumper = _yaml()
+            cfd = tempfile.NamedTemporaryFile(mode="w", suffix=".yaml", delete=False)
+            yaml.dump(conf, cfd, Dumper=Dumper)
+            cfd.close()
+
+            self.__set(batch, "testing")
+            rc, out = self.__run("test_dst.py", cfd.name, ["--yes"])
+            if rc != 0:
+                self.__set(batch, "failed", "Test failed:\n" + out[-2000:])
+                return False
+
+            if not self.deploy:
+                # Later batches build on the tested lists, so keep them as if they were deployed.
+                self.__save_state(domains)
+                self.__set(batch, "tested")
+                result = "tested"
+                return True
+
+            self.__set(batch, "deploying")
+            rc, out = self.__run("deploy_dst.py", cfd.name, [])
+            if rc != 0:
+                self.__set(batch, "failed", "Deployment failed:\n" + out[-2000:])
+                return False
+
+            self.__save_state(domains)
+            self.__set(batch, "deployed")
+            result = "deployed"
+            return True
+        finally:
+            if cfd is not None:
+                os.remove(cfd.name)
+            with self.__cond:
+                self.__current = None
+            self.metrics.batches.inc(result=result)
+            self.metrics.batch_duration.observe(time.time() - start)
+            if self.metrics_file:
+                try:
+                    self.metrics.write_textfile(self.metrics_file)
+                except Exception as e:
+                    sys.stderr.write("WARNING: Failed to write the metrics to {}: {}\n".format(self.metrics_file, e))
+
+    def serve_forever(self):
+        """
+        Process batches until stop() is called.
+        """
+
+        with self.__cond:
+            self.__running = True
+
+        while True:
+            batch = self.__take_batch()
+            if len(batch) == 0:
+                break
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                self.__set(batch, "failed", str(e))
+
+    def stop(self):
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify_all()
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """
+    The HTTP API:
+
+        POST /changes        {"add": [...], "remove": [...], "submitter": "...", "set": "..."}  -> the queued change
+        GET  /changes        -> all changes
+        GET  /changes/<id>   -> a single change
+        GET  /status         -> the daemon status
+        GET  /metrics        -> the metrics (OpenMetrics if the Accept header asks for it, else the Prometheus text format)
+    """
+
+    batcher = None
+    # When set, every request must carry it as "Authorization: Bearer <token>".
+    token = None
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        pass
+
+    def __reply(self, code, body):
+        data = (json.dumps(body) + "\n").encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __reply_metrics(self):
+        openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+        data = self.batcher.render_metrics(openmetrics).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __authorized(self):
+        if self.token is None:
+            return True
+
+        if hmac.compare_digest(self.headers.get("Authorization", "").encode("utf-8"), "Bearer {}".format(self.token).encode("utf-8")):
+            return True
+
+        self.__reply(401, {"error": "Unauthorized"})
+        return False
+
+    def do_GET(self):
+        if not self.__authorized():
+            return
+        if self.path == "/metrics":
+            return self.__reply_metrics()
+        if self.path == "/status":
+            return self.__reply(200, self.batcher.status())
+        if self.path == "/changes":
+            return self.__reply(200, self.batcher.list())
+        if self.path.startswith("/changes/"):
+            try:
+                change = self.batcher.get(int(self.path[len("/changes/") :]))
+            except ValueError:
+                change = None
+            if change is None:
+                return self.__reply(404, {"error": "No such change"})
+            return self.__reply(200, change)
+
+        self.__reply(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if not self.__authorized():
+            return
+        if self.path != "/changes":
+            return self.__reply(404, {"error": "Not found"})
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            req = json.loads(self.rfile.read(length).decode("utf-8"))
+            change = self.batcher.submit(
+                add=req.get("add"), remove=req.get("remove"), submitter=req.get("submitter"), dst_set=req.get("set")
+            )
+        except (ValueError, AttributeError) as e:
+            return self.__reply(400, {"error": str(e)})
+
+        self.__reply(202, change.to_dict())
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Anyone who can connect can change production, so only the owner may.
+        omask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(omask)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def make_server(batcher, listen=None, socket_path=DEFAULT_DAEMON_SOCKET, token=None):
+    """
+    Create the HTTP API server, either on a Unix socket only the current user can use, or on a TCP address.
+
+    Parameters:
+        batcher (ChangeBatcher): The batcher that receives the changes.
+        listen (tuple): Optional (host, port) on which to listen instead of the Unix socket.
+        socket_path (string): The Unix socket path on which to listen (default: daemon.sock in the DST runtime directory)
+        token (string): The token that clients must send; required on TCP, where anyone on the host can connect.
+
+    Returns:
+        The server object (call serve_forever() on it).
+    """
+
+    handler = type("Handler", (DaemonRequestHandler,), {"batcher": batcher, "token": token})
+    if listen:
+        if not token:
+            raise Exception("A token is required to serve the API on a TCP address")
+        return ThreadingHTTPServer(listen, handler)
+
+    if os.path.dirname(socket_path) == DST_RUNTIME_DIR:
+        make_private_dir(DST_RUNTIME_DIR)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    return UnixHTTPServer(socket_path, handler)
@@ -0,0 +1,246 @@
+"""
+Domain list normalization and packing for DST custom-data entries.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import re
+import zlib
+
+# The ASA accepts at most this many characters in a single anyconnect-custom-data value.
+# Longer values must be split across multiple entries with the same type and name.
+DST_CUSTOM_DATA_MAX_LEN = 420
+
+# About one domain in this many is a preferred place to end a custom-data value.
+DST_CHUNK_ANCHOR_EVERY = 2
+# A run of domains between kept values that fills less than this share of a value is packed with a neighbor.
+DST_CHUNK_MIN_FILL = 0.5
+# Kept values are all packed again once they are on average less full than this.
+DST_CHUNK_REPACK_FILL = 0.75
+
+_LABEL_RE = re.compile(r"^[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?$")
+
+
+def _domain_sort_key(domain):
+    # Sort by reversed labels so that sibling domains (e.g., *.webex.com) end up next to each other.
+    return domain.split(".")[::-1]
+
+
+def _is_anchor(domain):
+    # Use a stable hash (not hash()) so chunk boundaries are the same across runs.
+    return zlib.crc32(domain.encode("utf-8")) % DST_CHUNK_ANCHOR_EVERY == 0
+
+
+def validate_domain(domain):
+    """
+    Normalize a single domain and check that it is a valid DNS name.
+
+    Parameters:
+        domain (string): The domain as written in the config file.
+
+    Returns:
+        string: The normalized (lowercase, no leading wildcard or trailing dot) domain, or None if invalid.
+    """
+
+    if not isinstance(domain, str):
+        return None
+
+    d = domain.strip().lower()
+    if d.startswith("*."):
+        d = d[2:]
+    if d.endswith("."):
+        d = d[:-1]
+
+    if len(d) == 0 or len(d) > 253:
+        return None
+
+    labels = d.split(".")
+    if len(labels) < 2:
+        return None
+
+    for label in labels:
+        if not _LABEL_RE.match(label):
+            return None
+
+    # A top-level domain is never all digits, which also rules out IPv4 addresses.
+    if labels[-1].isdigit():
+        return None
+
+    return d
+
+
+def normalize_domains(domains):
+    """
+    Validate, dedupe, and sort a list of DST domains.
+
+    Subdomains that are already covered by a parent domain in the list are dropped, since DST
+    matches a domain and all of its subdomains.
+
+    Parameters:
+        domains (list): List of domain strings from the config file.
+
+    Returns:
+        list: The normalized list of domains.
+    """
+
+    normalized = set()
+    bad = []
+    for domain in domains:
+        d = validate_domain(domain)
+        if d is None:
+            bad.append(str(domain))
+        else:
+            normalized.add(d)
+
+    if len(bad) > 0:
+        raise Exception("Invalid DST domain(s): {}".format(", ".join(bad)))
+
+    result = []
+    for d in normalized:
+        labels = d.split(".")
+        covered = False
+        for i in range(1, len(labels) - 1):
+            if ".".join(labels[i:]) in normalized:
+                covered = True
+                break
+
+        if not covered:
+            result.append(d)
+
+    return sorted(result, key=_domain_sort_key)
+
+
+def pack_domains(domains, max_len=DST_CUSTOM_DATA_MAX_LEN, existing=None):
+    """
+    Pack a list of domains into length-limited anyconnect-custom-data values.
+
+    Each value is a comma-separated list of domains ending in a comma.  Values are filled greedily, but
+    a value is cut after the last anchor domain (picked by hash) that still fits, so the cut points mostly
+    depend on the content and a new domain rarely moves the boundaries after it.
+
+    When the values already on the device are given, the ones that still hold a run of the wanted domains
+    are kept as they are, and only the domains between them are packed again.  Adding or removing a domain
+    then replaces one value with at most two new ones.  If the kept values have become too fragmented,
+    the whole list is packed again.
+
+    Parameters:
+        domains (list): List of domain strings from the config file.
+        max_len (int): The maximum length of a single custom-data value (default: 420)
+        existing (list): Optional list of the custom-data values currently on the device.
+
+    Returns:
+        list: List of custom-data value strings.
+    """
+
+    ordered = normalize_domains(domains)
+    full = _pack_run(ordered, max_len)
+    if not existing:
+        return full
+
+    position = {d: i for i, d in enumerate(ordered)}
+    # kept[i] is the end of the existing value that starts with domain i.
+    kept = {}
+    covered = set()
+    for value in existing:
+        names = value[:-1].split(",")
+        if not value.endswith(",") or len(value) > max_len or names[0] not in position:
+            continue
+        start = position[names[0]]
+        end = start + len(names)
+        if ordered[start:end] == names and covered.isdisjoint(range(start, end)):
+            kept[start] = end
+            covered.update(range(start, end))
+
+    # Split the list into the kept values and the runs of domains between them.
+    pieces = []
+    i = 0
+    while i < len(ordered):
+        end = kept.get(i, i)
+        while end < len(ordered) and end not in kept and i not in kept:
+            end += 1
+        pieces.append((i, end, i in kept))
+        i = end
+
+    # A short run (e.g., a single added domain) is packed with a neighboring value instead of on its own.
+    n = 0
+    while n < len(pieces):
+        start, end, keep = pieces[n]
+        if not keep and _run_len(ordered[start:end]) < max_len * DST_CHUNK_MIN_FILL:
+            # Prefer the neighbor that still has room, so one value is replaced by one.
+            before = pieces[n - 1][0] if n > 0 and pieces[n - 1][2] else None
+            after = pieces[n + 1][1] if n + 1 < len(pieces) and pieces[n + 1][2] else None
+            if before is not None and (after is None or _run_len(ordered[before:end]) <= max_len):
+                pieces[n - 1 : n + 1] = [(before, end, False)]
+                continue
+            if after is not None:
+                pieces[n : n + 2] = [(start, after, False)]
+                continue
+        n += 1
+
+    chunks = []
+    for start, end, keep in pieces:
+        if keep:
+            chunks.append(",".join(ordered[start:end]) + ",")
+        else:
+            chunks += _pack_run(ordered[start:end], max_len)
+
+    # Only pack everything again once the values are on average less than this full.
+    if _run_len(ordered) < len(chunks) * max_len * DST_CHUNK_REPACK_FILL:
+        return full
+
+    return chunks
+
+
+def _run_len(run):
+    # Each domain is followed by a comma in the value.
+    return sum(len(d) + 1 for d in run)
+
+
+def _pack_run(ordered, max_len):
+    chunks = []
+    start = 0
+    while start < len(ordered):
+        end = start
+        length = 0
+        cut = None
+        while end < len(ordered) and length + len(ordered[end]) + 1 <= max_len:
+            length += len(ordered[end]) + 1
+            end += 1
+            if _is_anchor(ordered[end - 1]):
+                cut = end
+
+        # The last value takes whatever is left, and a value without an anchor is simply cut where it is full.
+        if end == len(ordered) or cut is None:
+            cut = max(end, start + 1)
+
+        chunks.append(",".join(ordered[start:cut]) + ",")
+        start = cut
+
+    return chunks
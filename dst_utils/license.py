@@ -0,0 +1,159 @@
+"""
+Track the Smart License registration of a kept test firewall so later test runs can reuse it.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import json
+import os
+import time
+import fcntl
+from .utils import DST_BASE_DIR
+
+DEFAULT_LEASE_FILE = os.path.join(DST_BASE_DIR, ".dst-license-lease.json")
+
+# Lock file descriptors held by this process, keyed by lease file path.
+_LOCKS = {}
+
+
+class LicenseLease(object):
+    """
+    A lease on a registered test firewall and the lab it runs in, kept in a JSON state file.
+
+    Parameters:
+        path (string): The lease state file.
+        hours (float): How long a registration may be reused after it was made (0 to never reuse it).
+    """
+
+    def __init__(self, path=DEFAULT_LEASE_FILE, hours=0):
+        self.path = path
+        self.hours = float(hours)
+
+    @property
+    def enabled(self):
+        return self.hours > 0
+
+    def lock(self):
+        """
+        Lock the lease for the rest of this process, so two runs never use the same leased lab at once.
+        """
+
+        path = os.path.abspath(self.path)
+        if path in _LOCKS:
+            return
+
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            raise Exception("Another test run is using the Smart License lease in {}".format(self.path))
+
+        _LOCKS[path] = fd
+
+    def unlock(self):
+        """
+        Release the lock taken by lock().
+        """
+
+        fd = _LOCKS.pop(os.path.abspath(self.path), None)
+        if fd is not None:
+            os.close(fd)
+
+    def load(self):
+        """
+        Load the current lease.
+
+        Returns:
+            dict: The lease (cml_host, lab_id, fw_ip, registered_at, expires_at), or None if there is none.
+        """
+
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            with open(self.path, "r") as fd:
+                return json.load(fd)
+        except ValueError:
+            # A truncated lease file is treated as no lease.
+            return None
+
+    def is_valid(self, lease, cml_host):
+        """
+        Check whether a lease can be reused.
+
+        Parameters:
+            lease (dict): The lease from load().
+            cml_host (string): The CML controller of this run.
+
+        Returns:
+            Boolean: True if leases are enabled, the lease is for this controller, and it has not expired.
+        """
+
+        return self.enabled and lease is not None and lease["cml_host"] == cml_host and time.time() < lease["expires_at"]
+
+    def record(self, cml_host, lab_id, fw_ip, hours=None):
+        """
+        Record a newly registered test firewall.
+
+        Parameters:
+            cml_host (string): The CML controller running the lab.
+            lab_id (string): The ID of the lab.
+            fw_ip (string): The management IP of the registered firewall.
+            hours (float): Optional lifetime of the lease (default: the configured lease hours).  A lease of 0 hours
+                           is never reused; it only lets the next run (or --release-lease) deregister the firewall.
+
+        Returns:
+            dict: The new lease.
+        """
+
+        now = time.time()
+        lease = {
+            "cml_host": cml_host,
+            "lab_id": lab_id,
+            "fw_ip": fw_ip,
+            "registered_at": now,
+            "expires_at": now + (self.hours if hours is None else hours) * 3600,
+        }
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fd:
+            json.dump(lease, fd, indent=2)
+        os.rename(tmp, self.path)
+
+        return lease
+
+    def release(self):
+        """
+        Forget the lease (once the firewall has been deregistered or its lab is gone).
+        """
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
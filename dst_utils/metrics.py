@@ -0,0 +1,426 @@
+"""
+Counters and histograms for the DST pipelines, exported as a Prometheus textfile or an OpenMetrics endpoint.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+import json
+import time
+import fcntl
+import atexit
+import tempfile
+import threading
+
+# Buckets (in seconds) shared by every duration histogram; they span quick probes to a full lab boot.
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+    """
+    The base of every metric: a family of samples, one per combination of label values.
+
+    Parameters:
+        name (string): The metric name (counters end in _total).
+        help (string): The description of the metric.
+        labelnames (list): The names of the labels each sample carries.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise Exception("Metric {} needs the labels {}, not {}".format(self.name, ", ".join(self.labelnames), ", ".join(labels)))
+        return tuple((k, str(labels[k])) for k in self.labelnames)
+
+    def family(self, openmetrics=False):
+        return self.name
+
+    def render(self, openmetrics=False):
+        family = self.family(openmetrics)
+        lines = ["# HELP {} {}".format(family, self.help), "# TYPE {} {}".format(family, self.type)]
+        with self._lock:
+            for key in sorted(self._samples):
+                lines += self._render_sample(key, self._samples[key], openmetrics)
+
+        return lines
+
+    def dump(self):
+        with self._lock:
+            return [[list(map(list, key)), value] for key, value in self._samples.items()]
+
+    def reset(self):
+        with self._lock:
+            self._samples = {}
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._samples.get(self._key(labels), 0)
+
+    def family(self, openmetrics=False):
+        # OpenMetrics names the counter family without the _total suffix of its samples.
+        return self.name[: -len("_total")] if openmetrics and self.name.endswith("_total") else self.name
+
+    def _render_sample(self, key, value, openmetrics=False):
+        return ["{}{} {}".format(self.name, _format_labels(key), _format_value(value))]
+
+    def merge(self, key, value):
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = value
+
+    def _render_sample(self, key, value, openmetrics=False):
+        return ["{}{} {}".format(self.name, _format_labels(key), _format_value(value))]
+
+    def merge(self, key, value):
+        # The merged value is the newer one.
+        with self._lock:
+            self._samples[key] = value
+
+
+class Histogram(Metric):
+    """
+    A histogram of observed values (usually durations in seconds).
+
+    Parameters:
+        name (string): The metric name.
+        help (string): The description of the metric.
+        labelnames (list): The names of the labels each sample carries.
+        buckets (list): The upper bounds of the buckets (default: DEFAULT_BUCKETS).
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            sample = self._samples.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample["buckets"][i] += 1
+                    break
+            sample["sum"] += value
+            sample["count"] += 1
+
+    def time(self, **labels):
+        """
+        Observe how long a with block takes.
+        """
+
+        return _Timer(self, labels)
+
+    def get(self, **labels):
+        with self._lock:
+            sample = self._samples.get(self._key(labels))
+            return dict(sample, buckets=list(sample["buckets"])) if sample else None
+
+    def _render_sample(self, key, sample, openmetrics=False):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, sample["buckets"]):
+            cumulative += count
+            # OpenMetrics wants the canonical float form of a bound (e.g., "1.0", not "1").
+            le = repr(float(bound)) if openmetrics and bound != float("inf") else _format_value(bound)
+            lines.append("{}_bucket{} {}".format(self.name, _format_labels(key + (("le", le),)), cumulative))
+        lines.append("{}_sum{} {}".format(self.name, _format_labels(key), _format_value(sample["sum"])))
+        lines.append("{}_count{} {}".format(self.name, _format_labels(key), sample["count"]))
+
+        return lines
+
+    def merge(self, key, value):
+        if len(value["buckets"]) != len(self.buckets):
+            raise Exception("Cannot merge histogram {} with different buckets".format(self.name))
+        with self._lock:
+            sample = self._samples.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            sample["buckets"] = [a + b for a, b in zip(sample["buckets"], value["buckets"])]
+            sample["sum"] += value["sum"]
+            sample["count"] += value["count"]
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exception, value, tb):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class MetricsRegistry(object):
+    """
+    A set of metrics that is rendered together.
+    """
+
+    def __init__(self):
+        self.__metrics = {}
+
+    def __add(self, metric):
+        if metric.name in self.__metrics:
+            raise Exception("Metric {} is already registered".format(metric.name))
+        self.__metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        if not name.endswith("_total"):
+            raise Exception("Counter {} must end in _total".format(name))
+        return self.__add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.__add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.__add(Histogram(name, help, labelnames, buckets))
+
+    def render(self, openmetrics=False):
+        """
+        Render every metric in the Prometheus text format, or in the OpenMetrics format.
+
+        Parameters:
+            openmetrics (Boolean): Whether to use the OpenMetrics format.
+
+        Returns:
+            string: The exposition text.
+        """
+
+        lines = []
+        for name in sorted(self.__metrics):
+            lines += self.__metrics[name].render(openmetrics)
+        if openmetrics:
+            lines.append("# EOF")
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """
+        Atomically write the metrics to a file for the Prometheus node_exporter textfile collector.
+
+        Parameters:
+            path (string): The file to write (it should end in .prom).
+        """
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".dst-metrics-")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.render())
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+
+    def dump(self):
+        """
+        Returns:
+            dict: Mapping of metric name to its samples, for merge().
+        """
+
+        return {name: metric.dump() for name, metric in self.__metrics.items()}
+
+    def merge(self, data):
+        """
+        Add the samples dumped by another process (e.g., a test run started by dst_daemon.py) to these metrics.
+
+        Parameters:
+            data (dict): The output of dump().
+        """
+
+        for name, samples in data.items():
+            metric = self.__metrics.get(name)
+            if metric is None:
+                continue
+            for key, value in samples:
+                metric.merge(tuple(tuple(kv) for kv in key), value)
+
+    def reset(self):
+        for metric in self.__metrics.values():
+            metric.reset()
+
+
+class PipelineMetrics(MetricsRegistry):
+    """
+    The metrics of the test and deploy pipelines.
+    """
+
+    def __init__(self):
+        super(PipelineMetrics, self).__init__()
+
+        self.runs = self.counter("dst_runs_total", "Pipeline runs by command and result.", ["command", "result"])
+        self.run_duration = self.histogram("dst_run_duration_seconds", "Duration of each pipeline run.", ["command"])
+        self.failures = self.counter("dst_failures_total", "Pipeline failures by command and failed stage.", ["command", "stage"])
+        self.lab_boot = self.histogram("dst_lab_boot_seconds", "Time from creating the test lab until all of its nodes are ready.")
+        self.wait_duration = self.histogram("dst_wait_duration_seconds", "Duration of each retried wait.", ["wait", "result"])
+        self.wait_attempts = self.counter("dst_wait_attempts_total", "Attempts made by retried waits.", ["wait"])
+        self.wait_retries = self.counter("dst_wait_retries_total", "Attempts after the first made by retried waits.", ["wait"])
+        self.wait_timeouts = self.counter("dst_wait_timeouts_total", "Retried waits that gave up.", ["wait"])
+        self.probe_duration = self.histogram("dst_probe_duration_seconds", "Latency of each traceroute or ping probe.", ["kind"])
+        self.route_checks = self.counter("dst_route_checks_total", "Tested host routes by expected path and result.", ["expect", "result"])
+        self.firewall_deploy = self.histogram("dst_firewall_deploy_seconds", "Time to push the DST config to one firewall.", ["method"])
+        self.firewall_deploys = self.counter("dst_firewall_deploys_total", "Firewalls pushed to, by result.", ["result"])
+        self.broker_command = self.histogram("dst_broker_command_seconds", "Connection broker commands by operation.", ["op", "result"])
+        self.ansible_runs = self.counter("dst_ansible_runs_total", "Ansible playbook runs by result.", ["playbook", "result"])
+        self.ansible_run_duration = self.histogram(
+            "dst_ansible_run_duration_seconds", "Duration of each Ansible playbook run.", ["playbook"]
+        )
+        self.ansible_task_duration = self.histogram(
+            "dst_ansible_task_duration_seconds", "Duration of each Ansible task (from the JSON callback).", ["playbook", "task"]
+        )
+        self.last_run = self.gauge("dst_last_run_timestamp_seconds", "When each command last finished.", ["command", "result"])
+
+        self.__command = None
+        self.__start = None
+        self.__result = None
+        self.__textfile = None
+        self.__registered = False
+
+    def begin(self, command, textfile=None):
+        """
+        Start timing a pipeline run.  The run is recorded when the process exits, as an error unless finish() was
+        called, and the metrics are then added to the textfile (and dumped to the file named by the
+        DST_METRICS_DUMP environment variable, for dst_daemon.py).
+
+        Parameters:
+            command (string): The command being run (e.g., "test" or "deploy").
+            textfile (string): Optional Prometheus textfile to write.
+        """
+
+        self.__command = command
+        self.__start = time.time()
+        self.__result = None
+        self.__textfile = textfile
+        if not self.__registered:
+            atexit.register(self.__write)
+            self.__registered = True
+
+    def __write(self):
+        if self.__command is not None and self.__result is None:
+            self.finish("error")
+
+        try:
+            if self.__textfile:
+                self.accumulate_textfile(self.__textfile)
+            if os.environ.get("DST_METRICS_DUMP"):
+                with open(os.environ["DST_METRICS_DUMP"], "w") as fd:
+                    json.dump(self.dump(), fd)
+        except Exception as e:
+            print("WARNING: Failed to write the metrics: {}".format(e))
+
+    def accumulate_textfile(self, path):
+        """
+        Add these metrics to the totals of earlier runs and write them to a Prometheus textfile.  The totals are kept
+        in a JSON file next to the textfile, so counters keep growing from one run to the next.
+
+        Parameters:
+            path (string): The textfile to write.
+        """
+
+        state = path + ".json"
+        with open(state + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            totals = PipelineMetrics()
+            if os.path.exists(state):
+                with open(state, "r") as fd:
+                    totals.merge(json.load(fd))
+            totals.merge(self.dump())
+
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(state)), prefix=".dst-metrics-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(totals.dump(), f)
+            os.rename(tmp, state)
+            totals.write_textfile(path)
+
+    def finish(self, result):
+        """
+        Record the result of the run started with begin().
+
+        Parameters:
+            result (string): The result (e.g., "passed", "failed", "deployed", or "error").
+        """
+
+        if self.__command is None or self.__result is not None:
+            return
+
+        self.__result = result
+        self.runs.inc(command=self.__command, result=result)
+        self.run_duration.observe(time.time() - self.__start, command=self.__command)
+        self.last_run.set(time.time(), command=self.__command, result=result)
+
+
+metrics = PipelineMetrics()
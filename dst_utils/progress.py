@@ -0,0 +1,283 @@
+"""
+Draw the progress of many concurrent tasks from a single renderer thread.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import itertools
+
+PROGRESS_MODES = ("auto", "tty", "plain", "json")
+
+
+class ProgressTask(object):
+    """
+    A unit of work shown by the renderer.  Tasks with a total also show how many of their items (e.g., hosts) are
+    done, the rate at which they finish and the estimated time left.
+
+    Parameters:
+        renderer (ProgressRenderer): The renderer drawing this task.
+        message (string): The message describing the task.
+        total (int): Optional number of items the task will work on.
+    """
+
+    def __init__(self, renderer, message, total=None):
+        self.renderer = renderer
+        self.message = message
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.last = None
+        self.started = time.time()
+        self.finished = None
+        self.hosts = {}
+
+    def set_total(self, total):
+        self.total = total
+
+    def update(self, item, status="ok", failed=False):
+        """
+        Record that an item of this task finished.
+
+        Parameters:
+            item (string): The item (e.g., the host address) that finished.
+            status (string): A short status for the item.
+            failed (Boolean): Whether the item failed.
+        """
+
+        with self.renderer.lock:
+            self.done += 1
+            if failed:
+                self.failed += 1
+            self.hosts[item] = status
+            self.last = (item, status)
+            self.renderer.changed = True
+
+    def rate(self):
+        elapsed = (self.finished or time.time()) - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        rate = self.rate()
+        if self.total is None or rate == 0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def status(self):
+        """
+        Format the counts, rate and ETA (empty if the task has no items).
+        """
+
+        if self.total is None and self.done == 0:
+            return ""
+
+        text = "{}/{}".format(self.done, self.total if self.total is not None else "?")
+        if self.failed > 0:
+            text += " ({} failed)".format(self.failed)
+        text += " {:.1f}/s".format(self.rate())
+        eta = self.eta()
+        if eta is not None and self.finished is None:
+            text += " ETA {}s".format(int(eta + 0.5))
+        if self.last is not None:
+            text += " [{}: {}]".format(*self.last)
+
+        return text
+
+    def to_dict(self):
+        return {
+            "task": self.message.strip(),
+            "done": self.done,
+            "failed": self.failed,
+            "total": self.total,
+            "rate": round(self.rate(), 3),
+            "eta": self.eta(),
+            "elapsed": round((self.finished or time.time()) - self.started, 3),
+        }
+
+
+class ProgressRenderer(object):
+    """
+    Draw the progress of all active tasks from one thread.  The thread only runs while there are active tasks and
+    only draws the innermost task on each tick, so the output cost stays the same no matter how many tasks are running.
+
+    Modes:
+        tty: A spinner, plus counts, rate and ETA, at the end of the current line.
+        plain: A status line for each task with items at most every line_interval seconds (the task's message itself
+               is left to the caller to print when the task is done).
+        json: JSON lines (start, progress and finish events) on stderr.
+
+    Parameters:
+        stream (file object): The stream to draw on (default: sys.stdout).
+        mode (string): One of PROGRESS_MODES (default: the DST_PROGRESS environment variable, or "auto").
+        interval (float): Seconds between redraws on a TTY (default: 0.1)
+        line_interval (float): Seconds between status lines in plain and json modes (default: 5)
+    """
+
+    def __init__(self, stream=None, mode=None, interval=0.1, line_interval=5.0):
+        self.stream = stream
+        self.mode = mode or os.environ.get("DST_PROGRESS", "auto")
+        if self.mode not in PROGRESS_MODES:
+            raise Exception("Invalid progress mode '{}'; must be one of {}".format(self.mode, ", ".join(PROGRESS_MODES)))
+        self.interval = interval
+        self.line_interval = line_interval
+        self.lock = threading.RLock()
+        self.changed = False
+        self.__tasks = []
+        self.__thread = None
+        self.__wake = threading.Condition(self.lock)
+        self.__spinner = itertools.cycle(["-", "/", "|", "\\"])
+        self.__drawn = ""
+        self.__owner = None
+        self.__last_line = 0.0
+
+    def __out(self):
+        return self.stream or sys.stdout
+
+    def active_mode(self):
+        if self.mode != "auto":
+            return self.mode
+        out = self.__out()
+        return "tty" if hasattr(out, "isatty") and out.isatty() else "plain"
+
+    def __erase(self):
+        # Backspace over the drawn suffix, as the original spinner did (taken from
+        # https://stackoverflow.com/questions/4995733/how-to-create-a-spinning-command-line-cursor, contributed there by
+        # Victor Moyseenko and Tagar).
+        if self.__drawn:
+            n = len(self.__drawn)
+            self.__out().write("\b" * n + " " * n + "\b" * n)
+            self.__drawn = ""
+
+    def write(self, text):
+        """
+        Write text to the stream, moving the drawn progress out of the way first.
+        """
+
+        with self.lock:
+            self.__erase()
+            self.__out().write(text)
+            self.__out().flush()
+
+    def __emit(self, event, task):
+        body = dict(task.to_dict(), event=event, time=round(time.time(), 3))
+        sys.stderr.write(json.dumps(body) + "\n")
+        sys.stderr.flush()
+
+    def start(self, message, total=None):
+        """
+        Start showing a task.
+
+        Parameters:
+            message (string): The message describing the task.
+            total (int): Optional number of items the task will work on.
+
+        Returns:
+            ProgressTask: The new task.
+        """
+
+        with self.lock:
+            task = ProgressTask(self, message, total)
+            self.__tasks.append(task)
+            self.__owner = task
+            if self.active_mode() == "json":
+                self.__emit("start", task)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="dst-progress", daemon=True)
+                self.__thread.start()
+            self.__wake.notify_all()
+
+        return task
+
+    def finish(self, task):
+        """
+        Stop showing a task.
+        """
+
+        with self.lock:
+            task.finished = time.time()
+            if task in self.__tasks:
+                self.__tasks.remove(task)
+            # Callers usually print a result line next, so an outer task is not redrawn until it starts a new one.
+            self.__owner = None
+            mode = self.active_mode()
+            if mode == "tty":
+                self.__erase()
+                self.__out().write("\r")
+            elif mode == "json":
+                self.__emit("finish", task)
+            self.__out().flush()
+            self.__wake.notify_all()
+
+    def __draw(self):
+        mode = self.active_mode()
+        task = self.__tasks[-1]
+        if mode == "tty":
+            if task is not self.__owner:
+                return
+            text = next(self.__spinner)
+            status = task.status()
+            if status:
+                text += " " + status
+            self.__erase()
+            self.__out().write(text)
+            self.__out().flush()
+            self.__drawn = text
+            return
+
+        now = time.time()
+        if not self.changed or now - self.__last_line < self.line_interval:
+            return
+        self.__last_line = now
+        self.changed = False
+        for task in self.__tasks:
+            if task.done == 0:
+                continue
+            if mode == "json":
+                self.__emit("progress", task)
+            else:
+                self.__out().write("\t{} {}\n".format(task.message.strip(), task.status()))
+                self.__out().flush()
+
+    def __run(self):
+        with self.lock:
+            while len(self.__tasks) > 0:
+                self.__draw()
+                self.__wake.wait(self.interval)
+                if len(self.__tasks) == 0:
+                    # Give a task started right after this one finished a chance to keep the thread.
+                    self.__wake.wait(self.interval)
+            self.__thread = None
+
+
+renderer = ProgressRenderer()
@@ -0,0 +1,227 @@
+"""
+A single retry and backoff policy for all of the DST wait loops.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import math
+import random
+import threading
+import time
+from .metrics import metrics
+
+# Default policies for each wait, overridden by the 'waits' dict in the 'test' section of the config file.
+DEFAULT_WAITS = {
+    # Polling CML until every node in the lab has converged.
+    "lab_ready": {"initial": 1.0, "factor": 1.5, "max_delay": 10.0, "jitter": 0.2, "deadline": 1800},
+    # Waiting for the firewall node to converge before reading its management IP.
+    "fw_ip": {"initial": 1.0, "factor": 1.5, "max_delay": 10.0, "jitter": 0.2, "deadline": 900},
+    # Pinging the firewall from this host until it answers.
+    "fw_reachable": {"initial": 0.5, "factor": 1.5, "max_delay": 5.0, "jitter": 0.1, "deadline": 300},
+    # Pinging the canary host from the firewall (asa_command retries, so the interval is fixed).
+    "fw_external_ping": {"initial": 1.0, "factor": 1.0, "jitter": 0.0, "max_attempts": 30},
+    # Waiting for Smart License registration on the firewall (asa_command retries, so the interval is fixed).
+    "license_registered": {"initial": 1.0, "factor": 1.0, "jitter": 0.0, "max_attempts": 60},
+    # Tracing a tunneled host until the AnyConnect client has connected (only with --yes, when no one confirms it).
+    "vpn_up": {"initial": 2.0, "factor": 1.5, "max_delay": 15.0, "jitter": 0.2, "deadline": 300},
+}
+
+
+class RetryTimeout(Exception):
+    """
+    Raised when a wait does not succeed before its deadline or within its maximum number of attempts.
+    """
+
+    pass
+
+
+class RetryStats(object):
+    """
+    Per-attempt records of every wait, keyed by wait name.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__waits = {}
+
+    def record(self, name, attempts, elapsed, success):
+        with self.__lock:
+            self.__waits.setdefault(name, []).append({"attempts": attempts, "elapsed": elapsed, "success": success})
+
+        metrics.wait_duration.observe(elapsed, wait=name, result="ok" if success else "timeout")
+        metrics.wait_attempts.inc(len(attempts), wait=name)
+        metrics.wait_retries.inc(max(len(attempts) - 1, 0), wait=name)
+        if not success:
+            metrics.wait_timeouts.inc(wait=name)
+
+    def get(self, name):
+        with self.__lock:
+            return list(self.__waits.get(name, []))
+
+    def summary(self):
+        """
+        Summarize every recorded wait.
+
+        Returns:
+            dict: Mapping of wait name to a dict with the waits, total attempts, failures, and the per-attempt
+                  records of the most recent wait.
+        """
+
+        with self.__lock:
+            summary = {}
+            for name, waits in self.__waits.items():
+                summary[name] = {
+                    "waits": len(waits),
+                    "attempts": sum(len(w["attempts"]) for w in waits),
+                    "failures": len([w for w in waits if not w["success"]]),
+                    "elapsed": sum(w["elapsed"] for w in waits),
+                    "last": waits[-1],
+                }
+
+            return summary
+
+    def reset(self):
+        with self.__lock:
+            self.__waits = {}
+
+
+retry_stats = RetryStats()
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter, bounded by an optional deadline and/or maximum number of attempts.
+
+    Parameters:
+        name (string): Name under which the attempts are recorded.
+        initial (float): Seconds to wait after the first failed attempt.
+        factor (float): Multiplier applied to the delay after each failed attempt (1 for a fixed interval).
+        max_delay (float): Upper bound on a single delay.
+        jitter (float): Fraction of each delay that is randomized (0 for none) to avoid polling in lockstep.
+        deadline (float): Give up after this many seconds (None for no limit).
+        max_attempts (int): Give up after this many attempts (None for no limit).
+    """
+
+    def __init__(self, name, initial=1.0, factor=2.0, max_delay=30.0, jitter=0.1, deadline=None, max_attempts=None):
+        if initial < 0 or factor < 1 or jitter < 0 or jitter > 1:
+            raise Exception("Invalid retry policy for {}: initial must be >= 0, factor >= 1, and jitter between 0 and 1".format(name))
+
+        self.name = name
+        self.initial = float(initial)
+        self.factor = float(factor)
+        self.max_delay = float(max_delay)
+        self.jitter = float(jitter)
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+
+    @classmethod
+    def from_config(cls, config, name):
+        """
+        Build the policy for a named wait from the defaults and the 'waits' dict in the 'test' section of the config.
+
+        Parameters:
+            config (dict): Dictionary representing the current configuration file.
+            name (string): The name of the wait (a key of DEFAULT_WAITS).
+
+        Returns:
+            RetryPolicy: The policy.
+        """
+
+        params = dict(DEFAULT_WAITS.get(name, {}))
+        params.update(((config or {}).get("test") or {}).get("waits", {}).get(name) or {})
+
+        return cls(name, **params)
+
+    def delays(self):
+        """
+        Generate the (jittered) delays between attempts.
+        """
+
+        delay = self.initial
+        while True:
+            yield delay * (1 - self.jitter * random.random())
+            delay = min(delay * self.factor, self.max_delay)
+
+    def wait_until(self, func, sleep=time.sleep):
+        """
+        Call a function until it returns a true value.
+
+        Parameters:
+            func (function): The function to call; exceptions it raises are not retried.
+            sleep (function): Function used to sleep between attempts.
+
+        Returns:
+            The first true value returned by func.
+        """
+
+        start = time.time()
+        attempts = []
+        delays = self.delays()
+        while True:
+            t0 = time.time()
+            result = func()
+            attempts.append(round(time.time() - t0, 3))
+            if result:
+                retry_stats.record(self.name, attempts, time.time() - start, True)
+                return result
+
+            delay = next(delays)
+            if self.max_attempts is not None and len(attempts) >= self.max_attempts:
+                break
+            if self.deadline is not None:
+                remaining = self.deadline - (time.time() - start)
+                if remaining <= 0:
+                    break
+                delay = min(delay, remaining)
+
+            sleep(delay)
+
+        retry_stats.record(self.name, attempts, time.time() - start, False)
+        raise RetryTimeout(
+            "Gave up waiting for {} after {} attempts in {:.1f} seconds".format(self.name, len(attempts), time.time() - start)
+        )
+
+    def ansible_params(self):
+        """
+        Map the policy onto the fixed-interval retries of the Ansible asa_command module.
+
+        Returns:
+            dict: The 'retries' and 'interval' values.
+        """
+
+        interval = max(1, int(round(self.initial)))
+        if self.max_attempts is not None:
+            retries = self.max_attempts
+        elif self.deadline is not None:
+            retries = int(math.ceil(self.deadline / float(interval)))
+        else:
+            raise Exception("The {} wait runs in Ansible and needs a deadline or max_attempts".format(self.name))
+
+        return {"retries": retries, "interval": interval}
@@ -0,0 +1,180 @@
+"""
+Pre-change snapshots of the firewalls' DST config and the rollback plans derived from them.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import os
+import gzip
+import json
+import time
+from .asa_config import AsaConfig, invert_plan, DST_SNAPSHOT_COMMANDS
+from .broker import run_broker_command
+from .utils import run_ansible_command, get_ansible_task_results
+
+DEFAULT_SNAPSHOT_DIR = "snapshots"
+
+
+class SnapshotStore(object):
+    """
+    Compressed snapshots on disk, stored as <dir>/<host>/<timestamp>.json.gz.
+    """
+
+    def __init__(self, base_dir=DEFAULT_SNAPSHOT_DIR):
+        self.base_dir = base_dir
+
+    @staticmethod
+    def new_timestamp():
+        """
+        Return a timestamp suitable for naming a snapshot.  It has microsecond precision, so two deploys
+        started in the same second get different snapshots, and still sorts after older second-precision names.
+        """
+
+        now = time.time()
+        return "{}-{:06d}".format(time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), int(now % 1 * 1000000))
+
+    def __path(self, host, timestamp):
+        return os.path.join(self.base_dir, host, "{}.json.gz".format(timestamp))
+
+    def save(self, host, timestamp, config, plan):
+        """
+        Save the pre-change config of a host along with the plan about to be applied to it.
+
+        Parameters:
+            host (string): The firewall address.
+            timestamp (string): The snapshot timestamp.
+            config (string): The DST-related config text captured from the firewall.
+            plan (list): The command plan that will be applied.
+        """
+
+        os.makedirs(os.path.join(self.base_dir, host), exist_ok=True)
+        # Never overwrite an existing snapshot; that would lose the only copy of an older config.
+        with gzip.open(self.__path(host, timestamp), "xt") as fd:
+            json.dump({"host": host, "timestamp": timestamp, "config": config, "plan": plan}, fd)
+
+    def load(self, host, timestamp):
+        """
+        Load a snapshot.
+
+        Returns:
+            dict: The snapshot with 'host', 'timestamp', 'config', and 'plan' keys.
+        """
+
+        with gzip.open(self.__path(host, timestamp), "rt") as fd:
+            return json.load(fd)
+
+    def hosts(self, timestamp):
+        """
+        Return the list of hosts that have a snapshot with the given timestamp.
+        """
+
+        if not os.path.isdir(self.base_dir):
+            return []
+
+        return sorted(h for h in os.listdir(self.base_dir) if os.path.exists(self.__path(h, timestamp)))
+
+    def timestamps(self):
+        """
+        Return all snapshot timestamps, oldest first.
+        """
+
+        ts = set()
+        if os.path.isdir(self.base_dir):
+            for host in os.listdir(self.base_dir):
+                for f in os.listdir(os.path.join(self.base_dir, host)):
+                    if f.endswith(".json.gz"):
+                        ts.add(f[: -len(".json.gz")])
+
+        return sorted(ts)
+
+    def latest(self):
+        """
+        Return the most recent snapshot timestamp of a deploy that changed something, or None if there is none.
+        """
+
+        # A deploy that found nothing to change (e.g., a retry) has nothing to undo, so it is skipped.
+        for timestamp in reversed(self.timestamps()):
+            if any(len(self.load(host, timestamp)["plan"]) > 0 for host in self.hosts(timestamp)):
+                return timestamp
+
+        return None
+
+    def rollback_plans(self, timestamp):
+        """
+        Compute the plans that restore each host to its state at the given snapshot.
+
+        Returns:
+            dict: Mapping of host to its rollback plan (hosts with nothing to undo are left out).
+        """
+
+        plans = {}
+        for host in self.hosts(timestamp):
+            snap = self.load(host, timestamp)
+            plan = invert_plan(snap["plan"], AsaConfig(snap["config"]))
+            if len(plan) > 0:
+                plans[host] = plan
+
+        return plans
+
+
+def capture_dst_config(hosts, inv=None, avars=None, client=None, creds=None, max_workers=8, progress=None):
+    """
+    Capture the DST-related config sections of a set of firewalls.
+
+    Either inv and avars (to use Ansible) or client and creds (to use the connection broker) must be given.
+
+    Parameters:
+        hosts (list): List of firewall addresses.
+        inv (file object): The Ansible inventory.
+        avars (file object): The Ansible variables.
+        client (BrokerClient): The connection broker client.
+        creds (dict): Config section with the device credentials (used with the broker).
+        max_workers (int): Maximum number of hosts to capture at once through the broker (default: 8)
+        progress (ProgressTask): Optional progress task to update as each host is captured through the broker.
+
+    Returns:
+        dict: Mapping of host to its captured config text.
+    """
+
+    if client:
+        outputs = run_broker_command(client, hosts, creds, "exec", DST_SNAPSHOT_COMMANDS, max_workers=max_workers, progress=progress)
+    else:
+        resd = run_ansible_command("snapshot-playbook.yaml", inv, avars)
+        outputs = {}
+        for host, properties in get_ansible_task_results(resd, "Capture the DST config sections").items():
+            outputs[host] = properties["stdout"]
+
+    configs = {}
+    for host in hosts:
+        if host not in outputs:
+            raise Exception("No config was captured from {}".format(host))
+        configs[host] = "\n".join(outputs[host]) + "\n"
+
+    return configs
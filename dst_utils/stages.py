@@ -0,0 +1,211 @@
+"""
+A small dependency-graph scheduler for running pipeline stages as soon as their inputs are ready.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import threading
+import time
+
+
+class StageFailed(Exception):
+    """
+    Raised by StageScheduler.run() when a stage fails.  The original exception is in the 'error' attribute.
+    """
+
+    def __init__(self, stage, error):
+        self.stage = stage
+        self.error = error
+        super(StageFailed, self).__init__("Stage '{}' failed: {}".format(stage, error))
+
+
+class Stage(object):
+    def __init__(self, name, func, requires=(), main_thread=False):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.main_thread = main_thread
+        self.start = None
+        self.end = None
+
+
+class StageScheduler(object):
+    """
+    Run a set of stages, each starting as soon as all of the stages it requires have finished.
+
+    Each stage function is called with a single argument: a dict mapping the names of finished stages
+    to their return values.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.results = {}
+        self.__stages = {}
+        self.__order = []
+        self.__lock = threading.Lock()
+        self.__t0 = None
+
+    def add(self, name, func, requires=(), main_thread=False):
+        """
+        Add a stage.
+
+        Parameters:
+            name (string): The unique name of the stage.
+            func (function): The function to run; it receives the results dict.
+            requires (list): Names of the stages that must finish first.
+            main_thread (bool): Run the stage on the calling thread (e.g., to prompt the user) instead of in the pool.
+        """
+
+        if name in self.__stages:
+            raise Exception("Stage '{}' is already defined".format(name))
+
+        self.__stages[name] = Stage(name, func, requires, main_thread)
+        self.__order.append(name)
+
+    def __run_stage(self, stage):
+        stage.start = time.time()
+        try:
+            result = stage.func(self.results)
+        finally:
+            stage.end = time.time()
+
+        with self.__lock:
+            self.results[stage.name] = result
+
+        return result
+
+    def run(self):
+        """
+        Run all stages.  If a stage fails, no new stages are started, the running ones are allowed to
+        finish, and StageFailed is raised.  An interrupt (Ctrl-C) is handled the same way, so the caller can
+        still clean up.
+
+        Returns:
+            dict: Mapping of stage name to its return value.
+        """
+
+        for stage in self.__stages.values():
+            for req in stage.requires:
+                if req not in self.__stages:
+                    raise Exception("Stage '{}' requires unknown stage '{}'".format(stage.name, req))
+
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+        self.__t0 = time.time()
+        pending = list(self.__order)
+        done = set()
+        running = {}
+        main = []
+        failure = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running or main:
+                if failure is None:
+                    for name in list(pending):
+                        if all(req in done for req in self.__stages[name].requires):
+                            pending.remove(name)
+                            if self.__stages[name].main_thread:
+                                main.append(name)
+                            else:
+                                running[pool.submit(self.__run_stage, self.__stages[name])] = name
+
+                # Stages on the calling thread run one at a time, while the pool keeps going.
+                if main and failure is None:
+                    name = main.pop(0)
+                    try:
+                        self.__run_stage(self.__stages[name])
+                        done.add(name)
+                    except BaseException as e:
+                        failure = StageFailed(name, e)
+                    continue
+
+                if not running:
+                    if pending and failure is None:
+                        raise Exception("Stages {} can never run (dependency cycle)".format(", ".join(pending)))
+                    break
+
+                try:
+                    finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                except KeyboardInterrupt as e:
+                    # Running stages cannot be stopped, so let them finish but start no new ones.
+                    if failure is None:
+                        failure = StageFailed(next(iter(running.values())), e)
+                    continue
+
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                    except BaseException as e:
+                        if failure is None:
+                            failure = StageFailed(name, e)
+
+        if failure is not None:
+            raise failure
+
+        return self.results
+
+    def critical_path(self):
+        """
+        Return the chain of stages that determined the total run time.
+
+        Returns:
+            list: List of (stage name, duration in seconds) tuples, first stage first.
+        """
+
+        finished = [s for s in self.__stages.values() if s.end is not None]
+        if len(finished) == 0:
+            return []
+
+        path = []
+        stage = max(finished, key=lambda s: s.end)
+        while stage is not None:
+            path.insert(0, (stage.name, stage.end - stage.start))
+            reqs = [self.__stages[r] for r in stage.requires if self.__stages[r].end is not None]
+            stage = max(reqs, key=lambda s: s.end) if len(reqs) > 0 else None
+
+        return path
+
+    def report(self):
+        """
+        Format the critical path and total time for display.
+        """
+
+        path = self.critical_path()
+        if len(path) == 0:
+            return ""
+
+        total = max(s.end for s in self.__stages.values() if s.end is not None) - self.__t0
+        lines = ["Critical path ({:.1f}s total):".format(total)]
+        for name, secs in path:
+            lines.append("\t{:<40} {:.1f}s".format(name, secs))
+
+        return "\n".join(lines)
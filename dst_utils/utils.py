@@ -31,80 +31,93 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
-from __future__ import print_function
-from builtins import next
-from builtins import object
-import threading
-import itertools
-import time
 import sys
 import os
 import tempfile
 import json
 import subprocess
+import hashlib
+import datetime
+import socket
+import ipaddress
 from shutil import which
-from yaml import load, dump
+from .asa_config import build_command_plan, invert_plan, render_plan, DST_SNAPSHOT_COMMANDS
+from .retry import RetryPolicy
+from .config import config_cache, validate_config
+from . import progress
+from .metrics import metrics
 
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
+# The checkout holding the playbooks, profiles, and base configs (and the scripts), wherever the commands are run from.
+DST_BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-"""
-This spinner code is taken from https://stackoverflow.com/questions/4995733/how-to-create-a-spinning-command-line-cursor
-Contributed there by Victor Moyseenko and Tagar
-"""
+
+def _yaml():
+    # PyYAML is only loaded by the commands that read or write YAML.
+    import yaml
+
+    try:
+        from yaml import CLoader as Loader, CDumper as Dumper
+    except ImportError:
+        from yaml import Loader, Dumper
+
+    return yaml, Loader, Dumper
+
+
+def load_config(path):
+    """
+    Load a YAML configuration file.  An unchanged file is not parsed again (see ConfigCache).
+
+    Parameters:
+        path (string): Path to the configuration file.
+
+    Returns:
+        dict: The parsed configuration.
+    """
+
+    def parse(text):
+        yaml, Loader, _ = _yaml()
+        return yaml.load(text, Loader=Loader)
+
+    return config_cache.load(path, parse)
+
+
+class AnsibleFailed(Exception):
+    """
+    Raised by run_ansible_command() when a playbook fails.  The parsed results of the failed run are in the
+    'results' attribute.
+    """
+
+    def __init__(self, message, results):
+        self.results = results
+        super(AnsibleFailed, self).__init__(message)
 
 
 class Spinner(object):
-    def __init__(self, message, delay=0.1):
-        self.spinner = itertools.cycle(["-", "/", "|", "\\"])
+    """
+    Show a message with a spinner (and, for tasks with a total, counts, rate and ETA) while a block runs.  All
+    spinners are drawn by the single renderer in dst_utils.progress.
+
+    Parameters:
+        message (string): The message to display.
+        delay (float): Kept for compatibility; the renderer's interval sets the redraw rate.
+        total (int): Optional number of items (e.g., hosts) to count; call update() on the returned task.
+    """
+
+    def __init__(self, message, delay=0.1, total=None):
+        self.message = message
         self.delay = delay
-        self.busy = False
-        self.spinner_visible = False
-        sys.stdout.write(message)
-
-    def write_next(self):
-        with self._screen_lock:
-            if not self.spinner_visible:
-                sys.stdout.write(next(self.spinner))
-                self.spinner_visible = True
-                sys.stdout.flush()
-
-    def remove_spinner(self, cleanup=False):
-        with self._screen_lock:
-            if self.spinner_visible:
-                sys.stdout.write("\b")
-                self.spinner_visible = False
-                if cleanup:
-                    sys.stdout.write(" ")  # overwrite spinner with blank
-                    sys.stdout.write("\r")  # move to next line
-                sys.stdout.flush()
-
-    def spinner_task(self):
-        while self.busy:
-            self.write_next()
-            time.sleep(self.delay)
-            self.remove_spinner()
+        self.total = total
+        self.task = None
+        # Elsewhere, done() prints the message when the block completes, so it would be shown twice.
+        if progress.renderer.active_mode() == "tty":
+            progress.renderer.write(message)
 
     def __enter__(self):
-        if sys.stdout.isatty():
-            self._screen_lock = threading.Lock()
-            self.busy = True
-            self.thread = threading.Thread(target=self.spinner_task)
-            self.thread.start()
+        self.task = progress.renderer.start(self.message, total=self.total)
+        return self.task
 
     def __exit__(self, exception, value, tb):
-        if sys.stdout.isatty():
-            self.busy = False
-            self.remove_spinner(cleanup=True)
-        else:
-            sys.stdout.write("\r")
-
-
-"""
-End Spinner code from StackOverflow
-"""
+        progress.renderer.finish(self.task)
 
 
 def run_ansible_command(playb, inv, avars, skip_tags=None):
@@ -115,6 +128,10 @@ def run_ansible_command(playb, inv, avars, skip_tags=None):
         playb (string): The name of the playbook to run
         inv (file object): The file pointer containing the Ansible inventory
         avars (file object): The file pointer containing the Ansible variables
+        skip_tags (string): Optional comma-separated list of tags to skip
+
+    Returns:
+        dict: The parsed JSON results of the playbook run.
     """
 
     python_exe = get_python_interpreter()
@@ -126,12 +143,13 @@ def run_ansible_command(playb, inv, avars, skip_tags=None):
         "dst_variable_file={}".format(avars.name),
         "-e",
         "ansible_python_interpreter={}".format(python_exe),
-        "ansible/{}".format(playb),
+        os.path.join(DST_BASE_DIR, "ansible", playb),
     ]
 
     if skip_tags:
         command += ["--skip-tags", skip_tags]
 
+    start = datetime.datetime.now()
     p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     result = ""
 
@@ -140,8 +158,16 @@ def run_ansible_command(playb, inv, avars, skip_tags=None):
 
     p.wait()
 
+    metrics.ansible_run_duration.observe((datetime.datetime.now() - start).total_seconds(), playbook=playb)
+    metrics.ansible_runs.inc(playbook=playb, result="ok" if p.returncode == 0 else "failed")
+    resd = json.loads(result)
+    for play in resd.get("plays", []):
+        for block in play["tasks"]:
+            secs = _ansible_block_duration(block)
+            if secs is not None:
+                metrics.ansible_task_duration.observe(secs, playbook=playb, task=block["task"]["name"])
+
     if p.returncode != 0:
-        resd = json.loads(result)
         emsg = ""
         ehost = "Unknown Host"
         etask = "Unknown Task"
@@ -160,7 +186,63 @@ def run_ansible_command(playb, inv, avars, skip_tags=None):
             if found_failure:
                 break
 
-        raise Exception("Failed to run the Ansible playbook task '{}' on host {}: {}".format(etask, ehost, emsg))
+        raise AnsibleFailed("Failed to run the Ansible playbook task '{}' on host {}: {}".format(etask, ehost, emsg), resd)
+
+    return resd
+
+
+def get_ansible_task_results(resd, task):
+    """
+    Get the per-host results of a task from the output of run_ansible_command().
+
+    Parameters:
+        resd (dict): The parsed playbook results.
+        task (string): The name of the task.
+
+    Returns:
+        dict: Mapping of host to the task's result properties for that host.
+    """
+
+    for play in resd["plays"]:
+        for block in play["tasks"]:
+            if block["task"]["name"] == task:
+                return block["hosts"]
+
+    return {}
+
+
+def _ansible_block_duration(block):
+    # A task skipped on every host (e.g., licensing without a token) did not wait for anything.
+    hosts = block.get("hosts", {})
+    if len(hosts) > 0 and all(result.get("skipped") for result in hosts.values()):
+        return None
+
+    duration = block["task"].get("duration")
+    if not duration or "end" not in duration:
+        return None
+
+    times = [datetime.datetime.strptime(duration[k], "%Y-%m-%dT%H:%M:%S.%fZ") for k in ("start", "end")]
+    return (times[1] - times[0]).total_seconds()
+
+
+def get_ansible_task_duration(resd, task):
+    """
+    Get the wall-clock duration of a task from the output of run_ansible_command().
+
+    Parameters:
+        resd (dict): The parsed playbook results.
+        task (string): The name of the task.
+
+    Returns:
+        float: The duration of the task in seconds, or None if the task did not run (or was skipped on every host).
+    """
+
+    for play in resd["plays"]:
+        for block in play["tasks"]:
+            if block["task"]["name"] == task:
+                return _ansible_block_duration(block)
+
+    return None
 
 
 def done(msg):
@@ -218,37 +300,96 @@ def cleanup(dstt=None, inv=None, avars=None):
     done(msg)
 
 
-def check_sections(type, config):
+def _report_config_errors(errors):
+    for e in errors:
+        print("ERROR: {}".format(e))
+
+    if len(errors) > 0:
+        sys.exit(1)
+
+
+def check_config(type, config):
     """
-    Check that the right sections appear in the YAML config file.
+    Validate the whole config file against the schema, print every problem found, and exit if there are any.
 
     Parameters:
         type (string): Either "test" or "production" to indicate the type of execution being run.
         config (dict): A dictionary representing the current config file.
     """
-    for sec in (type, "dst"):
-        if sec not in config:
-            print("ERROR: Section '{}' not found in config file.".format(sec))
-            sys.exit(1)
+
+    _report_config_errors(validate_config(type, config))
 
 
-def check_vars(type, config):
+def file_md5(path):
     """
-    Check that the right variables appear in the right config file sections.
+    Compute the MD5 checksum of a file (the same digest the ASA's 'verify /md5' command reports).
 
     Parameters:
+        path (string): Path to the file.
+
+    Returns:
+        string: The hex digest of the file.
+    """
+
+    h = hashlib.md5()
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(65536), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def set_ansible_concurrency(config, type):
+    """
+    Cap the number of firewalls Ansible works on at once.
+
+    Parameters:
+        config (dict): Dictionary representing the current configuration file.
         type (string): Either "test" or "production" to indicate the type of execution being run.
-        config (dict): A dictionary representing the current config file.
+
+    Returns:
+        int: The concurrency limit.
+    """
+
+    max_concurrency = int(config[type].get("max_concurrency", 8))
+    os.environ["ANSIBLE_FORKS"] = str(max_concurrency)
+
+    return max_concurrency
+
+
+def resolve_names(hosts, max_workers=16):
+    """
+    Look up a set of host names in parallel.
+
+    Parameters:
+        hosts (list): List of host names and/or IP addresses (addresses are skipped).
+        max_workers (int): Maximum number of lookups to run at once (default: 16)
+
+    Returns:
+        list: The host names that could not be resolved.
     """
-    for var in ("custom_name", "domains"):
-        if var not in config["dst"]:
-            print("ERROR: Variable '{}' not defined in 'dst' section in config file.".format(var))
-            sys.exit(1)
 
-    for var in ("ansible_user", "ansible_password", "ansible_become_password", "group_policies"):
-        if var not in config[type]:
-            print("ERROR Variable '{}' not defined in '{}' section in config file.".format(var, type))
-            sys.exit(1)
+    def resolves(host):
+        try:
+            socket.getaddrinfo(host, None, socket.AF_INET)
+            return True
+        except socket.gaierror:
+            return False
+
+    names = []
+    for host in hosts:
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            names.append(host)
+
+    if len(names) == 0:
+        return []
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(names))) as pool:
+        return [host for host, ok in zip(names, pool.map(resolves, names)) if not ok]
 
 
 def get_python_interpreter():
@@ -266,13 +407,14 @@ def get_python_interpreter():
     return python_exe
 
 
-def build_ansible_inventory(config=None, fw_ip=None):
+def build_ansible_inventory(config=None, fw_ip=None, hosts=None):
     """
     Build a basic ini-style Ansible inventory file.
 
     Parameters:
         config (dict): Optional dictionary representing the current configuration file (used in production mode).
         fw_ip (string): Optional firewall IP address (used in test mode).
+        hosts (list): Optional subset of the production firewalls to include (default: all of them).
 
     Returns:
         file object: File descriptor of the file containing the Ansible inventory.
@@ -286,20 +428,23 @@ def build_ansible_inventory(config=None, fw_ip=None):
             raise Exception("The configuration must include a production.firewalls section")
 
         for fw in config["production"]["firewalls"]:
-            inv.write(fw + "\n")
+            if hosts is None or fw in hosts:
+                inv.write(fw + "\n")
 
     inv.close()
 
     return inv
 
 
-def build_ansible_vars(config, type):
+def build_ansible_vars(config, type, running=None, host_plans=None):
     """
     Build a temporary YAML file to hold all of the Ansible variables.
 
     Parameters:
         config (dict): Dictionary representing the current configuration file.
         type (string): Either "test" or "production" to indicate the type of execution being run.
+        running (AsaConfig): Optional model of the firewall config to plan the DST changes against.
+        host_plans (dict): Optional mapping of host to a command plan already computed for that host.
 
     Returns:
         file object: File descriptor of the file containing the Ansible variables.
@@ -310,8 +455,32 @@ def build_ansible_vars(config, type):
         # Merge all variables together into a flat structure
         vard = {**vard, **config[sec]}
 
-    # Put the current working directory in the file as a base for subsequent operations.
-    vard["dst_base_dir"] = os.getcwd()
+    # Pre-compute the DST commands so they can be applied in a single task.  If we know the
+    # device config, the plan is already a delta and Ansible does not need to compare it again.
+    plan = build_command_plan(config["dst"], config[type]["group_policies"], running)
+    vard["dst_plan"] = render_plan(plan)
+    vard["dst_plan_match"] = "none" if running is not None else "line"
+
+    # Undoing the plan returns a kept test firewall to its base config for the next run.
+    vard["dst_revert_plan"] = render_plan(invert_plan(plan, running)) if running is not None else ""
+
+    vard["dst_snapshot_commands"] = DST_SNAPSHOT_COMMANDS
+
+    # Per-host plans are always exact deltas, so they never need to be compared again.
+    vard["dst_host_plans"] = {}
+    for host, plan in (host_plans or {}).items():
+        vard["dst_host_plans"][host] = render_plan(plan)
+
+    # Put the checkout in the file as a base for subsequent operations.
+    vard["dst_base_dir"] = DST_BASE_DIR
+
+    # The profile is only copied to a firewall when its checksum there differs from this one.
+    vard["dst_profile_md5"] = file_md5(os.path.join(vard["dst_base_dir"], "profiles", "DST.xml"))
+
+    # The waits that run on the firewall use the fixed-interval retries of asa_command.
+    for wait in ("fw_external_ping", "license_registered"):
+        for param, value in RetryPolicy.from_config(config, wait).ansible_params().items():
+            vard["{}_{}".format(wait, param)] = value
 
     # Add static Ansible variables.
     vard["ansible_network_os"] = "asa"
@@ -320,7 +489,8 @@ def build_ansible_vars(config, type):
     vard["ansible_connection"] = "network_cli"
 
     avars = tempfile.NamedTemporaryFile(mode="w", delete=False)
-    dump(vard, avars, Dumper=Dumper)
+    yaml, _, Dumper = _yaml()
+    yaml.dump(vard, avars, Dumper=Dumper)
 
     avars.close()
 
@@ -32,23 +32,17 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
-from __future__ import print_function
-from builtins import input
 from dst_topology import DSTTopology
 import argparse
 import sys
 import subprocess
 from dst_utils import *
-import time
 import tempfile
 import os
 import re
-from yaml import load, dump
-
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
+import json
+import time
+from shutil import which
 
 
 def run_traceroute(host):
@@ -64,13 +58,14 @@ def run_traceroute(host):
 
     command = ["traceroute", "-I", "-4", "-q", "1", "-n", "-m", "3", "-w", "1", host]
 
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    result = ""
+    with metrics.probe_duration.time(kind="traceroute"):
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        result = ""
 
-    for line in iter(p.stdout.readline, b""):
-        result += line.decode("utf-8")
+        for line in iter(p.stdout.readline, b""):
+            result += line.decode("utf-8")
 
-    p.wait()
+        p.wait()
 
     # Extract each hop IP from the traceroute output.
     m = re.findall(r"[123]\s+([\d\.\*]+)\s", result)
@@ -80,12 +75,8 @@ def run_traceroute(host):
 
 def main():
     dstt = None
-    fw_ip = None
     conf = None
     args = None
-    msg = None
-    def_routing = None
-    tests_passed = True
 
     parser = argparse.ArgumentParser(prog=sys.argv[0], description="Test a set of Dynamic Split Tunnel configs")
     parser.add_argument(
@@ -99,8 +90,38 @@ def main():
         "--base-config-dir",
         "-b",
         metavar="<BASE CONFIG DIR>",
-        help="Path to the base set of virtual device configs; default: base_configs dir in the current directory",
-        default="base_configs",
+        help="Path to the base set of virtual device configs; default: base_configs dir of the checkout",
+        default=os.path.join(DST_BASE_DIR, "base_configs"),
+    )
+    parser.add_argument("--plan", action="store_true", help="Print the DST command plan for the test firewall and exit")
+    parser.add_argument(
+        "--broker",
+        metavar="<SOCKET PATH>",
+        nargs="?",
+        const=DEFAULT_BROKER_SOCKET,
+        help="Apply and reset the DST config through the connection broker listening on this socket; default: {}".format(
+            DEFAULT_BROKER_SOCKET
+        ),
+    )
+    parser.add_argument("--report", "-r", metavar="<REPORT FILE>", help="Write the test results to this JSON file")
+    parser.add_argument(
+        "--yes",
+        "-y",
+        action="store_true",
+        help="Do not prompt; wait for the AnyConnect client to connect to the test firewall on its own (used by dst_daemon.py)",
+    )
+    parser.add_argument(
+        "--lease-file",
+        metavar="<LEASE FILE>",
+        help="File that tracks the kept, registered test firewall; default: {}".format(DEFAULT_LEASE_FILE),
+        default=DEFAULT_LEASE_FILE,
+    )
+    parser.add_argument("--release-lease", action="store_true", help="Deregister the kept test firewall, remove its lab, and exit")
+    parser.add_argument(
+        "--metrics-file",
+        metavar="<METRICS FILE>",
+        help="Write the run's metrics to this Prometheus textfile (e.g., in the node_exporter textfile directory); default: $DST_METRICS_FILE",
+        default=os.environ.get("DST_METRICS_FILE"),
     )
     args = parser.parse_args()
 
@@ -108,27 +129,33 @@ def main():
         print("ERROR: Config file {} does not exist!".format(args.config))
         sys.exit(1)
 
-    with open(args.config, "r") as fd:
-        conf = load(fd, Loader=Loader)
+    conf = load_config(args.config)
 
-    check_sections("test", conf)
+    check_config("test", conf)
 
-    for var in ("host", "user", "pass"):
-        if var not in conf["cml"]:
-            print("ERROR: Variable '{}' not defined in the 'cml' section in the config file.".format(var))
-            sys.exit(1)
-
-    check_vars("test", conf)
+    # The test firewall always boots from its base config, so the DST changes can be planned offline.
+    fw_base_config = os.path.join(args.base_config_dir, "hq_firewall.txt")
+    if not os.path.exists(fw_base_config):
+        print("ERROR: Firewall base config {} does not exist!".format(fw_base_config))
+        sys.exit(1)
 
-    for var in ("local_hosts", "tunnel_hosts", "canary_host", "vpn_hop"):
-        if var not in conf["test"]:
-            print("ERROR: Variable '{}' not defined in the 'test' section in the config file.".format(var))
+    running = AsaConfig.from_file(fw_base_config)
+
+    if args.plan:
+        plan = render_plan(build_command_plan(conf["dst"], conf["test"]["group_policies"], running))
+        if plan:
+            sys.stdout.write(plan)
+        else:
+            print("No DST changes are needed.")
+        sys.exit(0)
+
+    client = None
+    if args.broker:
+        client = BrokerClient(args.broker)
+        if not client.is_alive():
+            print("ERROR: No connection broker is listening on {}.".format(args.broker))
             sys.exit(1)
 
-    if not re.match(r"[\d\.]", conf["test"]["canary_host"]):
-        print("ERROR: The canary_host must be an IPv4 address.")
-        sys.exit(1)
-
     os.environ["VIRL2_USER"] = conf["cml"]["user"]
     os.environ["VIRL2_PASS"] = conf["cml"]["pass"]
 
@@ -138,194 +165,450 @@ def main():
         print("ERROR: Failed to connect to the CML controller at {}: {}".format(conf["cml"]["host"], e))
         sys.exit(1)
 
-    msg = "Creating test topology..."
+    set_ansible_concurrency(conf, "test")
+    os.environ["ANSIBLE_CONFIG"] = os.path.join(DST_BASE_DIR, "ansible", "dst.ansible.cfg")
+    os.environ["ANSIBLE_HOST_KEY_CHECKING"] = "False"
 
+    # Registering the firewall's Smart License is one of the slowest steps, so when leases are enabled the
+    # lab is kept after a run and the next run reuses it until the lease expires.
+    lease_hours = conf["test"].get("license_lease_hours", 0) if "smart_license_token" in conf["test"] else 0
+    leases = LicenseLease(args.lease_file, lease_hours)
     try:
-        with Spinner(msg):
-            dstt.create_topology()
+        # Held until the run exits, since the run may attach to (or record) the leased lab at any point.
+        leases.lock()
     except Exception as e:
-        print("ERROR: Failed to create topology on {}: {}".format(conf["cml"]["host"], e))
+        print("ERROR: {}".format(e))
         sys.exit(1)
+    lease = leases.load()
+    keep_lab = leases.enabled
+    leased = False
+
+    def reset_firewall(fw_ip, inv, avars, keep):
+        # A kept firewall stays registered but goes back to its base config; otherwise it is deregistered.
+        if client:
+            commands = ["vpn-sessiondb logoff all noconfirm"]
+            if not keep:
+                commands.insert(0, "license smart deregister")
+            run_broker_command(client, [fw_ip], conf["test"], "exec", commands)
+            if keep:
+                plan = build_command_plan(conf["dst"], conf["test"]["group_policies"], running)
+                commands = plan_commands(invert_plan(plan, running))
+                if len(commands) > 0:
+                    run_broker_command(client, [fw_ip], conf["test"], "config", commands)
+        else:
+            run_ansible_command("reset-test-playbook.yaml", inv, avars, skip_tags="license" if keep else "revert")
+
+    def release_lease(lease):
+        msg = "Releasing the Smart License registration of {}...".format(lease["fw_ip"])
+        with Spinner(msg):
+            try:
+                dstt.attach(lease["lab_id"])
+            except Exception as e:
+                leases.release()
+                raise Exception(
+                    "The lab of the registered test firewall is gone ({}); remove {} from the Smart Account if it is still listed".format(
+                        e, lease["fw_ip"]
+                    )
+                )
 
-    done(msg)
-    msg = "Starting topology..."
+            inv = build_ansible_inventory(fw_ip=lease["fw_ip"])
+            avars = build_ansible_vars(conf, "test", running)
+            try:
+                reset_firewall(lease["fw_ip"], inv, avars, False)
+            finally:
+                cleanup(dstt=dstt, inv=inv, avars=avars)
+                leases.release()
+
+        done(msg)
+
+    if args.release_lease:
+        if lease is None:
+            print("There is no Smart License lease in {}.".format(args.lease_file))
+            sys.exit(0)
 
-    try:
-        with Spinner(msg):
-            dstt.start()
-    except Exception as e:
-        print("ERROR: Failed to start topology: {}".format(e))
         try:
-            cleanup(dstt=dstt)
-        except:
-            pass
+            release_lease(lease)
+        except Exception as e:
+            print("")
+            print("ERROR: Failed to release the Smart License lease: {}".format(e))
+            sys.exit(1)
 
-        sys.exit(1)
+        sys.exit(0)
 
-    done(msg)
-    msg = "Waiting for topology to be ready..."
+    if lease is not None:
+        if lease["cml_host"] != conf["cml"]["host"]:
+            print(
+                "WARNING: The Smart License lease in {} is for {}; not keeping the lab of this run.".format(
+                    args.lease_file, lease["cml_host"]
+                )
+            )
+            keep_lab = False
+        elif leases.is_valid(lease, conf["cml"]["host"]):
+            try:
+                dstt.attach(lease["lab_id"])
+                leased = True
+            except Exception as e:
+                print("WARNING: Unable to reuse the registered test lab {}: {}".format(lease["lab_id"], e))
+                leases.release()
+        else:
+            try:
+                release_lease(lease)
+            except Exception as e:
+                print("")
+                print("WARNING: {}".format(e))
+
+    metrics.begin("test", args.metrics_file)
+
+    # Each stage runs as soon as the stages it requires are done.  Stages that run while the lab
+    # boots (tool checks, DNS lookups, the canary trace, and rendering the Ansible variables) do not
+    # print anything so they don't interfere with the progress output.
+    sched = StageScheduler()
+
+    def check_tools(results):
+        missing = [tool for tool in ("traceroute", "ping", "ansible-playbook") if not which(tool)]
+        if len(missing) > 0:
+            raise Exception("Required tool(s) not found in PATH: {}".format(", ".join(missing)))
+
+    def resolve_hosts(results):
+        # Only report names that don't resolve; the traceroutes must still do their own lookups
+        # so that DST sees the queries once the VPN is up.
+        return resolve_names(conf["test"].get("local_hosts", []) + conf["test"].get("tunnel_hosts", []))
+
+    def create_topology(results):
+        if leased:
+            done("Reusing registered test lab {}...".format(dstt.lab_id))
+            return
+
+        msg = "Creating test topology..."
+        start = time.time()
+        try:
+            with Spinner(msg):
+                dstt.create_topology()
+        except Exception as e:
+            raise Exception("Failed to create topology on {}: {}".format(conf["cml"]["host"], e))
 
-    try:
-        with Spinner("Waiting for topology to be ready..."):
-            while not dstt.is_ready():
-                time.sleep(1)
-    except Exception as e:
-        print("ERROR: Failed to wait for topology to be ready: {}".format(e))
+        done(msg)
+
+        return start
+
+    def start_topology(results):
+        msg = "Starting topology..."
         try:
-            cleanup(dstt=dstt)
-        except:
-            pass
+            with Spinner(msg):
+                dstt.start()
+        except Exception as e:
+            raise Exception("Failed to start topology: {}".format(e))
 
-        sys.exit(1)
+        done(msg)
 
-    done(msg)
+    def wait_ready(results):
+        msg = "Waiting for topology to be ready..."
+        try:
+            with Spinner(msg):
+                RetryPolicy.from_config(conf, "lab_ready").wait_until(dstt.is_ready)
+        except Exception as e:
+            raise Exception("Failed to wait for topology to be ready: {}".format(e))
+
+        # The create stage returns when the lab started booting (None for a reused lab).
+        if results["create"] is not None:
+            metrics.lab_boot.observe(time.time() - results["create"])
+
+        done(msg)
+
+    def get_fw_ip(results):
+        try:
+            fw_ip = dstt.get_fw_ip(wait=True, policy=RetryPolicy.from_config(conf, "fw_ip"))
+        except Exception as e:
+            raise Exception("Failed to obtain the firewall IP: {}".format(e))
 
-    try:
-        fw_ip = dstt.get_fw_ip()
         if not fw_ip:
             if "firewall_ip" not in conf["test"]:
-                print(
-                    "ERROR: Unable to dynamically obtain the firewall IP and a static IP has not been defined in {}; define 'firewall_ip' in the 'test' section of {}".format(
+                raise Exception(
+                    "Unable to dynamically obtain the firewall IP and a static IP has not been defined in {}; define 'firewall_ip' in the 'test' section of {}".format(
                         args.config, args.config
                     )
                 )
-                try:
-                    cleanup(dstt=dstt)
-                except:
-                    pass
-
-                sys.exit(1)
-            else:
-                fw_ip = conf["test"]["firewall_ip"]
-    except Exception as e:
-        print("ERROR: Failed to obtain the firewall IP: {}".format(e))
-        try:
-            cleanup(dstt=dstt)
-        except:
-            pass
 
-    command = ["ping", "-W", "1", "-c", "1", "-q", fw_ip]
-    rc = 1
-    msg = "Making sure HQ Firewall is reachable..."
-    with Spinner(msg):
-        while rc != 0:
-            p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            p.wait()
-            rc = p.returncode
+            fw_ip = conf["test"]["firewall_ip"]
 
-    done(msg)
+        return fw_ip
 
-    inv = build_ansible_inventory(fw_ip=fw_ip)
-    avars = build_ansible_vars(conf, "test")
+    def wait_reachable(results):
+        command = ["ping", "-W", "1", "-c", "1", "-q", results["fw_ip"]]
 
-    msg = "Running Ansible to provision the firewall for testing..."
-
-    os.environ["ANSIBLE_CONFIG"] = os.getcwd() + "/ansible/dst.ansible.cfg"
-    os.environ["ANSIBLE_HOST_KEY_CHECKING"] = "False"
+        def ping():
+            with metrics.probe_duration.time(kind="ping"):
+                p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                return p.wait() == 0
 
-    with Spinner(msg):
+        msg = "Making sure HQ Firewall is reachable..."
         try:
-            run_ansible_command("dst-playbook.yaml", inv, avars)
-        except Exception as e:
-            print("")
-            print("ERROR: {}".format(e))
-            try:
-                cleanup(dstt=dstt, inv=inv, avars=avars)
-            except:
-                pass
-            sys.exit(1)
+            with Spinner(msg):
+                RetryPolicy.from_config(conf, "fw_reachable").wait_until(ping)
+        except RetryTimeout as e:
+            raise Exception("HQ Firewall is not reachable: {}".format(e))
 
-    done(msg)
+        done(msg)
 
-    msg = "Testing canary to get default routing..."
-    with Spinner(msg):
-        def_routing = run_traceroute(conf["test"]["canary_host"])
+    def render_vars(results):
+        return build_ansible_vars(conf, "test", running)
 
-    done(msg)
+    def render_inventory(results):
+        return build_ansible_inventory(fw_ip=results["fw_ip"])
 
-    print("")
-    while True:
-        print("Dynamic Split Tunnel VPN is ready to test.")
-        ans = input("Point AnyConnect to {} then when connected, hit 'y' and press Enter in this window to start the test...".format(fw_ip))
-        if ans.lower().startswith("y"):
-            break
-    print("")
+    def provision(results):
+        inv = results["inventory"]
+        avars = results["ansible_vars"]
+        msg = "Running Ansible to provision the firewall for testing..."
+        with Spinner(msg):
+            # A leased firewall is already registered.
+            skip_tags = ["license"] if leased else []
+            if client:
+                # Ansible only handles the test setup; the DST config goes through the broker's session.
+                resd = run_ansible_command("dst-playbook.yaml", inv, avars, skip_tags=",".join(skip_tags + ["dst"]))
+                commands = plan_commands(build_command_plan(conf["dst"], conf["test"]["group_policies"], running))
+                run_broker_command(client, [results["fw_ip"]], conf["test"], "config", commands)
+            else:
+                resd = run_ansible_command("dst-playbook.yaml", inv, avars, skip_tags=",".join(skip_tags) or None)
 
-    msg = "Testing VPN tunneled hosts..."
-    with Spinner(msg):
-        if "hq_server_ip" in conf["test"]:
-            # Append the internal host for testing.
-            conf["test"]["tunnel_hosts"].append(conf["test"]["hq_server_ip"])
+        # asa_command does not report its attempts, so each wait on the firewall is recorded as a single one.
+        for wait, task in (
+            ("fw_external_ping", "Ensure reachability to an external host"),
+            ("license_registered", "Wait for Smart License to be registered"),
+        ):
+            secs = get_ansible_task_duration(resd, task)
+            if secs is not None:
+                retry_stats.record(wait, [secs], secs, True)
 
-        print("")
-        for host in conf["test"]["tunnel_hosts"]:
-            imsg = "\tInspecting route to {}".format(host)
-            rt = None
-            with Spinner(imsg):
-                rt = run_traceroute(host)
-            bad = False
-            if rt[2] != conf["test"]["vpn_hop"] and rt[2] != host:
-                bad = True
-                tests_passed = False
+        done(msg)
 
-            if bad:
-                sys.stdout.write(imsg + " [\033[33mWARNING\033[0m] Unexpected route: {}\n".format(", ".join(rt)))
-            else:
-                sys.stdout.write(imsg + " [\033[32mOK\033[0m] ({})\n".format(", ".join(rt)))
+    def trace_canary(results):
+        # The canary learns the local routing, so it only has to finish before the VPN is connected.
+        return run_traceroute(conf["test"]["canary_host"])
 
-    done(msg)
+    def user_gate(results):
+        for host in results["resolve"]:
+            print("WARNING: Unable to resolve test host {} (it may only resolve over the VPN).".format(host))
 
-    msg = "Testing Split Tunnel hosts..."
-    with Spinner(msg):
         print("")
-        for host in conf["test"]["local_hosts"]:
-            imsg = "\tInspecting route to {}".format(host)
-            rt = None
-            with Spinner(imsg):
-                rt = run_traceroute(host)
-            i = 0
-            bad = False
-            for hop in rt:
-                if rt[i] != def_routing[i]:
-                    bad = True
-                    tests_passed = False
-                    break
+        if args.yes:
+            print("Dynamic Split Tunnel VPN is ready to test at {}.".format(results["fw_ip"]))
+            wait_vpn(results["fw_ip"])
+            return
+
+        while True:
+            print("Dynamic Split Tunnel VPN is ready to test.")
+            ans = input(
+                "Point AnyConnect to {} then when connected, hit 'y' and press Enter in this window to start the test...".format(
+                    results["fw_ip"]
+                )
+            )
+            if ans.lower().startswith("y"):
+                break
+        print("")
 
-                i += 1
+    def wait_vpn(fw_ip):
+        # No one confirms the connection, so trace a tunneled host until its route goes through the VPN.
+        probe = conf["test"].get("hq_server_ip") or (conf["test"]["tunnel_hosts"] or [None])[0]
+        if probe is None:
+            return
 
-            if bad:
-                sys.stdout.write(imsg + " [\033[33mWARNING\033[0m] Unexpected route: {}\n".format(", ".join(rt)))
-            else:
-                sys.stdout.write(imsg + " [\033[32mOK\033[0m] ({})\n".format(", ".join(rt)))
+        def tunneled():
+            rt = run_traceroute(probe)
+            return len(rt) > 2 and rt[2] in (conf["test"]["vpn_hop"], probe)
+
+        msg = "Waiting for the AnyConnect client to connect..."
+        try:
+            with Spinner(msg):
+                RetryPolicy.from_config(conf, "vpn_up").wait_until(tunneled)
+        except RetryTimeout as e:
+            raise Exception("The VPN to {} did not come up (the route to {} never went through it): {}".format(fw_ip, probe, e))
 
-    done(msg)
+        done(msg)
 
-    # if not tests_passed:
-    #     while True:
-    #         ans = input("XXX: Hit 'y' and Enter to continue...")
-    #         if ans.lower().startswith("y"):
-    #             break
+    def run_traces(results):
+        tests_passed = True
+        routes = []
+        def_routing = results["canary"]
 
-    msg = "Resetting the test topology..."
+        msg = "Testing VPN tunneled hosts..."
+        tunnel_hosts = list(conf["test"]["tunnel_hosts"])
+        if "hq_server_ip" in conf["test"]:
+            # Append the internal host for testing.
+            tunnel_hosts.append(conf["test"]["hq_server_ip"])
 
-    with Spinner(msg):
-        try:
-            run_ansible_command("reset-test-playbook.yaml", inv, avars)
-        except Exception as e:
-            print("")
-            print("WARNING: Failed to reset the topology config: {}".format(e))
+        # Only the task reports each host while the traces run; the results are printed once they are done.
+        lines = []
+        with Spinner(msg, total=len(tunnel_hosts)) as task:
+            for host in tunnel_hosts:
+                imsg = "\tInspecting route to {}".format(host)
+                rt = run_traceroute(host)
+                bad = False
+                if rt[2] != conf["test"]["vpn_hop"] and rt[2] != host:
+                    bad = True
+                    tests_passed = False
 
-    done(msg)
+                routes.append({"host": host, "expect": "tunnel", "route": rt, "passed": not bad})
+                metrics.route_checks.inc(expect="tunnel", result="failed" if bad else "passed")
+                task.update(host, "unexpected route" if bad else "ok", failed=bad)
+                if bad:
+                    lines.append(imsg + " [\033[33mWARNING\033[0m] Unexpected route: {}\n".format(", ".join(rt)))
+                else:
+                    lines.append(imsg + " [\033[32mOK\033[0m] ({})\n".format(", ".join(rt)))
+
+        done(msg)
+        sys.stdout.write("".join(lines))
+
+        msg = "Testing Split Tunnel hosts..."
+        lines = []
+        with Spinner(msg, total=len(conf["test"]["local_hosts"])) as task:
+            for host in conf["test"]["local_hosts"]:
+                imsg = "\tInspecting route to {}".format(host)
+                rt = run_traceroute(host)
+                i = 0
+                bad = False
+                for hop in rt:
+                    if rt[i] != def_routing[i]:
+                        bad = True
+                        tests_passed = False
+                        break
+
+                    i += 1
+
+                routes.append({"host": host, "expect": "local", "route": rt, "passed": not bad})
+                metrics.route_checks.inc(expect="local", result="failed" if bad else "passed")
+                task.update(host, "unexpected route" if bad else "ok", failed=bad)
+                if bad:
+                    lines.append(imsg + " [\033[33mWARNING\033[0m] Unexpected route: {}\n".format(", ".join(rt)))
+                else:
+                    lines.append(imsg + " [\033[32mOK\033[0m] ({})\n".format(", ".join(rt)))
+
+        done(msg)
+        sys.stdout.write("".join(lines))
+
+        return {"passed": tests_passed, "canary": def_routing, "routes": routes}
+
+    def reset(results):
+        msg = "Resetting the test topology..."
+
+        # "reset" if the firewall is back to its base config, "deregistered" if it is not but holds no
+        # registration, or "registered" if it may still be registered.
+        state = "reset"
+        with Spinner(msg):
+            try:
+                reset_firewall(results["fw_ip"], results["inventory"], results["ansible_vars"], keep_lab)
+            except Exception as e:
+                state = "registered" if "smart_license_token" in conf["test"] else "deregistered"
+                print("")
+                print("WARNING: Failed to reset the topology config: {}".format(e))
+                if keep_lab:
+                    # A firewall that could not be reset is not reused, so give up its registration.
+                    try:
+                        reset_firewall(results["fw_ip"], results["inventory"], results["ansible_vars"], False)
+                        state = "deregistered"
+                    except Exception as de:
+                        print("WARNING: Failed to deregister the Smart License of {}: {}".format(results["fw_ip"], de))
+
+        done(msg)
+
+        return state
+
+    def write_report(results):
+        if args.report:
+            sets = dst_sets(conf["dst"], conf["test"]["group_policies"])
+            with open(args.report, "w") as fd:
+                json.dump(
+                    dict(
+                        results["traces"],
+                        firewall=results["fw_ip"],
+                        domains=[d for dset in sets for d in dset["domains"]],
+                        sets={dset["name"]: dset["domains"] for dset in sets},
+                        waits=retry_stats.summary(),
+                    ),
+                    fd,
+                    indent=2,
+                )
+
+    def cleanup_test(results):
+        if results["reset"] == "registered":
+            # Removing the lab would leave its firewall registered, so keep it with an expired lease instead.
+            leases.record(conf["cml"]["host"], dstt.lab_id, results["fw_ip"], hours=0)
+            cleanup(inv=results["inventory"], avars=results["ansible_vars"])
+            print("Keeping test lab {} until its firewall is deregistered (run with --release-lease to retry).".format(dstt.lab_id))
+        elif keep_lab and results["reset"] == "reset":
+            if not leased:
+                leases.record(conf["cml"]["host"], dstt.lab_id, results["fw_ip"])
+            cleanup(inv=results["inventory"], avars=results["ansible_vars"])
+            print("Keeping test lab {} for its Smart License registration (run with --release-lease to remove it).".format(dstt.lab_id))
+        else:
+            cleanup(dstt=dstt, inv=results["inventory"], avars=results["ansible_vars"])
+            leases.release()
+
+    sched.add("tools", check_tools)
+    sched.add("resolve", resolve_hosts)
+    sched.add("create", create_topology)
+    sched.add("start", start_topology, requires=["create"])
+    sched.add("ready", wait_ready, requires=["start"])
+    sched.add("fw_ip", get_fw_ip, requires=["ready"])
+    sched.add("reachable", wait_reachable, requires=["fw_ip", "tools"])
+    sched.add("ansible_vars", render_vars)
+    sched.add("inventory", render_inventory, requires=["fw_ip"])
+    sched.add("provision", provision, requires=["reachable", "inventory", "ansible_vars"])
+    sched.add("canary", trace_canary, requires=["tools"])
+    # The gate prompts the user, so it runs on the main thread, where Ctrl-C lands.
+    sched.add("gate", user_gate, requires=["provision", "canary", "resolve"], main_thread=True)
+    sched.add("traces", run_traces, requires=["gate"])
+    sched.add("reset", reset, requires=["traces"])
+    sched.add("report", write_report, requires=["traces"])
+    sched.add("cleanup", cleanup_test, requires=["reset"])
 
     try:
-        cleanup(dstt=dstt, inv=inv, avars=avars)
-    except Exception as e:
+        results = sched.run()
+    except StageFailed as e:
+        metrics.failures.inc(command="test", stage=e.stage)
+        if e.stage == "cleanup":
+            print("")
+            print("WARNING: Failed to cleanup after the test: {}".format(e.error))
+            sys.exit(1)
+
         print("")
-        print("WARNING: Failed to cleanup after the test: {}".format(e))
+        print("ERROR: {}".format("Interrupted" if isinstance(e.error, KeyboardInterrupt) else e.error))
+        inv = sched.results.get("inventory")
+        avars = sched.results.get("ansible_vars")
+        # The lab is going away, so deregister its firewall if it may have been registered.  A leased firewall
+        # is registered even if the run failed before it got to its address, inventory or variables.
+        if "smart_license_token" in conf["test"] and (leased or "reachable" in sched.results):
+            fw_ip = lease["fw_ip"] if leased else sched.results["fw_ip"]
+            if inv is None:
+                inv = build_ansible_inventory(fw_ip=fw_ip)
+            if avars is None:
+                avars = build_ansible_vars(conf, "test", running)
+            try:
+                reset_firewall(fw_ip, inv, avars, False)
+            except Exception as de:
+                # Keep the lab with an expired lease, so the next run (or --release-lease) tries again.
+                leases.record(conf["cml"]["host"], dstt.lab_id, fw_ip, hours=0)
+                cleanup(inv=inv, avars=avars)
+                print(
+                    "WARNING: Failed to deregister the Smart License of {}: {}; keeping test lab {} (run with --release-lease to retry).".format(
+                        fw_ip, de, dstt.lab_id
+                    )
+                )
+                sys.exit(1)
+        try:
+            cleanup(dstt=dstt, inv=inv, avars=avars)
+        except:
+            pass
+        leases.release()
         sys.exit(1)
 
     print("")
-    if tests_passed:
+    print(sched.report())
+
+    metrics.finish("passed" if results["traces"]["passed"] else "failed")
+
+    print("")
+    if results["traces"]["passed"]:
         sys.stdout.write("All tests \033[32mPASSED\033[0m!\n")
     else:
         sys.stdout.write("One or more tests \033[31mFAILED\033[0m!\n")
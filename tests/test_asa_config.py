@@ -0,0 +1,276 @@
+"""
+Check the command plans for configs with several custom-data sets, and how the config checks and the daemon handle them.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import tempfile
+import unittest
+import shutil
+import json
+import sys
+import os
+from unittest import mock
+from yaml import safe_dump, safe_load
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from bench_dst import make_config
+from dst_utils import AsaConfig, build_command_plan, invert_plan, dst_sets, validate_config, DST_CUSTOM_ATTR
+from dst_utils.daemon import ChangeBatcher
+
+DATA = "anyconnect-custom-data dynamic-split-exclude-domains "
+VALUE = "anyconnect-custom dynamic-split-exclude-domains value "
+
+RUNNING = """webvpn
+ {attr}
+{data}corp example.com,
+{data}old_set a.example.net,
+{data}legacy b.example.net,
+group-policy Eng attributes
+ {value}corp
+group-policy Sales attributes
+ {value}old_set
+group-policy Marketing attributes
+ {value}old_set
+group-policy Partners attributes
+ {value}legacy
+""".format(attr=DST_CUSTOM_ATTR, data=DATA, value=VALUE)
+
+DST = {
+    "sets": [
+        {"name": "corp", "domains": ["example.org", "Example.com."], "group_policies": ["Eng"]},
+        {"name": "sales", "domains": ["sales.example.net"], "group_policies": ["Sales"]},
+    ]
+}
+
+
+class CommandPlanTest(unittest.TestCase):
+    def test_multi_set_plan(self):
+        plan = build_command_plan(DST, ["Eng", "Sales", "Marketing"], AsaConfig(RUNNING))
+
+        self.assertEqual(
+            plan,
+            [
+                {
+                    "parents": [],
+                    "lines": [
+                        "no " + DATA + "corp example.com,",
+                        DATA + "corp example.com,example.org,",
+                        DATA + "sales sales.example.net,",
+                    ],
+                },
+                {"parents": ["group-policy Sales attributes"], "lines": ["no " + VALUE + "old_set", VALUE + "sales"]},
+                # Marketing is in the run but in no set, so it stops using the removed set.
+                {"parents": ["group-policy Marketing attributes"], "lines": ["no " + VALUE + "old_set"]},
+                # The legacy set stays, since Partners (which this run does not manage) still uses it.
+                {"parents": [], "lines": ["no " + DATA + "old_set a.example.net,"]},
+            ],
+        )
+
+    def test_multi_set_rollback(self):
+        running = AsaConfig(RUNNING)
+        plan = build_command_plan(DST, ["Eng", "Sales", "Marketing"], running)
+
+        self.assertEqual(
+            invert_plan(plan, running),
+            [
+                {"parents": [], "lines": [DATA + "old_set a.example.net,"]},
+                {"parents": ["group-policy Marketing attributes"], "lines": [VALUE + "old_set"]},
+                {"parents": ["group-policy Sales attributes"], "lines": ["no " + VALUE + "sales", VALUE + "old_set"]},
+                {
+                    "parents": [],
+                    "lines": [
+                        "no " + DATA + "sales sales.example.net,",
+                        "no " + DATA + "corp example.com,example.org,",
+                        DATA + "corp example.com,",
+                    ],
+                },
+            ],
+        )
+
+    def test_multi_set_plan_without_running_config(self):
+        plan = build_command_plan(DST, ["Eng", "Sales"])
+
+        self.assertEqual(
+            plan,
+            [
+                {"parents": ["webvpn"], "lines": [DST_CUSTOM_ATTR]},
+                {
+                    "parents": [],
+                    "lines": [DATA + "corp example.com,example.org,", DATA + "sales sales.example.net,"],
+                },
+                {"parents": ["group-policy Eng attributes"], "lines": [VALUE + "corp"]},
+                {"parents": ["group-policy Sales attributes"], "lines": [VALUE + "sales"]},
+            ],
+        )
+
+    def test_unchanged_plan_is_empty(self):
+        plan = build_command_plan(DST, ["Eng", "Sales"], AsaConfig(RUNNING))
+        running = AsaConfig(
+            "\n".join(
+                ["webvpn", " " + DST_CUSTOM_ATTR, DATA + "corp example.com,example.org,", DATA + "sales sales.example.net,"]
+                + ["group-policy Eng attributes", " " + VALUE + "corp", "group-policy Sales attributes", " " + VALUE + "sales"]
+            )
+        )
+
+        self.assertNotEqual(plan, [])
+        self.assertEqual(build_command_plan(DST, ["Eng", "Sales"], running), [])
+
+
+class DstSetsTest(unittest.TestCase):
+    def test_default_set_takes_the_rest(self):
+        dst = {
+            "custom_name": "all",
+            "domains": ["example.com"],
+            "sets": [{"name": "eng", "domains": ["example.org"], "group_policies": ["Eng"]}],
+        }
+
+        sets = dst_sets(dst, ["Eng", "Sales", "Marketing"])
+
+        self.assertEqual([(s["name"], s["group_policies"]) for s in sets], [("all", ["Sales", "Marketing"]), ("eng", ["Eng"])])
+
+    def test_group_policies_outside_the_run_are_ignored(self):
+        sets = dst_sets(DST, ["Eng"])
+
+        self.assertEqual([(s["name"], s["group_policies"]) for s in sets], [("corp", ["Eng"]), ("sales", [])])
+
+    def test_conflicts(self):
+        duplicate = {"sets": [{"name": "a", "domains": []}, {"name": "a", "domains": []}]}
+        shared = {
+            "sets": [{"name": "a", "domains": [], "group_policies": ["Eng"]}, {"name": "b", "domains": [], "group_policies": ["Eng"]}]
+        }
+        ambiguous = {"sets": [{"name": "a", "domains": []}, {"name": "b", "domains": []}]}
+
+        for dst in (duplicate, shared, ambiguous):
+            with self.assertRaises(Exception):
+                dst_sets(dst, ["Eng"])
+
+
+class ConfigChecksTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="dst-test-")
+        self.conf = make_config(os.path.join(self.workdir, "config.yaml"), self.workdir, 2, 4, 1)
+        self.conf["test"]["group_policies"] = ["Eng", "Sales"]
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def errors(self, dst):
+        self.conf["dst"] = dst
+        return [str(e) for e in validate_config("test", self.conf)]
+
+    def test_valid_sets(self):
+        self.assertEqual(self.errors(DST), [])
+
+    def test_invalid_sets(self):
+        self.assertEqual(len(self.errors({"sets": [{"name": "bad name", "domains": ["example.com"], "extra": 1}]})), 1)
+        self.assertEqual(len(self.errors({"sets": [{"name": "a", "domains": ["10.0.0.1"]}]})), 1)
+        self.assertEqual(len(self.errors({"sets": [{"name": "a", "domains": []}, {"name": "b", "domains": []}]})), 1)
+        self.assertEqual(len(self.errors({})), 1)
+
+
+class DaemonSetsTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="dst-test-")
+        self.config_file = os.path.join(self.workdir, "config.yaml")
+        self.state_file = os.path.join(self.workdir, "state.json")
+        conf = make_config(self.config_file, self.workdir, 2, 4, 1)
+        conf["dst"] = {
+            "custom_name": "all",
+            "domains": ["example.com"],
+            "sets": [{"name": "eng", "domains": ["eng.example.org"], "group_policies": ["Eng"]}],
+        }
+        with open(self.config_file, "w") as fd:
+            safe_dump(conf, fd)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_legacy_state_file(self):
+        with open(self.state_file, "w") as fd:
+            json.dump({"domains": ["example.com", "example.net"]}, fd)
+
+        batcher = ChangeBatcher(self.config_file, self.state_file)
+
+        self.assertEqual(batcher.default_set, "all")
+        self.assertEqual(dict(batcher.domains), {"all": ["example.com", "example.net"], "eng": ["eng.example.org"]})
+
+    def test_batch_changes_each_set(self):
+        batcher = ChangeBatcher(self.config_file, self.state_file, window=0)
+        configs = []
+
+        def run(script, config_file, extra):
+            with open(config_file, "r") as fd:
+                configs.append(fd.read())
+            return 0, ""
+
+        with self.assertRaises(ValueError):
+            batcher.submit(add=["example.org"], dst_set="missing")
+
+        changes = [
+            batcher.submit(add=["Example.ORG."], remove=["EXAMPLE.com."]),
+            batcher.submit(add=["hr.example.org"], dst_set="eng"),
+        ]
+        with mock.patch.object(batcher, "_ChangeBatcher__run", run):
+            self.assertTrue(batcher.run_batch(changes))
+
+        # Without --deploy, only the test runs, but its result is kept for the next batch.
+        self.assertEqual(len(configs), 1)
+        self.assertEqual([c.status for c in changes], ["tested", "tested"])
+        with open(self.state_file, "r") as fd:
+            self.assertEqual(json.load(fd), {"sets": {"all": ["example.org"], "eng": ["eng.example.org", "hr.example.org"]}})
+
+    def test_config_is_read_again_for_each_batch(self):
+        batcher = ChangeBatcher(self.config_file, self.state_file, window=0)
+        queued = batcher.submit(add=["ops.example.org"], dst_set="eng")
+
+        with open(self.config_file, "r") as fd:
+            conf = safe_load(fd)
+        conf["dst"]["sets"] = [{"name": "ops", "domains": ["ops.example.net"], "group_policies": ["Ops"]}]
+        with open(self.config_file, "w") as fd:
+            safe_dump(conf, fd)
+
+        with mock.patch.object(batcher, "_ChangeBatcher__run", lambda script, config_file, extra: (0, "")):
+            # The change was queued for a set that is no longer in the config.
+            self.assertFalse(batcher.run_batch([queued]))
+            self.assertEqual(queued.status, "failed")
+            self.assertEqual(dict(batcher.domains), {"all": ["example.com"], "ops": ["ops.example.net"]})
+
+            change = batcher.submit(add=["hr.example.net"], dst_set="ops")
+            self.assertTrue(batcher.run_batch([change]))
+
+        self.assertEqual(change.status, "tested")
+        self.assertEqual(batcher.domains["ops"], ["ops.example.net", "hr.example.net"])
+
+
+if __name__ == "__main__":
+    unittest.main()
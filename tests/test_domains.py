@@ -0,0 +1,104 @@
+"""
+Check how DST domains are packed into custom-data values.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import random
+import unittest
+import math
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from dst_utils.domains import pack_domains, normalize_domains, DST_CUSTOM_DATA_MAX_LEN
+
+
+def make_domains(rng, count):
+    tlds = ["com", "net", "org", "io", "example.com"]
+    return [
+        "{}.{}".format("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 20))), rng.choice(tlds))
+        for _ in range(count)
+    ]
+
+
+def min_values(domains):
+    # No packing can do better than the total length split into full values.
+    return math.ceil(sum(len(d) + 1 for d in normalize_domains(domains)) / DST_CUSTOM_DATA_MAX_LEN)
+
+
+class PackDomainsTest(unittest.TestCase):
+    def test_values_are_valid(self):
+        domains = make_domains(random.Random(1), 500)
+        values = pack_domains(domains)
+
+        self.assertTrue(all(len(v) <= DST_CUSTOM_DATA_MAX_LEN and v.endswith(",") for v in values))
+        self.assertEqual(",".join(v[:-1] for v in values).split(","), normalize_domains(domains))
+
+    def test_value_count(self):
+        for count in (50, 500, 5000):
+            domains = make_domains(random.Random(count), count)
+
+            self.assertLessEqual(len(pack_domains(domains)), math.ceil(min_values(domains) * 1.1))
+
+    def test_added_domain_changes_few_values(self):
+        rng = random.Random(2)
+        domains = make_domains(rng, 1000)
+        values = pack_domains(domains)
+
+        for _ in range(100):
+            new = pack_domains(domains + make_domains(rng, 1), existing=values)
+
+            # One value is replaced by at most two.
+            self.assertLessEqual(len(set(values) - set(new)), 1)
+            self.assertLessEqual(len(set(new) - set(values)), 2)
+
+    def test_removed_domain_changes_one_value(self):
+        rng = random.Random(3)
+        domains = make_domains(rng, 1000)
+        values = pack_domains(domains)
+
+        for domain in rng.sample(domains, 100):
+            new = pack_domains([d for d in domains if d != domain], existing=values)
+
+            self.assertLessEqual(len(set(values) - set(new)), 1)
+            self.assertLessEqual(len(set(new) - set(values)), 1)
+
+    def test_fragmented_values_are_packed_again(self):
+        domains = make_domains(random.Random(4), 200)
+        values = pack_domains(domains, existing=[d + "," for d in normalize_domains(domains)])
+
+        self.assertEqual(values, pack_domains(domains))
+
+
+if __name__ == "__main__":
+    unittest.main()
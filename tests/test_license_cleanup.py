@@ -0,0 +1,215 @@
+"""
+Check that a failed test run never leaves the test firewall registered with Smart Licensing.
+
+Copyright (c) 2020, Copyright (c) 2020, Cisco Systems, Inc. or its affiliates
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import contextlib
+import subprocess
+import io
+import threading
+import tempfile
+import unittest
+import shutil
+import json
+import sys
+import os
+from unittest import mock
+from yaml import safe_dump
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import test_dst
+from bench_dst import make_config, SIM_BIN_DIR
+from dst_topology import DSTTopology
+from dst_sim import FakeClientLibrary, LicenseServer
+
+
+class LicenseCleanupTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="dst-test-")
+        self.old_env = dict(os.environ)
+        self.old_cwd = os.getcwd()
+        os.chdir(ROOT_DIR)
+
+        os.environ["PATH"] = SIM_BIN_DIR + os.pathsep + os.environ.get("PATH", "")
+        os.environ["DST_SIM_PROBE_LATENCY"] = "0"
+        os.environ["DST_SIM_ANSIBLE_HOST_LATENCY"] = "0"
+        os.environ["DST_SIM_ANSIBLE_STARTUP"] = "0"
+        os.environ["DST_SIM_LICENSE_STATE"] = os.path.join(self.workdir, "licensing.json")
+        self.licensing = LicenseServer.from_env()
+
+        # A kept lab must outlive the run that created it, so all runs share one controller.
+        self.cml = FakeClientLibrary("cml.test.local", boot_time=0.05, latency=0)
+        self.lease_file = os.path.join(self.workdir, "lease.json")
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        os.environ.clear()
+        os.environ.update(self.old_env)
+        shutil.rmtree(self.workdir)
+
+    def connect(self, prompt=""):
+        os.environ["DST_SIM_VPN"] = "1"
+        return "y"
+
+    def run_test(self, lease_hours, *extra, gate=None, waits=None):
+        cfg = os.path.join(self.workdir, "config.yaml")
+        conf = make_config(cfg, os.path.join(self.workdir, "snapshots"), 2, 4, 1, license_lease=lease_hours)
+        if waits:
+            conf["test"]["waits"] = waits
+            with open(cfg, "w") as fd:
+                safe_dump(conf, fd)
+        os.environ["DST_SIM_VPN"] = "0"
+        os.environ["DST_SIM_DST_DOMAINS"] = ",".join(conf["dst"]["domains"])
+
+        argv = ["test_dst.py", "-c", cfg, "--lease-file", self.lease_file] + list(extra)
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.object(sys, "argv", argv))
+            stack.enter_context(
+                mock.patch.object(
+                    test_dst, "DSTTopology", lambda host, base_config_dir: DSTTopology(host, base_config_dir, client=self.cml)
+                )
+            )
+            stack.enter_context(mock.patch.object(test_dst, "input", gate or self.connect, create=True))
+            self.output = io.StringIO()
+            stack.enter_context(contextlib.redirect_stdout(self.output))
+            try:
+                test_dst.main()
+            except SystemExit as e:
+                return e.code or 0
+
+        return 0
+
+    def hide_tool(self, tool):
+        # Only the other simulated tools are left in the PATH, so a real one cannot stand in for the hidden one.
+        bindir = os.path.join(self.workdir, "bin")
+        os.makedirs(bindir)
+        for name in os.listdir(SIM_BIN_DIR):
+            if name != tool:
+                path = os.path.join(bindir, name)
+                with open(path, "w") as fd:
+                    fd.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.join(SIM_BIN_DIR, name)))
+                os.chmod(path, 0o755)
+        os.environ["PATH"] = bindir
+
+    def test_failed_run_deregisters(self):
+        os.environ["DST_SIM_ANSIBLE_FAIL_TASK"] = "Apply the Dynamic Split Tunneling command plan"
+
+        self.assertEqual(self.run_test(0), 1)
+
+        stats = self.licensing.stats()
+        self.assertEqual(stats["registrations"], 1)
+        self.assertEqual(stats["deregistrations"], 1)
+        self.assertEqual(stats["registered"], [])
+        self.assertFalse(os.path.exists(self.lease_file))
+
+    def test_interrupted_gate_deregisters(self):
+        threads = []
+
+        def interrupt(prompt=""):
+            # Ctrl-C only reaches the main thread, so the prompt must run there.
+            threads.append(threading.current_thread())
+            raise KeyboardInterrupt()
+
+        self.assertEqual(self.run_test(0, gate=interrupt), 1)
+        self.assertEqual(threads, [threading.main_thread()])
+
+        stats = self.licensing.stats()
+        self.assertEqual(stats["deregistrations"], 1)
+        self.assertEqual(stats["registered"], [])
+        self.assertEqual(self.cml.all_labs(), [])
+
+    def test_unattended_run_waits_for_vpn(self):
+        # The client never connects, so the run gives up before tracing anything and cleans up.
+        self.assertEqual(self.run_test(0, "--yes", waits={"vpn_up": {"initial": 0.01, "deadline": 0.1}}), 1)
+        self.assertIn("did not come up", self.output.getvalue())
+        self.assertEqual(self.licensing.stats()["registered"], [])
+        self.assertEqual(self.cml.all_labs(), [])
+
+    def test_concurrent_run_is_refused(self):
+        # Another run holds the lease lock from its own process.
+        holder = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import sys, fcntl; fd = open(sys.argv[1], 'w'); fcntl.flock(fd, fcntl.LOCK_EX); print(); input()",
+                self.lease_file + ".lock",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        try:
+            holder.stdout.readline()
+            self.assertEqual(self.run_test(1), 1)
+        finally:
+            holder.communicate(b"\n")
+
+        self.assertIn("Another test run is using the Smart License lease", self.output.getvalue())
+        self.assertEqual(self.licensing.stats()["registrations"], 0)
+
+    def test_failed_leased_run_deregisters(self):
+        self.assertEqual(self.run_test(1), 0)
+        self.assertEqual(len(self.licensing.stats()["registered"]), 1)
+
+        # The next run fails before it knows the firewall address, but the lease does.
+        self.hide_tool("traceroute")
+        self.assertEqual(self.run_test(1), 1)
+
+        stats = self.licensing.stats()
+        self.assertEqual(stats["deregistrations"], 1)
+        self.assertEqual(stats["registered"], [])
+        self.assertFalse(os.path.exists(self.lease_file))
+
+    def test_failed_deregistration_keeps_lab(self):
+        self.assertEqual(self.run_test(1), 0)
+        with open(self.lease_file, "r") as fd:
+            lab_id = json.load(fd)["lab_id"]
+
+        self.hide_tool("traceroute")
+        os.environ["DST_SIM_ANSIBLE_FAIL_TASK"] = "Deregister the Smart License license"
+        self.assertEqual(self.run_test(1), 1)
+
+        # The lab and an expired lease are kept so the registration can still be released.
+        self.cml.join_existing_lab(lab_id)
+        with open(self.lease_file, "r") as fd:
+            lease = json.load(fd)
+        self.assertEqual(lease["lab_id"], lab_id)
+        self.assertLessEqual(lease["expires_at"], lease["registered_at"])
+
+        del os.environ["DST_SIM_ANSIBLE_FAIL_TASK"]
+        self.assertEqual(self.run_test(1, "--release-lease"), 0)
+        self.assertEqual(self.licensing.stats()["registered"], [])
+        self.assertFalse(os.path.exists(self.lease_file))
+
+
+if __name__ == "__main__":
+    unittest.main()